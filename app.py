@@ -1,7 +1,14 @@
-import os, sys, subprocess, threading, time, platform, json, queue, socket
+import os, sys, subprocess, threading, time, platform, json, socket, re, uuid, sqlite3, hashlib, asyncio, glob, tempfile, random, shlex, shutil, signal, weakref, atexit
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
 from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+from urllib.request import Request, urlopen
 from datetime import datetime
 from flask import Flask, render_template, request, Response, jsonify, stream_with_context
+try: import resource          # POSIX only: memory limits for child processes
+except ImportError: resource = None
 
 app = Flask(__name__)
 
@@ -9,43 +16,581 @@ app = Flask(__name__)
 DEFAULT_DIR = str(Path.home() / "Downloads" / "YT-Downloader")
 os.makedirs(DEFAULT_DIR, exist_ok=True)
 IS_WINDOWS  = platform.system() == "Windows"
+# Upper bound for simultaneous yt-dlp processes in one playlist batch
+MAX_CONCURRENCY = int(os.environ.get("YTDL_MAX_CONCURRENCY", 8))
+# How many queued jobs may run at the same time
+MAX_JOBS  = int(os.environ.get("YTDL_MAX_JOBS", 2))
+# External tools: a path or a full command line (e.g. the benchmark's fake tools,
+# "python bench/fake_tool.py yt-dlp"). A custom ffmpeg path is passed on to yt-dlp.
+def _tool_cmd(var, default):
+    # posix=False keeps Windows backslashes; it also keeps the quotes, so strip them
+    return [a.strip('"') for a in shlex.split(os.environ.get(var, default), posix=not IS_WINDOWS)]
+YTDLP_CMD  = _tool_cmd("YTDL_YTDLP", "yt-dlp")
+FFMPEG_CMD = _tool_cmd("YTDL_FFMPEG", "ffmpeg")
+# Cluster: with YTDL_COORDINATOR set (e.g. http://10.0.0.5:5050) this process is a
+# worker — it leases downloads from that coordinator and runs them with up to
+# WORKER_SLOTS at a time instead of serving the UI. A coordinator with live workers
+# hands every download to them. Leases are renewed by heartbeats every
+# CLUSTER_HEARTBEAT s; one not renewed for CLUSTER_LEASE s goes to another worker
+# (a task is leased at most CLUSTER_MAX_LEASES times). Run several workers on one
+# machine with distinct YTDL_WORKER_ID; YTDL_WORKER_DIR overrides the save folder.
+COORDINATOR        = os.environ.get("YTDL_COORDINATOR", "").rstrip("/")
+WORKER_ID          = os.environ.get("YTDL_WORKER_ID", socket.gethostname())
+WORKER_SLOTS       = int(os.environ.get("YTDL_WORKER_SLOTS", 2))
+WORKER_DIR         = os.environ.get("YTDL_WORKER_DIR", "")
+CLUSTER_TOKEN      = os.environ.get("YTDL_CLUSTER_TOKEN", "")
+CLUSTER_LEASE      = float(os.environ.get("YTDL_CLUSTER_LEASE", 30))
+CLUSTER_HEARTBEAT  = float(os.environ.get("YTDL_CLUSTER_HEARTBEAT", 5))
+CLUSTER_MAX_LEASES = int(os.environ.get("YTDL_CLUSTER_MAX_LEASES", 3))
+# Durable state (job queue, last playlist) lives here — a worker keeps its own
+# (partials, archive, caches) under worker-<id> so it never touches the queue
+STATE_DIR = os.environ.get("YTDL_STATE_DIR", str(Path.home() / ".yt-downloader" / (f"worker-{WORKER_ID}" if COORDINATOR else "")))
+os.makedirs(STATE_DIR, exist_ok=True)
+DB_PATH   = os.path.join(STATE_DIR, "state.db")
+# Strategy learning: outcomes lose half their weight every STRATEGY_HALF_LIFE seconds,
+# and a strategy with at least STRATEGY_PRUNE_FAILS (decayed) failures and no
+# successes for a host is dropped from that host's chain until it decays back
+STRATEGY_HALF_LIFE   = float(os.environ.get("YTDL_STRATEGY_HALF_LIFE", 3 * 86400))
+STRATEGY_PRUNE_FAILS = float(os.environ.get("YTDL_STRATEGY_PRUNE_FAILS", 6))
+# yt-dlp engine: "subprocess" (one yt-dlp process per attempt) or "inprocess"
+# (yt_dlp.YoutubeDL in long-lived ytdl_worker.py processes; falls back to subprocess)
+ENGINE          = os.environ.get("YTDL_ENGINE", "subprocess")
+INPROC_WORKERS  = int(os.environ.get("YTDL_INPROC_WORKERS", MAX_CONCURRENCY))
+WORKER_SCRIPT   = str(Path(__file__).with_name("ytdl_worker.py"))
+# Progress: at most PROGRESS_HZ "progress" events per job (all items coalesced),
+# plus one log line per PROGRESS_LOG_STEP percent per file
+PROGRESS_HZ       = float(os.environ.get("YTDL_PROGRESS_HZ", 2))
+PROGRESS_LOG_STEP = 10
+# SSE hub: events kept per channel for Last-Event-ID replay, and the most a slow
+# subscriber may have queued before logs are dropped / the connection is reset
+SSE_REPLAY = int(os.environ.get("YTDL_SSE_REPLAY", 500))
+SSE_BUFFER = int(os.environ.get("YTDL_SSE_BUFFER", 1000))
+# Async SSE server port (0 = off, Flask's /stream route only). Default: UI port + 1.
+# It binds to HOST like the UI, and only the UI's own origin may read it cross-port.
+SSE_PORT   = os.environ.get("YTDL_SSE_PORT", "")
+# Address the UI and the SSE server listen on ("127.0.0.1" = this machine only;
+# the default also lets cluster workers and other devices on the network in)
+HOST       = os.environ.get("YTDL_HOST", "0.0.0.0")
+# Extraction cache: playlist listings and per-video info JSON. Info JSON holds
+# stream URLs that expire and are bound to the requesting IP, so keep its TTL short.
+CACHE_DIR      = os.path.join(STATE_DIR, "cache")
+INFO_TTL       = float(os.environ.get("YTDL_INFO_TTL", 1800))
+PLAYLIST_TTL   = float(os.environ.get("YTDL_PLAYLIST_TTL", 900))
+CACHE_MAX_MB   = float(os.environ.get("YTDL_CACHE_MAX_MB", 256))
+# Playlist batches probe their items' formats and sizes before downloading
+# (YTDL_PROBE=0 to skip); format IDs change rarely, so results keep PROBE_TTL s
+PROBE          = os.environ.get("YTDL_PROBE", "1") != "0"
+PROBE_TTL      = float(os.environ.get("YTDL_PROBE_TTL", 6 * 3600))
+# Rate governor (per host, shared by all jobs): yt-dlp launches allowed per minute
+# and burst; 429s back off BACKOFF_BASE·2ⁿ seconds (jittered, capped at BACKOFF_MAX)
+# for the whole queue, and a download gives up after RATE_MAX_429 of them
+EXTRACT_PER_MIN = float(os.environ.get("YTDL_EXTRACT_PER_MIN", 30))
+EXTRACT_BURST   = float(os.environ.get("YTDL_EXTRACT_BURST", 5))
+BACKOFF_BASE    = float(os.environ.get("YTDL_BACKOFF_BASE", 15))
+BACKOFF_MAX     = float(os.environ.get("YTDL_BACKOFF_MAX", 600))
+RATE_MAX_429    = int(os.environ.get("YTDL_MAX_429", 6))
+# yt-dlp's own retry delay: --retry-sleep expression (http and fragment retries)
+RETRY_SLEEP     = os.environ.get("YTDL_RETRY_SLEEP", "exp=1:30")
+# Bandwidth: total download budget shared by all running attempts ("0" = unlimited,
+# else e.g. "4M"); time-of-day schedules and the live value are set via /api/bandwidth.
+# Subprocess attempts are restarted with a new --limit-rate at most every BW_RESTART_MIN s.
+BANDWIDTH      = os.environ.get("YTDL_BANDWIDTH", "0")
+BW_TICK        = 5.0
+BW_RESTART_MIN = float(os.environ.get("YTDL_BW_RESTART_MIN", 30))
+# Partial downloads (.part/.ytdl) of unfinished attempts are kept for resuming;
+# once their job is over they are deleted after PARTIAL_TTL seconds
+PARTIAL_TTL = float(os.environ.get("YTDL_PARTIAL_TTL", 86400))
+# Batch conversion: ffmpeg processes run side by side (default one per CPU core)
+CONVERT_WORKERS = int(os.environ.get("YTDL_CONVERT_WORKERS", os.cpu_count() or 2))
+# Post-download pipeline: yt-dlp only fetches the raw streams and a pool of
+# POSTPROCESS_WORKERS ffmpeg processes merges / extracts audio / tags them, so a
+# playlist's next download overlaps the previous item's mux. LOUDNORM is a target
+# loudness in LUFS (e.g. "-16", "" = off); EMBED adds metadata and cover art.
+PIPELINE            = os.environ.get("YTDL_PIPELINE", "1") != "0"
+POSTPROCESS_WORKERS = int(os.environ.get("YTDL_POSTPROCESS_WORKERS", os.cpu_count() or 2))
+LOUDNORM            = os.environ.get("YTDL_LOUDNORM", "")
+EMBED               = os.environ.get("YTDL_EMBED", "1") != "0"
+# Child processes: each runs in its own process group (tree-killed on Windows), so
+# stopping a job also kills the ffmpeg a yt-dlp started. NICE / CONVERT_NICE lower the CPU priority of yt-dlp
+# and of ffmpeg (conversions, postprocessing) so a long encode can't starve the
+# downloads; MEM_LIMIT_MB caps each child's address space (Linux, 0 = none).
+# A process is killed after STALL_SECS s without a line of output or progress
+# (yt-dlp until it starts postprocessing, and anything reporting progress) or
+# after PROC_TIMEOUT s in total — an attempt killed that way fails over to the
+# next strategy. A job still running after JOB_TIMEOUT s is cancelled. 0 turns
+# each limit off.
+PROC_NICE    = int(os.environ.get("YTDL_NICE", 0))
+CONVERT_NICE = int(os.environ.get("YTDL_CONVERT_NICE", 10))
+MEM_LIMIT_MB = int(os.environ.get("YTDL_MEM_LIMIT_MB", 0))
+STALL_SECS   = float(os.environ.get("YTDL_STALL_SECS", 300))
+PROC_TIMEOUT = float(os.environ.get("YTDL_PROC_TIMEOUT", 0))
+JOB_TIMEOUT  = float(os.environ.get("YTDL_JOB_TIMEOUT", 0))
+# yt-dlp self-update: PyPI is asked at most every UPDATE_INTERVAL s (0 = never) and
+# only while no job runs. A newer release is installed into its own folder under
+# UPDATE_DIR and switched to between jobs. Off with a custom YTDL_YTDLP.
+UPDATE_INTERVAL = float(os.environ.get("YTDL_UPDATE_INTERVAL", 86400))
+UPDATE_DELAY    = 60          # no check in the first minute after startup
+UPDATE_DIR      = os.path.join(STATE_DIR, "yt-dlp")
+# `python app.py download …` runs one batch from the command line (see HEADLESS
+# CLI): no UI, no job scheduler picking up queued jobs, no self-update.
+HEADLESS = __name__ == "__main__" and sys.argv[1:2] == ["download"]
+# One process owns STATE_DIR (an OS lock on owner.lock, held until exit). Only the
+# owner recovers the queue, cluster tasks, partials and playlist at startup; the CLI
+# refuses to run on a folder another process owns.
+_state_lock = None
+def _own_state_dir():
+    global _state_lock
+    f = open(os.path.join(STATE_DIR, "owner.lock"), "a+")
+    try:
+        if IS_WINDOWS:
+            import msvcrt; f.seek(0); msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl; fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close(); return False
+    _state_lock = f
+    return True
+STATE_OWNER = _own_state_dir()
 
 # ── Shared state ─────────────────────────────────────────────────────────────
-playlist_videos = []
-active_process  = None
-stop_flag       = threading.Event()
-# Per-client SSE queues  {client_id: queue.Queue}
-sse_queues: dict[str, queue.Queue] = {}
+playlist_videos  = []
+playlist_lock    = threading.Lock()
+# playlist_epoch changes whenever the list is replaced; playlist_version on every change.
+# Clients apply "playlist_delta" events in version order and re-read the snapshot on a gap.
+playlist_epoch   = 0
+playlist_version = 0
+# Running jobs  {job_id: Job}  — the durable queue is in `store` (see JOB QUEUE)
+jobs: dict[str, "Job"] = {}
+jobs_lock = threading.Lock()
+
+def ts(): return datetime.now().strftime("%H:%M:%S")
 
 # ═══════════════════════════════════════════════════════════════════════════
-#  STARTUP — auto-update yt-dlp
+#  METRICS  (Prometheus text format at /metrics — no client library needed)
 # ═══════════════════════════════════════════════════════════════════════════
-def ts(): return datetime.now().strftime("%H:%M:%S")
+# Counters and histograms are updated where things happen; gauges (job states,
+# queue depths, throughput…) are read from their owners when /metrics is scraped.
+# Durations are histograms so latency can be broken down by stage under load.
+METRIC_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
 
-def _startup_update():
-    try:
-        subprocess.run([sys.executable,"-m","pip","install","--upgrade","yt-dlp"],
-                       capture_output=True, text=True, timeout=120)
-        print("[startup] yt-dlp update done")
-    except Exception as e:
-        print(f"[startup] yt-dlp update failed: {e}")
+def _labels(labels):
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}" if labels else ""
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock(); self.help = {}
+        self.counters = {}      # (name, labels) → value
+        self.hists    = {}      # (name, labels) → [bucket counts…, sum, count]
 
-threading.Thread(target=_startup_update, daemon=True).start()
+    def describe(self, name, text): self.help[name] = text
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.hists.get(key)
+            if h is None: h = self.hists[key] = [0] * (len(METRIC_BUCKETS) + 2)
+            for k, b in enumerate(METRIC_BUCKETS):
+                if value <= b: h[k] += 1
+            h[-2] += value; h[-1] += 1
+
+    def render(self, gauges=()):
+        """Exposition text; `gauges` is [(name, help, [(labels dict, value)])] sampled by the caller."""
+        with self.lock: counters = dict(self.counters); hists = {k: list(v) for k, v in self.hists.items()}
+        out = []; seen = set()
+        def head(name, kind, text):
+            if name not in seen: seen.add(name); out.extend([f"# HELP {name} {text}", f"# TYPE {name} {kind}"])
+        for (name, labels), v in sorted(counters.items()):
+            head(name, "counter", self.help.get(name, name)); out.append(f"{name}{_labels(labels)} {v}")
+        for (name, labels), h in sorted(hists.items()):
+            head(name, "histogram", self.help.get(name, name))
+            for b, n in zip(METRIC_BUCKETS, h):
+                out.append(f"{name}_bucket{_labels(labels + (('le', b),))} {n}")
+            out.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {h[-1]}")
+            out.append(f"{name}_sum{_labels(labels)} {round(h[-2], 6)}")
+            out.append(f"{name}_count{_labels(labels)} {h[-1]}")
+        for name, text, samples in gauges:
+            head(name, "gauge", text)
+            out.extend(f"{name}{_labels(tuple(sorted(l.items())))} {v}" for l, v in samples)
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+for _name, _text in [
+    ("ytdl_strategy_attempts_total", "smart_download attempts by strategy and outcome"),
+    ("ytdl_attempt_errors_total",    "attempts that hit HTTP 403, 429 or SABR"),
+    ("ytdl_downloaded_bytes_total",  "bytes downloaded by yt-dlp"),
+    ("ytdl_process_spawns_total",    "yt-dlp/ffmpeg/worker processes started"),
+    ("ytdl_watchdog_kills_total",    "processes killed for stalling or running too long, and jobs cancelled at JOB_TIMEOUT"),
+    ("ytdl_jobs_finished_total",     "jobs that ended, by kind and final state"),
+    ("ytdl_sse_events_total",        "events published to SSE channels"),
+    ("ytdl_sse_dropped_total",       "log events dropped for slow SSE subscribers"),
+    ("ytdl_stage_seconds",           "time per stage: extraction, download, postprocess, convert, listing"),
+    ("ytdl_attempt_seconds",         "wall time of one smart_download attempt"),
+    ("ytdl_job_seconds",             "wall time of a job from start to end"),
+]: metrics.describe(_name, _text)
 
 # ═══════════════════════════════════════════════════════════════════════════
-#  SSE HELPERS
+#  SSE HUB  (fan-out per client channel, bounded buffers, Last-Event-ID replay)
 # ═══════════════════════════════════════════════════════════════════════════
+# Events are (seq, event, data). Every tab with the same client id subscribes to
+# the same channel and gets its own copy. Per subscriber:
+#   · "progress" events still queued are merged by item index (coalesce)
+#   · past SSE_BUFFER, the oldest "log" lines are dropped and counted
+#   · if only non-log events are left to drop, the subscriber is reset; the
+#     browser reconnects with Last-Event-ID and catches up from the replay ring
+COALESCE = {"progress"}
+
+class Subscriber:
+    def __init__(self, notify):
+        self.buf = deque(); self.lock = threading.Lock()
+        self.notify = notify; self.dropped = 0; self.overflow = False
+
+    def offer(self, item):
+        seq, event, data = item
+        with self.lock:
+            if event in COALESCE:
+                for k, old in enumerate(self.buf):
+                    if old[1] == event and json.loads(old[2]).get("job") == json.loads(data).get("job"):
+                        merged = {i["index"]: i for i in json.loads(old[2])["items"] + json.loads(data)["items"]}
+                        self.buf[k] = (seq, event, json.dumps(dict(json.loads(data), items=list(merged.values()))))
+                        break
+                else: self.buf.append(item)
+            else: self.buf.append(item)
+            while len(self.buf) > SSE_BUFFER:
+                k = next((k for k, it in enumerate(self.buf) if it[1] == "log"), None)
+                if k is None: self.overflow = True; break
+                del self.buf[k]; self.dropped += 1; metrics.inc("ytdl_sse_dropped_total")
+        self.notify()
+
+    def drain(self):
+        with self.lock:
+            items = list(self.buf); self.buf.clear()
+            if self.dropped:
+                items.insert(0, (None, "log", f"[{ts()}] … {self.dropped} log lines skipped (slow connection)"))
+                self.dropped = 0
+        return items
+
+class Channel:
+    def __init__(self):
+        self.seq = int(time.time() * 1000)   # ids keep increasing across restarts
+        self.ring = deque(maxlen=SSE_REPLAY); self.subs = set()
+        self.delivered = self.seq; self.touched = time.time()
+
+class EventHub:
+    def __init__(self):
+        self.channels: dict[str, Channel] = {}; self.lock = threading.Lock()
+
+    def _channel(self, cid):
+        ch = self.channels.get(cid)
+        if not ch: ch = self.channels[cid] = Channel()
+        ch.touched = time.time()
+        return ch
+
+    def publish(self, cid, event, data):
+        with self.lock:
+            ch = self._channel(cid); ch.seq += 1
+            item = (ch.seq, event, data); ch.ring.append(item)
+            subs = list(ch.subs)
+            if subs: ch.delivered = ch.seq
+        metrics.inc("ytdl_sse_events_total", event=event)
+        for sub in subs: sub.offer(item)
+
+    def subscribe(self, cid, notify, last_id=None):
+        """New subscriber, pre-filled with what it missed: events after last_id, or —
+        on a first connect — whatever was published while nobody was listening."""
+        sub = Subscriber(notify)
+        with self.lock:
+            ch = self._channel(cid)
+            after = last_id if last_id is not None and last_id <= ch.seq else ch.delivered
+            for item in ch.ring:
+                if item[0] > after: sub.buf.append(item)
+            ch.subs.add(sub); ch.delivered = ch.seq
+        return sub
+
+    def unsubscribe(self, cid, sub):
+        with self.lock:
+            ch = self.channels.get(cid)
+            if ch: ch.subs.discard(sub)
+            # forget channels nobody has used for a day
+            stale = [k for k, c in self.channels.items() if not c.subs and time.time() - c.touched > 86400]
+            for k in stale: del self.channels[k]
+
+    def close(self, cid):
+        """Forget a channel that will not be used again (a cluster task's relay channel)."""
+        with self.lock: self.channels.pop(cid, None)
+
+    def stats(self):
+        with self.lock:
+            return {cid: {"subscribers": len(ch.subs), "replay": len(ch.ring),
+                          "queued": [len(s.buf) for s in ch.subs]} for cid, ch in self.channels.items()}
+
+hub = EventHub()
+
+def sse_frame(item):
+    seq, event, data = item
+    lines = "".join(f"data: {l}\n" for l in str(data).split("\n"))
+    return (f"id: {seq}\n" if seq is not None else "") + f"event: {event}\n{lines}\n"
+
 def push(client_id: str, msg: str, event="log"):
-    """Push a message to a specific client's SSE queue."""
-    q = sse_queues.get(client_id)
-    if q:
-        q.put(json.dumps({"event": event, "data": msg}))
+    """Publish a message on a client's SSE channel (delivered to every open tab)."""
+    hub.publish(client_id, event, msg)
 
 def push_done(client_id: str, success: bool, saved_to: str = ""):
     push(client_id, json.dumps({"ok": success, "path": saved_to}), event="done")
 
-def push_playlist(client_id: str, videos: list):
-    push(client_id, json.dumps(videos), event="playlist")
+def replace_playlist(videos: list):
+    """Swap in a new playlist (new epoch). Returns (epoch, version)."""
+    global playlist_videos, playlist_epoch, playlist_version
+    with playlist_lock:
+        playlist_videos = videos; playlist_epoch += 1; playlist_version += 1
+        return playlist_epoch, playlist_version
+
+def playlist_snapshot():
+    with playlist_lock:
+        return {"epoch": playlist_epoch, "v": playlist_version, "videos": [dict(v) for v in playlist_videos]}
+
+def set_item_status(client_id: str, index: int, status: str, vid: str = ""):
+    """Update one playlist row and push it as a delta; ignored if the playlist was re-fetched (vid mismatch)."""
+    global playlist_version
+    with playlist_lock:
+        if index >= len(playlist_videos): return
+        if vid and playlist_videos[index].get("id") != vid: return
+        playlist_videos[index]["status"] = status
+        playlist_version += 1
+        delta = {"epoch": playlist_epoch, "v": playlist_version, "items": [{"index": index, "status": status}]}
+    push(client_id, json.dumps(delta), event="playlist_delta")
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  JOBS  (one per route call — owns its stop flag and child processes)
+# ═══════════════════════════════════════════════════════════════════════════
+class Job:
+    def __init__(self, client_id: str, kind: str, job_id: str = ""):
+        self.id        = job_id or uuid.uuid4().hex[:12]
+        self.client_id = client_id
+        self.kind      = kind
+        self.stop      = threading.Event()
+        self.procs     = set()
+        self.lock      = threading.Lock()
+        self.pending   = {}        # index → latest progress not yet pushed
+        self.last_emit = 0.0
+        self.deadline  = None      # set by watchdog.limit (JOB_TIMEOUT)
+        self.timed_out = False
+
+    def attach(self, proc):
+        with self.lock: self.procs.add(proc)
+
+    def detach(self, proc):
+        with self.lock: self.procs.discard(proc)
+
+    def cancel(self):
+        """Set the stop flag and terminate every process this job has running."""
+        self.stop.set()
+        with self.lock: procs = list(self.procs)
+        for p in procs:
+            try: p.terminate()
+            except: pass
+
+    def report(self, index, p, force=False):
+        """Coalesce progress for all of this job's items into ≤ PROGRESS_HZ "progress" events."""
+        with self.lock:
+            self.pending[index] = p; now = time.time()
+            if not force and now - self.last_emit < 1.0 / PROGRESS_HZ: return
+            items = [dict(v, index=k) for k, v in self.pending.items()]
+            self.pending.clear(); self.last_emit = now
+        push(self.client_id, json.dumps({"job": self.id, "kind": self.kind, "items": items}), event="progress")
+
+    def info(self):
+        with self.lock: n = len(self.procs)
+        return {"id": self.id, "client_id": self.client_id, "kind": self.kind,
+                "processes": n, "stopping": self.stop.is_set()}
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  JOB QUEUE  (SQLite — survives restarts)
+# ═══════════════════════════════════════════════════════════════════════════
+# Job states:  queued → running → done | failed
+#              paused (resume → queued) · cancelled (terminal)
+# Item states mirror the playlist badges: queued/downloading/done/failed/skipped
+ACTIVE_STATES = ("queued", "running", "paused")
+
+class JobStore:
+    """Thin SQLite wrapper — one connection shared by all threads behind a lock."""
+    def __init__(self, path):
+        self.db   = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY, client_id TEXT, kind TEXT, params TEXT,
+                    priority INTEGER DEFAULT 0, state TEXT, error TEXT DEFAULT '',
+                    created REAL, updated REAL);
+                CREATE TABLE IF NOT EXISTS items (
+                    job_id TEXT, idx INTEGER, video_id TEXT, title TEXT, url TEXT, status TEXT,
+                    PRIMARY KEY (job_id, idx));
+                CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS conversions (
+                    dst TEXT PRIMARY KEY, src TEXT, size INTEGER, mtime REAL, sha1 TEXT,
+                    settings TEXT, updated REAL);
+                CREATE INDEX IF NOT EXISTS jobs_pick ON jobs (state, priority DESC, created);
+            """)
+
+    def q(self, sql, args=()):
+        with self.lock: return [dict(r) for r in self.db.execute(sql, args).fetchall()]
+
+    def x(self, sql, args=()):
+        with self.lock: self.db.execute(sql, args)
+
+    @contextmanager
+    def transaction(self, mode=""):
+        """Hold the lock for an explicit BEGIN [mode] … COMMIT. On any error the transaction
+        is rolled back, so the shared autocommit connection is never left inside it."""
+        with self.lock:
+            self.db.execute(f"BEGIN {mode}")
+            try:
+                yield self.db
+                self.db.execute("COMMIT")
+            except BaseException:
+                if self.db.in_transaction: self.db.execute("ROLLBACK")
+                raise
+
+    def add(self, job_id, client_id, kind, params, priority=0, items=None):
+        now = time.time()
+        with self.transaction() as db:
+            db.execute("INSERT INTO jobs VALUES (?,?,?,?,?,?,?,?,?)",
+                       (job_id, client_id, kind, json.dumps(params), priority, "queued", "", now, now))
+            if items:
+                db.executemany("INSERT INTO items VALUES (?,?,?,?,?,?)",
+                    [(job_id, it["idx"], it["id"], it["title"], it["url"], it["status"]) for it in items])
+
+    def get(self, job_id):
+        rows = self.q("SELECT * FROM jobs WHERE id=?", (job_id,))
+        return rows[0] if rows else None
+
+    def set_state(self, job_id, state, error=""):
+        self.x("UPDATE jobs SET state=?, error=?, updated=? WHERE id=?", (state, error, time.time(), job_id))
+
+    def next_queued(self):
+        rows = self.q("SELECT * FROM jobs WHERE state='queued' ORDER BY priority DESC, created LIMIT 1")
+        return rows[0] if rows else None
+
+    def items(self, job_id):
+        return self.q("SELECT idx, video_id AS id, title, url, status FROM items WHERE job_id=? ORDER BY idx", (job_id,))
+
+    def set_item(self, job_id, idx, status):
+        self.x("UPDATE items SET status=? WHERE job_id=? AND idx=?", (status, job_id, idx))
+
+    def item_counts(self, job_id):
+        return {r["status"]: r["n"] for r in self.q(
+            "SELECT status, COUNT(*) AS n FROM items WHERE job_id=? GROUP BY status", (job_id,))}
+
+    def recover(self):
+        """After a crash/restart: running jobs go back to the queue, half-done items restart."""
+        self.x("UPDATE jobs SET state='queued' WHERE state='running'")
+        self.x("UPDATE items SET status='queued' WHERE status='downloading' AND job_id IN "
+               "(SELECT id FROM jobs WHERE state IN ('queued','paused'))")
+
+    def put_kv(self, key, value):
+        self.x("INSERT OR REPLACE INTO kv VALUES (?,?)", (key, json.dumps(value)))
+
+    def get_kv(self, key, default=None):
+        rows = self.q("SELECT value FROM kv WHERE key=?", (key,))
+        return json.loads(rows[0]["value"]) if rows else default
+
+class Scheduler:
+    """Runs queued jobs from `store`, highest priority first, at most `max_jobs` at a time."""
+    def __init__(self, store, max_jobs):
+        self.store    = store
+        self.max_jobs = max_jobs
+        self.wake     = threading.Event()
+        self.lock     = threading.Lock()
+
+    def start(self):
+        if STATE_OWNER: self.store.recover()      # else the owner's running jobs aren't orphans
+        threading.Thread(target=self._loop, daemon=True, name="scheduler").start()
+
+    def submit(self, client_id, kind, params, priority=0, items=None):
+        job_id = uuid.uuid4().hex[:12]
+        self.store.add(job_id, client_id, kind, params, priority, items)
+        self.wake.set()
+        return job_id
+
+    def _loop(self):
+        while True:
+            self.wake.wait(timeout=2); self.wake.clear()
+            # one failed pass (e.g. a SQLite error) must not end the loop — nothing would ever start again
+            try:
+                with self.lock:
+                    updater.swap_if_idle()
+                    while True:
+                        with jobs_lock: running = len(jobs)
+                        if running >= self.max_jobs: break
+                        row = self.store.next_queued()
+                        if not row: break
+                        try: self._launch(row)
+                        except Exception as e:
+                            print(f"[scheduler] job {row['id']} could not start: {e}")
+                            with jobs_lock: jobs.pop(row["id"], None)
+                            self.store.set_state(row["id"], "failed", f"could not start: {e}")
+            except Exception as e: print(f"[scheduler] {e}")
+
+    def _launch(self, row):
+        target = JOB_KINDS.get(row["kind"])
+        if not target:
+            self.store.set_state(row["id"], "failed", f"unknown job kind {row['kind']}"); return
+        job = Job(row["client_id"], row["kind"], row["id"]); watchdog.limit(job)
+        with jobs_lock: jobs[job.id] = job
+        self.store.set_state(job.id, "running")
+        threading.Thread(target=self._run, args=(job, target, json.loads(row["params"])),
+                         daemon=True, name=f"job-{job.id}").start()
+
+    def _run(self, job, target, params):
+        ok, error = False, ""; t0 = time.time()
+        try: ok = bool(target(job, **params))
+        except Exception as e:
+            error = str(e); push(job.client_id, f"[{ts()}] Exception: {e}")
+        finally:
+            if job.timed_out: error = error or f"timed out after {JOB_TIMEOUT:.0f}s"
+            with jobs_lock: jobs.pop(job.id, None)
+            # pause/cancel already wrote the final state — only settle jobs still marked running
+            row = self.store.get(job.id)
+            if row and row["state"] == "running":
+                self.store.set_state(job.id, "done" if ok else "failed", error)
+            final = "done" if ok else "failed" if not row or row["state"] == "running" else row["state"]
+            metrics.inc("ytdl_jobs_finished_total", kind=job.kind, state=final)
+            metrics.observe("ytdl_job_seconds", time.time() - t0, kind=job.kind)
+            partials.settle(job.id)
+            self.wake.set()
+
+    def _stop(self, job_id, state):
+        row = self.store.get(job_id)
+        if not row or row["state"] not in ACTIVE_STATES: return False
+        self.store.set_state(job_id, state)
+        with jobs_lock: job = jobs.get(job_id)
+        if job: job.cancel()
+        return True
+
+    def pause(self, job_id):  return self._stop(job_id, "paused")
+    def cancel(self, job_id): return self._stop(job_id, "cancelled")
+
+    def resume(self, job_id):
+        row = self.store.get(job_id)
+        if not row or row["state"] != "paused": return False
+        with jobs_lock: busy = job_id in jobs
+        if busy: return False   # still winding down after pause — try again shortly
+        self.store.x("UPDATE items SET status='queued' WHERE job_id=? AND status='downloading'", (job_id,))
+        self.store.set_state(job_id, "queued"); self.wake.set()
+        return True
+
+    def set_max_jobs(self, n):
+        self.max_jobs = max(1, n); self.wake.set()
+
+store     = JobStore(DB_PATH)
+scheduler = Scheduler(store, MAX_JOBS)
 
 # ═══════════════════════════════════════════════════════════════════════════
 #  UTILITY
@@ -65,7 +610,8 @@ def build_cookie_args(browser, cookie_file):
 
 def build_extra_args(rate_limit, retries):
     """Return a list of yt-dlp extra flag arguments."""
-    args = ["--retries", str(retries), "--fragment-retries", str(retries), "--retry-sleep", "5"]
+    args = ["--retries", str(retries), "--fragment-retries", str(retries),
+            "--retry-sleep", f"http:{RETRY_SLEEP}", "--retry-sleep", f"fragment:{RETRY_SLEEP}"]
     if rate_limit != "No limit":
         speed = rate_limit.replace("MB/s","M").replace("KB/s","K").strip()
         args += ["--limit-rate", speed]
@@ -78,9 +624,13 @@ def build_cookie_flag(browser, cookie_file):
 def build_extra_flags(rate_limit, retries):
     return " ".join(build_extra_args(rate_limit, retries))
 
-def is_403(o): return any(x in o for x in ["HTTP Error 403","Forbidden","unable to download video data","Got error: 403"])
-def is_429(o): return "429" in o or "Too Many Requests" in o
-def is_sabr(o): return "SABR" in o or "sabr" in o.lower()
+# Only yt-dlp's own error/warning lines are classified — a title such as "Route 429"
+# or "Sabrina" in a Destination line must not back off a whole host
+YTDLP_ERR_RE = re.compile(r"^(ERROR|WARNING):|^\[download\] Got error:")
+def _err_line(o): return bool(YTDLP_ERR_RE.match(o.lstrip()))
+def is_403(o): return _err_line(o) and any(x in o for x in ["HTTP Error 403","Forbidden","unable to download video data","Got error: 403"])
+def is_429(o): return _err_line(o) and ("HTTP Error 429" in o or "Too Many Requests" in o)
+def is_sabr(o): return _err_line(o) and "SABR" in o
 
 def fmt_fallback(cmd):
     for pat in [
@@ -95,6 +645,138 @@ def fmt_fallback(cmd):
 # ═══════════════════════════════════════════════════════════════════════════
 #  RUN LIVE  (yields lines to client via SSE)
 # ═══════════════════════════════════════════════════════════════════════════
+def tool_args(args):
+    """Swap the leading "yt-dlp"/"ffmpeg" of an args list for the configured command
+    (or the staged yt-dlp release the updater switched to)."""
+    if args[0] == "yt-dlp":
+        loc = ["--ffmpeg-location", FFMPEG_CMD[0]] if FFMPEG_CMD != ["ffmpeg"] and len(FFMPEG_CMD) == 1 else []
+        cmd = [sys.executable, "-m", "yt_dlp"] if updater.active else YTDLP_CMD
+        return cmd + loc + args[1:]
+    if args[0] == "ffmpeg": return FFMPEG_CMD + args[1:]
+    return args
+
+def tool_env():
+    """Environment for child processes: a staged yt-dlp release goes first on the import path."""
+    if not updater.active: return None
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in (updater.active, os.environ.get("PYTHONPATH")) if p))
+
+class Child(subprocess.Popen):
+    """A child started by spawn(): terminate()/kill() take down everything it started
+    too (the ffmpeg a yt-dlp runs) — its process group on POSIX, its process tree
+    via taskkill /T on Windows, where TerminateProcess only ends the one process."""
+    def send_signal(self, sig):
+        if not IS_WINDOWS and self.returncode is None:
+            try: os.killpg(self.pid, sig); return
+            except OSError: pass
+        super().send_signal(sig)
+
+    def _kill_tree(self):
+        if self.poll() is not None: return
+        try: subprocess.run(["taskkill", "/T", "/F", "/PID", str(self.pid)], capture_output=True, timeout=15,
+                            creationflags=subprocess.CREATE_NO_WINDOW)
+        except (OSError, subprocess.SubprocessError): pass
+
+    def terminate(self):
+        if IS_WINDOWS: self._kill_tree()
+        super().terminate()
+
+    def kill(self):
+        if IS_WINDOWS: self._kill_tree()
+        super().kill()
+
+# spawn()ed processes don't get the terminal's Ctrl+C any more — they are killed on exit instead
+children = weakref.WeakSet()
+
+@atexit.register
+def _kill_children():
+    for c in list(children):
+        try: c.poll() is None and c.kill()
+        except Exception: pass
+
+def spawn(args, nice=0, **kw):
+    """Popen in a process group of its own, with `nice` added to its CPU niceness and
+    MEM_LIMIT_MB applied. Both are set on the new pid from here rather than in a
+    preexec_fn, which isn't safe with threads; grandchildren inherit them."""
+    if IS_WINDOWS:
+        kw["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP | (subprocess.BELOW_NORMAL_PRIORITY_CLASS if nice > 0 else 0)
+    else: kw["start_new_session"] = True
+    proc = Child(args, shell=False, env=tool_env(), **kw)
+    children.add(proc)
+    if not IS_WINDOWS:
+        try:
+            if nice > 0: os.setpriority(os.PRIO_PROCESS, proc.pid, min(19, os.getpriority(os.PRIO_PROCESS, 0) + nice))
+            if MEM_LIMIT_MB and hasattr(resource, "prlimit"):
+                resource.prlimit(proc.pid, resource.RLIMIT_AS, (MEM_LIMIT_MB << 20, MEM_LIMIT_MB << 20))
+        except OSError: pass     # already exited, or not allowed here
+    return proc
+
+class Watch:
+    """One watched process: touch() on every line; `reason` is why the watchdog killed it.
+
+    Once yt-dlp starts postprocessing inline (YTDL_PIPELINE=0) it runs ffmpeg quietly
+    until the merge / extraction is done, so from its first postprocessor line on
+    only PROC_TIMEOUT applies — a long merge is not a stall.
+    """
+    POSTPROCESS_RE = re.compile(r"^\[(Merger|ExtractAudio|VideoConvertor|VideoRemuxer|Fixup\w+|EmbedThumbnail|"
+                                r"EmbedSubtitle|Metadata|ModifyChapters|SplitChapters|ThumbnailsConvertor|FFmpeg\w*)\] ")
+    __slots__ = ("proc", "stall", "timeout", "seen", "deadline", "reason")
+    def __init__(self, proc, stall, timeout):
+        self.proc, self.stall, self.timeout = proc, stall, timeout
+        self.seen = time.time(); self.deadline = self.seen + timeout if timeout else None; self.reason = ""
+    def touch(self, line=""):
+        self.seen = time.time()
+        if self.stall and self.POSTPROCESS_RE.match(line): self.stall = 0
+    def why(self):
+        return (f"No output for {self.stall:.0f}s" if self.reason == "stall"
+                else f"Still running after {self.timeout:.0f}s") + " — killed"
+
+class Watchdog:
+    """Kills processes that stall or run past their time, and cancels jobs past
+    JOB_TIMEOUT. One thread checks everything once a second."""
+    TICK = 1.0
+    def __init__(self):
+        self.lock = threading.Lock(); self.watches = set(); self.jobs = weakref.WeakSet()
+
+    def watch(self, proc, stall=0, timeout=PROC_TIMEOUT):
+        w = Watch(proc, stall, timeout)
+        if stall or timeout:
+            with self.lock: self.watches.add(w)
+        return w
+
+    def unwatch(self, w):
+        with self.lock: self.watches.discard(w)
+
+    def limit(self, job, timeout=JOB_TIMEOUT):
+        """Cancel `job` if it is still running `timeout` s from now."""
+        if not timeout: return
+        job.deadline = time.time() + timeout
+        with self.lock: self.jobs.add(job)
+
+    def start(self):
+        threading.Thread(target=self._loop, daemon=True, name="watchdog").start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.TICK); now = time.time()
+            with self.lock:
+                watches = list(self.watches)
+                late = [j for j in self.jobs if j.deadline and now > j.deadline]
+            for w in watches:
+                if w.reason: continue
+                if w.stall and now - w.seen > w.stall: w.reason = "stall"
+                elif w.deadline and now > w.deadline: w.reason = "timeout"
+                else: continue
+                metrics.inc("ytdl_watchdog_kills_total", reason=w.reason)
+                try: w.proc.kill()
+                except Exception: pass
+            for j in late:
+                j.deadline = None; j.timed_out = True
+                metrics.inc("ytdl_watchdog_kills_total", reason="job_timeout")
+                push(j.client_id, f"[{ts()}] ⏱ Job time limit reached — cancelling")
+                j.cancel()
+
+watchdog = Watchdog()
+
 def _parse_cookie_flag(flag_str):
     """Convert legacy cookie flag string back to (browser, cookie_file) for build_cookie_args."""
     if not flag_str: return "None", ""
@@ -108,38 +790,600 @@ def _parse_cookie_flag(flag_str):
 def _parse_extra_flags(flag_str):
     """Convert legacy extra flags string to a list for shell=False calls."""
     if not flag_str: return []
-    import shlex
     try: return shlex.split(flag_str)
     except: return flag_str.split()
 
 BROWSERS = ["chrome","firefox","edge","brave","opera","chromium","safari"]
 
-def run_and_stream(args, client_id):
-    """Run a command (list of args, shell=False), stream output to SSE. Returns (ok, full_output)."""
-    global active_process
+# ═══════════════════════════════════════════════════════════════════════════
+#  PROGRESS + OUTPUT CLASSIFICATION
+# ═══════════════════════════════════════════════════════════════════════════
+# yt-dlp prints one machine-readable line per progress tick instead of its
+# human "[download]  42.0% of …" line:  [progress]status|done|total|estimate|speed|eta
+PROGRESS_TEMPLATE = ("download:[progress]%(progress.status)s|%(progress.downloaded_bytes)s|"
+                     "%(progress.total_bytes)s|%(progress.total_bytes_estimate)s|"
+                     "%(progress.speed)s|%(progress.eta)s")
+PROGRESS_ARGS = ["--progress-template", PROGRESS_TEMPLATE]
+PROGRESS_RE   = re.compile(r"^\[download\]\s+([\d.]+)%")
+
+def parse_progress(line):
+    """Progress dict for a template or classic yt-dlp progress line, else None."""
+    if line.startswith("[progress]"):
+        f = [None if x in ("NA", "None", "") else x for x in line[10:].split("|")]
+        if len(f) < 6: return None
+        num = lambda x: int(float(x)) if x is not None else None
+        done, total = num(f[1]), num(f[2]) or num(f[3])
+        return {"status": f[0], "downloaded": done, "total": total, "speed": num(f[4]), "eta": num(f[5]),
+                "pct": round(100.0 * done / total, 1) if done is not None and total else None}
+    m = PROGRESS_RE.match(line)
+    return {"status": "downloading", "pct": float(m.group(1))} if m else None
+
+def fmt_progress(p):
+    """Render a progress dict as the line yt-dlp itself would print."""
+    mib = lambda b: f"{b/1048576:.2f}MiB" if b else "~"
+    eta = time.strftime("%M:%S", time.gmtime(p["eta"])) if p.get("eta") is not None else "--:--"
+    pct = f"{p['pct']:5.1f}%" if p.get("pct") is not None else "  ?  %"
+    return f"[download] {pct} of {mib(p.get('total'))} at {mib(p.get('speed'))}/s ETA {eta}"
+
+class Progress:
+    """Per-attempt progress sink: feeds the job's coalesced "progress" events and
+    writes a log line only each PROGRESS_LOG_STEP percent."""
+    parse = staticmethod(parse_progress)
+    fmt   = staticmethod(fmt_progress)
+
+    def __init__(self, client_id, job, index=None, tag=""):
+        self.client_id, self.job, self.index, self.tag = client_id, job, index, tag
+        self.logged = -1; self.last = {}
+        self.first_at = self.done_at = None; self.seen = 0     # stage timing / byte counting
+        self.bytes = 0
+
+    def update(self, p):
+        self.last = p
+        if p.get("status") == "downloading" and self.first_at is None: self.first_at = time.time()
+        if p.get("status") == "finished": self.done_at = time.time()
+        got = p.get("downloaded")
+        if got is not None:
+            # a smaller count means yt-dlp moved on to the next file of a merge
+            delta = got - self.seen if got >= self.seen else got
+            if delta: metrics.inc("ytdl_downloaded_bytes_total", delta); self.bytes += delta
+            self.seen = got
+        pct = p.get("pct"); final = p.get("status") == "finished" or (pct is not None and pct >= 100)
+        step = int(pct // PROGRESS_LOG_STEP) if pct is not None else self.logged
+        if step > self.logged or (final and self.logged < 100 // PROGRESS_LOG_STEP):
+            self.logged = 100 // PROGRESS_LOG_STEP if final else step
+            push(self.client_id, self.tag + self.fmt(p))
+        self.job.report(self.index, p, force=final)
+
+class FfmpegProgress(Progress):
+    """Progress sink for ffmpeg run with `-progress pipe:1`: key=value blocks, each
+    ending in progress=continue|end. The input duration comes from ffmpeg's own
+    "Duration:" line, so percent/ETA need no separate ffprobe call."""
+    DURATION_RE = re.compile(r"^\s*Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+    KEY_RE      = re.compile(r"^[a-z_0-9]+=")
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.duration = None; self.block = {}; self.out_time = 0.0
+
+    def parse(self, line):
+        m = self.DURATION_RE.match(line)
+        if m:
+            if self.duration is None:
+                self.duration = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+            return None                      # still logged
+        if not self.KEY_RE.match(line): return None
+        k, _, v = line.partition("="); self.block[k] = v.strip()
+        if k != "progress": return {}        # swallowed, block not complete yet
+        b, self.block = self.block, {}
+        try: self.out_time = max(self.out_time, int(b.get("out_time_us") or b.get("out_time_ms") or 0) / 1e6)
+        except ValueError: pass
+        try: speed = float(b.get("speed", "").rstrip("x"))
+        except ValueError: speed = None
+        end = b["progress"] == "end"; dur = self.duration
+        return {"status": "finished" if end else "converting", "speed": speed, "total": int(b.get("total_size") or 0) or None,
+                "pct": 100.0 if end else round(min(99.9, 100.0 * self.out_time / dur), 1) if dur else None,
+                "eta": int((dur - self.out_time) / speed) if dur and speed and not end else None}
+
+    @staticmethod
+    def fmt(p):
+        eta = time.strftime("%M:%S", time.gmtime(p["eta"])) if p.get("eta") is not None else "--:--"
+        pct = f"{p['pct']:5.1f}%" if p.get("pct") is not None else "  ?  %"
+        return f"[ffmpeg] {pct} at {p['speed'] or 0:.1f}x ETA {eta}"
+
+class AttemptOutput:
+    """Bounded tail of one attempt's output; 403/429/SABR are classified line by line
+    so the whole output never has to be kept for the substring checks. Also notes
+    the format IDs yt-dlp picked and the files it started writing (for resuming)."""
+    TAIL = 200
+    DEST_RE    = re.compile(r"^\[download\] Destination: (.+)$")
+    FORMATS_RE = re.compile(r"^\[info\] \S+: Downloading \d+ format\(s\): (.+)$")
+    def __init__(self):
+        self.lines = deque(maxlen=self.TAIL)
+        self.e403 = self.e429 = self.sabr = False
+        self.formats = ""; self.dests = []
+        self.stalled = ""          # "stall" / "timeout" when the watchdog killed the attempt
+
+    def add(self, line):
+        self.lines.append(line)
+        self.e403 = self.e403 or is_403(line)
+        self.e429 = self.e429 or is_429(line)
+        self.sabr = self.sabr or is_sabr(line)
+        m = self.FORMATS_RE.match(line)
+        if m: self.formats = ",".join(f.strip() for f in m.group(1).split(","))   # "137+140" or "137,140"
+        m = self.DEST_RE.match(line)
+        if m: self.dests.append(os.path.abspath(m.group(1).strip()))
+
+    def __str__(self): return "\n".join(self.lines)
+
+def run_and_stream(args, client_id, job, tag="", progress=None, bw=None):
+    """Run a command (list of args, shell=False), stream output to SSE. Returns (ok, AttemptOutput).
+
+    The process is attached to `job` so /api/stop can terminate exactly this job's
+    children. `tag` prefixes each line when several items stream concurrently.
+    With a `progress` sink, lines its parse() recognises go there instead of the log.
+    `bw` (a bandwidth Stream) gets the process so the scheduler can restart it.
+    yt-dlp, and anything with a progress sink, is killed after STALL_SECS s of silence
+    (not once yt-dlp's own postprocessing has started — see Watch).
+    """
+    proc = w = None; out = AttemptOutput()
     try:
         # shell=False + args list: the shell never sees the arguments, so
         # special characters like < > % are passed literally to the process.
         # This is the only reliable cross-platform approach.
-        proc = subprocess.Popen(args, shell=False, stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT, text=True, bufsize=1)
-        active_process = proc
-        out_lines = []
+        proc = spawn(tool_args(args), CONVERT_NICE if args[0] == "ffmpeg" else PROC_NICE,
+                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+        metrics.inc("ytdl_process_spawns_total", tool=args[0])
+        job.attach(proc)
+        if bw: bw.handle = proc
+        w = watchdog.watch(proc, STALL_SECS if args[0] == "yt-dlp" or progress else 0)
         for raw in proc.stdout:
-            if stop_flag.is_set():
-                proc.terminate(); proc.wait(); active_process = None
-                push(client_id, f"[{ts()}] ⛔ Stopped by user.")
-                return False, "\n".join(out_lines)
+            w.touch(raw)
+            if job.stop.is_set():
+                proc.terminate(); proc.wait()
+                push(client_id, f"{tag}[{ts()}] ⛔ Stopped by user.")
+                return False, out
             line = raw.rstrip()
-            if line:
-                out_lines.append(line)
-                push(client_id, line)
-        proc.wait(); active_process = None
-        return proc.returncode == 0, "\n".join(out_lines)
+            if not line: continue
+            p = progress.parse(line) if progress else None
+            if p is not None:
+                if p: progress.update(p)
+                continue
+            out.add(line)
+            push(client_id, tag + line)
+        proc.wait()
+        if w.reason:
+            out.stalled = w.reason; out.add(w.why()); push(client_id, f"{tag}[{ts()}] ⏱ {w.why()}")
+        return proc.returncode == 0, out
     except Exception as e:
-        active_process = None
-        push(client_id, f"Exception: {e}")
-        return False, str(e)
+        push(client_id, f"{tag}Exception: {e}")
+        out.add(str(e))
+        return False, out
+    finally:
+        if w: watchdog.unwatch(w)
+        if proc: job.detach(proc)
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  IN-PROCESS ENGINE  (yt_dlp.YoutubeDL in long-lived worker processes)
+# ═══════════════════════════════════════════════════════════════════════════
+class InprocWorker:
+    """One ytdl_worker.py process; runs one task at a time."""
+    def __init__(self):
+        self.proc = spawn([sys.executable, "-u", WORKER_SCRIPT], PROC_NICE, stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE, text=True, bufsize=1)
+        metrics.inc("ytdl_process_spawns_total", tool="ytdl_worker")
+        hello = json.loads(self.proc.stdout.readline() or "{}")
+        if not hello.get("ready"):
+            self.proc.kill(); raise RuntimeError("ytdl_worker did not start (is yt-dlp installed?)")
+        self.version = hello.get("version", "")
+        self.next_id = 0
+
+    def alive(self): return self.proc.poll() is None
+
+    def send(self, **msg):
+        self.proc.stdin.write(json.dumps(msg) + "\n"); self.proc.stdin.flush()
+
+    def kill(self):
+        try: self.proc.kill()
+        except: pass
+
+class _InprocHandle:
+    """What Job.attach sees for an in-process attempt: terminate() asks the worker to cancel.
+
+    Cancels are honoured in the progress hook, which never fires during extraction,
+    so the worker is killed outright if the task is still running after a grace period.
+    """
+    GRACE = 5.0
+    def __init__(self, worker, task_id):
+        self.worker, self.task_id = worker, task_id; self.finished = threading.Event()
+    def terminate(self):
+        try: self.worker.send(cancel=self.task_id)
+        except: self.worker.kill(); return
+        threading.Timer(self.GRACE, lambda: self.finished.is_set() or self.worker.kill()).start()
+    def kill(self): self.worker.kill()
+    def set_rate(self, bps):
+        """Change the running task's rate limit in place (None = unlimited)."""
+        try: self.worker.send(ratelimit=bps, id=self.task_id)
+        except: pass
+
+class InprocPool:
+    """Up to `size` idle-or-busy workers, started lazily and reused across attempts."""
+    def __init__(self, size):
+        self.size = size; self.idle = []; self.count = 0; self.gen = 0
+        self.cond = threading.Condition(); self.error = ""
+
+    def _checkout(self):
+        with self.cond:
+            while True:
+                while self.idle:
+                    w = self.idle.pop()
+                    if w.alive(): return w
+                    self.count -= 1
+                if self.count < self.size: self.count += 1; break
+                self.cond.wait()
+        try:
+            w = InprocWorker(); w.gen = self.gen
+            return w
+        except Exception as e:
+            with self.cond: self.count -= 1; self.error = str(e); self.cond.notify()
+            return None
+
+    def _checkin(self, w):
+        with self.cond:
+            if w.alive() and w.gen == self.gen: self.idle.append(w)
+            else: w.kill(); self.count -= 1
+            self.cond.notify()
+
+    def retire(self):
+        """After a yt-dlp switch: idle workers exit now, busy ones when their task ends."""
+        with self.cond:
+            self.gen += 1; old, self.idle = self.idle, []; self.count -= len(old)
+            self.cond.notify_all()
+        for w in old: w.kill()
+
+    def run(self, args, client_id, job, tag="", progress=None, bw=None):
+        """Same contract as run_and_stream; returns None if no worker could be started."""
+        w = self._checkout()
+        if not w: return None
+        w.next_id += 1; task_id = w.next_id
+        handle = _InprocHandle(w, task_id); out = AttemptOutput()
+        job.attach(handle)
+        if bw: bw.handle = handle
+        watch = watchdog.watch(handle, STALL_SECS)
+        try:
+            w.send(id=task_id, argv=args[1:])
+            for raw in w.proc.stdout:
+                msg = json.loads(raw); watch.touch(msg.get("line", ""))
+                if msg.get("id") != task_id: continue
+                if "done" in msg:
+                    if job.stop.is_set(): push(client_id, f"{tag}[{ts()}] ⛔ Stopped by user.")
+                    return msg["done"] == 0, out
+                if "progress" in msg:
+                    if progress: progress.update(msg["progress"])
+                    continue
+                line = msg.get("line", "")
+                if line: out.add(line); push(client_id, tag + line)
+            # stdout closed without a "done" — the worker died mid-task (or the watchdog killed it)
+            if watch.reason:
+                out.stalled = watch.reason; out.add(watch.why()); push(client_id, f"{tag}[{ts()}] ⏱ {watch.why()}")
+            else: out.add("ERROR: in-process worker exited unexpectedly")
+            return False, out
+        except Exception as e:
+            w.kill(); push(client_id, f"{tag}Exception: {e}")
+            out.add(str(e))
+            return False, out
+        finally:
+            watchdog.unwatch(watch); handle.finished.set(); job.detach(handle); self._checkin(w)
+
+    def info(self):
+        with self.cond: return {"workers": self.count, "idle": len(self.idle), "size": self.size, "error": self.error}
+
+inproc_pool = InprocPool(INPROC_WORKERS)
+
+def run_ytdlp(args, client_id, job, tag="", progress=None):
+    """Run one yt-dlp attempt on the configured engine, falling back to a subprocess.
+
+    The attempt's rate limit comes from the bandwidth scheduler; a subprocess it
+    restarts to apply a new limit is simply run again (yt-dlp resumes the .part).
+    """
+    args, cap = pop_limit_rate(args)
+    with bandwidth.stream(job, cap, progress) as bw:
+        while True:
+            res = None
+            if ENGINE == "inprocess":
+                res = inproc_pool.run(args + bw.limit_args(), client_id, job, tag, progress, bw)
+                if res is None:
+                    push(client_id, f"{tag}[{ts()}] ⚠ In-process engine unavailable ({inproc_pool.error}) — using yt-dlp subprocess")
+            if res is None:
+                res = run_and_stream(args + bw.limit_args() + PROGRESS_ARGS, client_id, job, tag, progress, bw)
+            if not bw.restarting or job.stop.is_set(): return res
+            bw.restarting = False
+            push(client_id, f"{tag}[{ts()}] ↻ Bandwidth rebalanced — continuing at {fmt_rate(bw.limit)}")
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  TOOLS  (cached version probes, staged yt-dlp updates)
+# ═══════════════════════════════════════════════════════════════════════════
+class ToolProbe:
+    """`--version` of each external tool, remembered until its executable changes
+    (resolved path + mtime). Kept in `store`, so after a restart the settings
+    page still starts no process unless a tool was replaced meanwhile."""
+    def __init__(self, store):
+        self.store = store; self.lock = threading.Lock()
+        self.cache = store.get_kv("tool_probe", {})
+
+    @staticmethod
+    def _files(cmd):
+        """The resolved executable plus any script it is given (python fake_tool.py …)."""
+        exe = cmd[0] if os.path.isfile(cmd[0]) else shutil.which(cmd[0])
+        return [os.path.abspath(exe)] + [os.path.abspath(a) for a in cmd[1:] if os.path.isfile(a)] if exe else []
+
+    def probe(self, name, cmd, flag, env=None):
+        files = self._files(cmd)
+        if not files: return {"tool": name, "status": "error", "version": "NOT FOUND", "path": ""}
+        sig = [[f, os.path.getmtime(f)] for f in files] + [cmd, (env or {}).get("PYTHONPATH", "")]
+        with self.lock: hit = self.cache.get(name)
+        if hit and hit["sig"] == sig: return hit["result"]
+        try:
+            r = subprocess.run(cmd + [flag], shell=False, capture_output=True, text=True, timeout=30, env=env)
+            ver = (r.stdout or r.stderr).strip().split("\n")[0][:60]
+            result = {"tool": name, "status": "ok" if r.returncode == 0 else "error", "version": ver, "path": files[0]}
+        except (OSError, subprocess.SubprocessError) as e:
+            result = {"tool": name, "status": "error", "version": str(e)[:60], "path": files[0]}
+        with self.lock: self.cache[name] = {"sig": sig, "result": result}; snapshot = dict(self.cache)
+        self.store.put_kv("tool_probe", snapshot)
+        return result
+
+    def forget(self, name):
+        with self.lock: self.cache.pop(name, None)
+
+tools = ToolProbe(store)
+
+def _vkey(v):
+    """'2025.01.15' and PyPI's normalised '2025.1.15' compare equal."""
+    return tuple(int(x) for x in re.findall(r"\d+", v or ""))
+
+class Updater:
+    """Keeps yt-dlp current without touching the installed package: newer releases
+    are pip-installed into UPDATE_DIR/<version> and switched to between jobs
+    (tool_args / tool_env then run `python -m yt_dlp` from there)."""
+    PYPI = "https://pypi.org/pypi/yt-dlp/json"
+
+    def __init__(self, store, root):
+        self.store, self.root = store, root; self.lock = threading.Lock(); self.busy = False
+        st = self._state() if self.enabled() else {}
+        self.active = st.get("active") if st.get("active") and os.path.isdir(st["active"]) else None
+        self.staged = st.get("staged") if st.get("staged") and os.path.isdir(st["staged"]) else None
+
+    @staticmethod
+    def enabled(): return YTDLP_CMD == ["yt-dlp"]
+
+    def _state(self): return self.store.get_kv("ytdlp_update", {})
+    def _save(self, **kw): self.store.put_kv("ytdlp_update", dict(self._state(), **kw))
+
+    def version(self):
+        """Version in use: the active staged release, else whatever `yt-dlp` resolves to."""
+        if self.active: return os.path.basename(self.active)
+        return tools.probe("yt-dlp", tool_args(["yt-dlp"]), "--version").get("version", "")
+
+    def check(self, say=print, force=False):
+        """Ask PyPI for the latest release (unless checked within UPDATE_INTERVAL) and
+        stage it if it is newer. Returns the staged folder or None."""
+        if not force and time.time() - self._state().get("checked", 0) < UPDATE_INTERVAL: return None
+        with self.lock:
+            if self.busy: return None
+            self.busy = True
+        try:
+            with urlopen(self.PYPI, timeout=15) as r: latest = json.loads(r.read())["info"]["version"]
+            self._save(checked=time.time(), latest=latest, error="")
+            current = os.path.basename(self.staged) if self.staged else self.version()
+            if _vkey(latest) <= _vkey(current):
+                say(f"[{ts()}] yt-dlp {current} is up to date"); return None
+            say(f"[{ts()}] Installing yt-dlp {latest} (in use: {current or 'unknown'})…")
+            dst = os.path.join(self.root, latest); tmp = f"{dst}.tmp{os.getpid()}"
+            shutil.rmtree(tmp, ignore_errors=True)
+            r = subprocess.run([sys.executable, "-m", "pip", "install", "--disable-pip-version-check", "--no-deps",
+                                "--target", tmp, f"yt-dlp=={latest}"], capture_output=True, text=True, timeout=600)
+            if r.returncode != 0: raise RuntimeError(((r.stderr or r.stdout).strip().splitlines() or ["pip failed"])[-1])
+            if os.path.isdir(dst): shutil.rmtree(tmp, ignore_errors=True)
+            else: os.replace(tmp, dst)            # appears complete or not at all
+            with self.lock: self.staged = dst
+            self._save(staged=dst)
+            say(f"[{ts()}] yt-dlp {latest} ready — used from the next job on")
+            return dst
+        except Exception as e:
+            self._save(checked=time.time(), error=str(e))
+            say(f"[{ts()}] yt-dlp update failed: {e}"); return None
+        finally:
+            with self.lock: self.busy = False
+
+    def swap_if_idle(self):
+        """Switch to the staged release if nothing is running. The scheduler calls this
+        before starting jobs, so a download never sees yt-dlp change under it."""
+        if not self.staged or self.staged == self.active: return False
+        with jobs_lock: busy = bool(jobs)
+        with fetches_lock: busy = busy or bool(fetches) or bool(estimates)
+        if busy: return False
+        with self.lock: prev, self.active, self.staged = self.active, self.staged, None
+        self._save(active=self.active, staged=None)
+        inproc_pool.retire(); tools.forget("yt-dlp")
+        print(f"[update] switched to yt-dlp {os.path.basename(self.active)}")
+        # keep the previous release for a manual rollback, drop older ones
+        for d in os.listdir(self.root):
+            path = os.path.join(self.root, d)
+            if path not in (self.active, prev): shutil.rmtree(path, ignore_errors=True)
+        return True
+
+    def _loop(self):
+        time.sleep(UPDATE_DELAY)
+        while True:
+            with jobs_lock: idle = not jobs
+            if idle: self.check()
+            time.sleep(300)
+
+    def start(self):
+        if self.enabled() and UPDATE_INTERVAL > 0:
+            os.makedirs(self.root, exist_ok=True)
+            threading.Thread(target=self._loop, daemon=True, name="updater").start()
+
+    def info(self):
+        return dict(self._state(), enabled=self.enabled(), interval=UPDATE_INTERVAL, version=self.version(),
+                    active=self.active, staged=self.staged)
+
+updater = Updater(store, UPDATE_DIR)
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  BANDWIDTH SCHEDULER  (one budget for all downloads, split by weight)
+# ═══════════════════════════════════════════════════════════════════════════
+# Every running yt-dlp attempt is a Stream. Each BW_TICK, and whenever one starts
+# or ends, the budget in force (base or the time-of-day window) is split:
+#   1. between jobs by weight 2^priority, capped by the job's own speed limit
+#   2. inside a job evenly between its parallel items
+# Streams that leave their share unused (slower than 60% of it) are held at
+# what they use and the rest goes to the others. In-process attempts get the
+# new limit live; subprocess attempts are restarted, at most every BW_RESTART_MIN.
+BW_MIN = 50 * 1024          # never throttle a stream below this
+
+def parse_rate(v):
+    """'2M', '500K', '1.5MB/s', 1048576 → bytes/s; 0 / '' / 'No limit' → None."""
+    if v in (None, "", 0, "0") or str(v).strip().lower() in ("no limit", "none", "unlimited"): return None
+    m = re.fullmatch(r"\s*([\d.]+)\s*([KMG]?)(?:i?B)?(?:/s)?\s*", str(v), re.I)
+    if not m: raise ValueError(f"bad rate {v!r}")
+    return int(float(m.group(1)) * {"": 1, "K": 1024, "M": 1048576, "G": 1073741824}[m.group(2).upper()]) or None
+
+def fmt_rate(bps):
+    return "unlimited" if bps is None else f"{bps/1048576:.2f}MiB/s" if bps >= 1048576 else f"{bps/1024:.0f}KiB/s"
+
+def pop_limit_rate(args):
+    """Strip a per-job --limit-rate from args; returns (args, cap bytes/s or None)."""
+    if "--limit-rate" not in args: return args, None
+    i = args.index("--limit-rate")
+    try: cap = parse_rate(args[i+1])
+    except (ValueError, IndexError): cap = None
+    return args[:i] + args[i+2:], cap
+
+def _waterfill(total, entries):
+    """Split `total` over {key: (weight, cap)} in proportion to weight, never above cap;
+    what capped entries leave over goes to the rest. total/caps of None = unlimited."""
+    out = {}; left = dict(entries)
+    while left:
+        if total is None:
+            out.update({k: cap for k, (_, cap) in left.items()}); break
+        wsum = sum(w for w, _ in left.values())
+        capped = {k: cap for k, (w, cap) in left.items() if cap is not None and cap <= total * w / wsum}
+        if not capped:
+            out.update({k: total * w / wsum for k, (w, _) in left.items()}); break
+        for k, cap in capped.items(): out[k] = cap; total -= cap; del left[k]
+        total = max(total, 0)
+    return out
+
+class Stream:
+    def __init__(self, sched, job, cap, progress):
+        self.sched, self.job, self.cap, self.progress = sched, job, cap, progress
+        self.weight = 1.0; self.limit = None; self.handle = None
+        self.restarting = False; self.since = time.time(); self.bytes_seen = 0
+
+    def limit_args(self):
+        return ["--limit-rate", str(int(self.limit))] if self.limit else []
+
+    def speed(self):
+        p = self.progress.last if self.progress else {}
+        return (p.get("speed") or 0) if p.get("status") == "downloading" else 0
+
+    def __enter__(self):
+        row = store.get(self.job.id); prio = row["priority"] if row else 0
+        self.weight = 2.0 ** max(-3, min(3, prio))
+        self.sched.add(self); return self
+
+    def __exit__(self, *exc): self.sched.remove(self)
+
+class BandwidthScheduler:
+    def __init__(self):
+        self.streams = set(); self.lock = threading.Lock(); self.wake = threading.Event()
+        self.budget = parse_rate(BANDWIDTH); self.schedule = []
+        self.bytes_total = 0; self.rate_ewma = 0.0
+
+    def configure(self, limit=None, schedule=None):
+        """limit: base budget ("0" = unlimited); schedule: [{"from": "HH:MM", "to": "HH:MM", "limit": "2M"}]."""
+        if limit is not None: self.budget = parse_rate(limit)
+        if schedule is not None:
+            for w in schedule:
+                parse_rate(w.get("limit")); [datetime.strptime(w[k], "%H:%M") for k in ("from", "to")]
+            self.schedule = list(schedule)
+        self.wake.set()
+
+    def budget_now(self, now=None):
+        """The budget in force: the first schedule window containing now (wraps midnight), else the base."""
+        hm = (now or datetime.now()).strftime("%H:%M")
+        for w in self.schedule:
+            a, b = w["from"], w["to"]
+            if (a <= hm < b) if a <= b else (hm >= a or hm < b): return parse_rate(w.get("limit"))
+        return self.budget
+
+    def stream(self, job, cap, progress): return Stream(self, job, cap, progress)
+
+    def add(self, st):
+        with self.lock: self.streams.add(st); self._rebalance(initial=st)
+
+    def remove(self, st):
+        with self.lock: self.streams.discard(st); self._rebalance()
+
+    def _rebalance(self, initial=None):
+        """Recompute limits (caller holds self.lock) and apply the ones that changed."""
+        budget = self.budget_now(); now = time.time()
+        by_job = {}
+        for st in self.streams: by_job.setdefault(st.job.id, []).append(st)
+        def demand(st):
+            # a stream running well under its limit for a while only needs a bit more than it uses
+            sp = st.speed()
+            return max(BW_MIN, sp * 1.25) if st.limit and now - st.since > 2 * BW_TICK and sp < 0.6 * st.limit else None
+        def need(group):
+            ds = [demand(st) for st in group]
+            return None if None in ds else sum(ds)
+        job_caps = {}
+        for jid, group in by_job.items():
+            caps = [c for c in (group[0].cap, need(group)) if c is not None]
+            job_caps[jid] = (max(st.weight for st in group), min(caps) if caps else None)
+        job_alloc = _waterfill(budget, job_caps)
+        for jid, group in by_job.items():
+            alloc = _waterfill(job_alloc[jid], {st: (1.0, demand(st)) for st in group})
+            for st, lim in alloc.items():
+                lim = None if lim is None else max(BW_MIN, int(lim))
+                if st is initial or st.handle is None: st.limit = lim; st.since = now; continue
+                if lim == st.limit: continue
+                if hasattr(st.handle, "set_rate"):
+                    st.limit = lim; st.since = now; st.handle.set_rate(lim)
+                elif now - st.since >= BW_RESTART_MIN and (st.limit is None or lim is None or abs(lim - st.limit) > 0.3 * st.limit) \
+                        and st.progress and st.progress.last.get("status") == "downloading":
+                    st.limit = lim; st.since = now; st.restarting = True
+                    try: st.handle.terminate()
+                    except Exception: pass
+
+    def _loop(self):
+        last = time.time()
+        while True:
+            self.wake.wait(BW_TICK); self.wake.clear()
+            with self.lock:
+                now = time.time(); agg = 0
+                for st in self.streams:
+                    agg += st.speed()
+                    got = (st.progress.last.get("downloaded") or 0) if st.progress else 0
+                    if got > st.bytes_seen: self.bytes_total += got - st.bytes_seen
+                    st.bytes_seen = got
+                a = min(1.0, (now - last) / 30); self.rate_ewma += a * (agg - self.rate_ewma); last = now
+                self._rebalance()
+
+    def start(self):
+        threading.Thread(target=self._loop, daemon=True, name="bandwidth").start()
+
+    def state(self):
+        with self.lock:
+            streams = [{"job": st.job.id, "index": st.progress.index if st.progress else None, "weight": st.weight,
+                        "limit": st.limit, "cap": st.cap, "speed": st.speed(),
+                        "engine": "inprocess" if hasattr(st.handle, "set_rate") else "subprocess" if st.handle else None} for st in self.streams]
+        return {"budget": self.budget, "budget_now": self.budget_now(), "schedule": self.schedule,
+                "aggregate_bps": sum(s["speed"] for s in streams), "aggregate_bps_30s": round(self.rate_ewma),
+                "bytes_total": self.bytes_total, "streams": streams}
+
+bandwidth = BandwidthScheduler()
 
 # ── Format map — plain strings, no shell escaping needed (shell=False) ──────
 # Format strings — prefer H.264 (avc1) + AAC for maximum compatibility with
@@ -169,15 +1413,511 @@ def fmt_fallback_list(args):
             result[i] = "best"
     return result
 
-def smart_download(base_args, cookie_args, extra_args, out_dir, client_id):
+# ═══════════════════════════════════════════════════════════════════════════
+#  EXTRACTION CACHE  (playlist listings + per-video info JSON on disk)
+# ═══════════════════════════════════════════════════════════════════════════
+class DiskCache:
+    """Files under root/<namespace>/. Freshness is by mtime (write time); eviction
+    past max_bytes drops least-recently-used first, tracked through atime which
+    get()/touch() set explicitly so noatime mounts don't matter."""
+    def __init__(self, root, max_bytes):
+        self.root = root; self.max_bytes = max_bytes
+        self.lock = threading.Lock(); self.size = None
+        self.hits = 0; self.misses = 0
+
+    def path(self, ns, key, suffix=""):
+        d = os.path.join(self.root, ns); os.makedirs(d, exist_ok=True)
+        return os.path.join(d, hashlib.sha1(key.encode()).hexdigest()[:24] + suffix)
+
+    def fresh(self, path, ttl):
+        try: st = os.stat(path)
+        except OSError:
+            self.misses += 1; return False
+        if time.time() - st.st_mtime > ttl:
+            self.misses += 1; return False
+        self.hits += 1; self.touch(path)
+        return True
+
+    def touch(self, path):
+        try: os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError: pass
+
+    def get_json(self, ns, key, ttl):
+        p = self.path(ns, key, ".json")
+        if not self.fresh(p, ttl): return None
+        try:
+            with open(p, encoding="utf-8") as f: return json.load(f)
+        except (OSError, ValueError): return None
+
+    def put_json(self, ns, key, value):
+        p = self.path(ns, key, ".json"); tmp = p + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f: json.dump(value, f)
+        os.replace(tmp, p)
+        self.added(p)
+
+    def added(self, path):
+        """Account for a file written into the cache (by us or by yt-dlp) and evict if over budget."""
+        try: n = os.path.getsize(path)
+        except OSError: return
+        with self.lock:
+            if self.size is None: self.size = sum(f[2] for f in self._files())
+            else: self.size += n
+            if self.size > self.max_bytes: self._evict()
+
+    def drop(self, path):
+        try: os.remove(path)
+        except OSError: pass
+
+    def _files(self):
+        out = []
+        for dirpath, _, names in os.walk(self.root):
+            for n in names:
+                p = os.path.join(dirpath, n)
+                try: st = os.stat(p)
+                except OSError: continue
+                out.append((st.st_atime, p, st.st_size))
+        return out
+
+    def _evict(self):
+        files = sorted(self._files()); total = sum(f[2] for f in files)
+        target = self.max_bytes * 0.8           # leave headroom so we don't evict on every write
+        for _, p, n in files:
+            if total <= target: break
+            self.drop(p); total -= n
+        self.size = total
+
+    def clear(self, ns=""):
+        with self.lock:
+            for _, p, _ in self._files():
+                if not ns or os.path.dirname(p) == os.path.join(self.root, ns): self.drop(p)
+            self.size = None
+
+    def stats(self):
+        with self.lock: files = self._files()
+        by_ns = {}
+        for _, p, n in files:
+            ns = os.path.basename(os.path.dirname(p)); e = by_ns.setdefault(ns, {"files": 0, "bytes": 0})
+            e["files"] += 1; e["bytes"] += n
+        return {"namespaces": by_ns, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+cache = DiskCache(CACHE_DIR, int(CACHE_MAX_MB * 1048576))
+
+# Flags that change what extraction returns. Stream URLs are tied to the client,
+# the cookies and the source IP, so each combination gets its own info JSON.
+INFO_KEY_FLAGS = ("--extractor-args", "--cookies", "--cookies-from-browser", "--force-ipv4")
+
+def info_cache_args(args, url):
+    """Return (args, info_path, loaded): args rewritten to --load-info-json when a fresh
+    info JSON exists for this url+extraction flags, else with --write-info-json into the cache."""
+    key = [url] + [a for i, a in enumerate(args)
+                   if a in INFO_KEY_FLAGS or (i and args[i-1] in INFO_KEY_FLAGS[:3])]
+    info = cache.path("info", "\0".join(key), ".info.json")
+    if cache.fresh(info, INFO_TTL):
+        return [a for a in args if a != url] + ["--load-info-json", info], info, True
+    return args + ["--write-info-json", "-o", "infojson:" + info[:-len(".info.json")]], info, False
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  STRATEGY LEARNING  (reorder smart_download's chain per host)
+# ═══════════════════════════════════════════════════════════════════════════
+def host_key(url):
+    """youtube.com for www./m./music.youtube.com and youtu.be; bare hostname otherwise."""
+    host = (urlparse(url).hostname or "").lower()
+    for p in ("www.", "m.", "music."):
+        if host.startswith(p): host = host[len(p):]
+    return "youtube.com" if host == "youtu.be" else host or "unknown"
+
+class StrategyStats:
+    """Time-decayed success/failure counts per (host, strategy label), kept in `store`.
+
+    Only failures that are the strategy's fault (403 / SABR) are recorded — a
+    private or removed video fails every strategy and says nothing about order.
+    """
+    def __init__(self, store, half_life):
+        self.store = store; self.half_life = half_life
+        store.x("""CREATE TABLE IF NOT EXISTS strategy_stats (
+                       host TEXT, label TEXT, succ REAL, fail REAL, secs REAL, attempts INTEGER,
+                       updated REAL, PRIMARY KEY (host, label))""")
+
+    def _decay(self, row, now):
+        f = 0.5 ** ((now - row["updated"]) / self.half_life) if self.half_life > 0 else 1.0
+        return row["succ"] * f, row["fail"] * f
+
+    def rows(self, host):
+        now = time.time(); out = {}
+        for r in self.store.q("SELECT * FROM strategy_stats WHERE host=?", (host,)):
+            succ, fail = self._decay(r, now)
+            out[r["label"]] = {"succ": succ, "fail": fail, "attempts": r["attempts"],
+                               "mean_secs": r["secs"] / r["attempts"] if r["attempts"] else 0.0}
+        return out
+
+    def record(self, host, label, ok, secs):
+        now = time.time()
+        with self.store.lock:
+            r = self.store.db.execute("SELECT * FROM strategy_stats WHERE host=? AND label=?", (host, label)).fetchone()
+            succ, fail = self._decay(dict(r), now) if r else (0.0, 0.0)
+            secs_sum = (r["secs"] if r else 0.0) + secs; attempts = (r["attempts"] if r else 0) + 1
+            self.store.db.execute("INSERT OR REPLACE INTO strategy_stats VALUES (?,?,?,?,?,?,?)",
+                                  (host, label, succ + ok, fail + (not ok), secs_sum, attempts, now))
+
+    def order(self, host, strategies):
+        """Sort by smoothed success rate (unknowns at the 50% prior keep their place); drop dead ones."""
+        stats = self.rows(host)
+        def score(item):
+            st = stats.get(item[1][0])
+            return -((st["succ"] + 1) / (st["succ"] + st["fail"] + 2)) if st else -0.5
+        keep = [s for s in strategies
+                if not (s[0] in stats and stats[s[0]]["succ"] < 0.5 and stats[s[0]]["fail"] >= STRATEGY_PRUNE_FAILS)]
+        if not keep: keep = list(strategies)
+        return [s for _, s in sorted(enumerate(keep), key=lambda item: (score(item), item[0]))]
+
+    def summary(self):
+        hosts = [r["host"] for r in self.store.q("SELECT DISTINCT host FROM strategy_stats ORDER BY host")]
+        out = {}
+        for h in hosts:
+            rows = self.rows(h)
+            out[h] = sorted(({"label": k, "success": round(v["succ"], 2), "fail": round(v["fail"], 2),
+                              "rate": round((v["succ"] + 1) / (v["succ"] + v["fail"] + 2), 3),
+                              "attempts": v["attempts"], "mean_secs": round(v["mean_secs"], 2)}
+                             for k, v in rows.items()), key=lambda r: -r["rate"])
+        return out
+
+strategy_stats = StrategyStats(store, STRATEGY_HALF_LIFE)
+# Process-lifetime counters for spawns-per-success
+spawn_counts = {"spawns": 0, "successes": 0}
+spawn_lock   = threading.Lock()
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  RATE GOVERNOR  (one request budget and 429 backoff per host, for all jobs)
+# ═══════════════════════════════════════════════════════════════════════════
+# Every yt-dlp launch (download attempt or playlist listing) takes a token from
+# its host's bucket. A 429 halves the refill rate and starts a jittered,
+# exponentially growing cool-down during which no job starts anything on that
+# host; successes restore the rate and step the backoff level back down.
+class _Bucket:
+    def __init__(self):
+        self.rate = EXTRACT_PER_MIN; self.tokens = EXTRACT_BURST; self.stamp = time.time()
+        self.level = 0; self.cooldown_until = 0.0; self.last_429 = 0.0
+        self.total_429 = 0; self.waiting = 0
+
+    def refill(self, now):
+        self.tokens = min(EXTRACT_BURST, self.tokens + (now - self.stamp) * self.rate / 60); self.stamp = now
+
+class RateGovernor:
+    def __init__(self):
+        self.buckets: dict[str, _Bucket] = {}; self.lock = threading.Lock()
+
+    def _bucket(self, host):
+        b = self.buckets.get(host)
+        if not b: b = self.buckets[host] = _Bucket()
+        return b
+
+    def acquire(self, host, stop, say=None):
+        """Block until `host` is out of cool-down and has a token. False if `stop` was set meanwhile."""
+        told = False
+        with self.lock: self._bucket(host).waiting += 1
+        try:
+            while True:
+                with self.lock:
+                    b = self._bucket(host); now = time.time(); b.refill(now)
+                    wait = b.cooldown_until - now
+                    if wait <= 0:
+                        if b.tokens >= 1: b.tokens -= 1; return True
+                        wait = (1 - b.tokens) * 60 / b.rate
+                    cooling = b.cooldown_until > now
+                if say and not told and wait >= 2:
+                    say(f"[{ts()}] ⏳ {host}: {'cooling down after 429' if cooling else 'request budget used up'} — "
+                        f"next start in {wait:.0f}s"); told = True
+                if stop.wait(min(wait, 5)): return False
+        finally:
+            with self.lock: self._bucket(host).waiting -= 1
+
+    def penalize(self, host):
+        """Record a 429. Returns the cool-down in seconds (a 429 inside a running cool-down,
+        e.g. from another job's attempt that started before it, does not escalate)."""
+        with self.lock:
+            b = self._bucket(host); now = time.time()
+            b.total_429 += 1; b.last_429 = now
+            if now < b.cooldown_until: return b.cooldown_until - now
+            b.level += 1; b.rate = max(1.0, b.rate / 2); b.tokens = 0
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (b.level - 1))
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            b.cooldown_until = now + delay
+            return delay
+
+    def succeeded(self, host):
+        with self.lock:
+            b = self._bucket(host)
+            b.level = max(0, b.level - 1); b.rate = min(EXTRACT_PER_MIN, b.rate + EXTRACT_PER_MIN / 10)
+
+    def extra_args(self, host):
+        """While backing off, also space out yt-dlp's own requests within one run."""
+        with self.lock: level = self.buckets[host].level if host in self.buckets else 0
+        return ["--sleep-requests", str(min(10, level))] if level else []
+
+    def state(self):
+        now = time.time()
+        with self.lock:
+            out = {}
+            for host, b in self.buckets.items():
+                b.refill(now)
+                out[host] = {"rate_per_min": round(b.rate, 2), "tokens": round(b.tokens, 2), "burst": EXTRACT_BURST,
+                             "backoff_level": b.level, "cooldown_secs": round(max(0.0, b.cooldown_until - now), 1),
+                             "total_429": b.total_429, "last_429": b.last_429 or None, "waiting": b.waiting}
+            return out
+
+    def reset(self, host=""):
+        with self.lock:
+            if host: self.buckets.pop(host, None)
+            else: self.buckets.clear()
+
+governor = RateGovernor()
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  DOWNLOAD ARCHIVE  (what has been downloaded, across sessions and playlists)
+# ═══════════════════════════════════════════════════════════════════════════
+# Keyed like yt-dlp's --download-archive ("<extractor> <id>") plus the mode, so
+# an mp3 of a video does not count as having the video. Entries imported from a
+# yt-dlp archive file have mode "" and match both.
+ARCHIVE_PRINT = "after_move:%(extractor_key)s|%(id)s|%(format_id)s|%(filepath)s"
+ARCHIVE_ID_RE = re.compile(r"\[([0-9A-Za-z_-]{11})\]\.[0-9A-Za-z]+$")
+AUDIO_EXTS    = {".mp3",".m4a",".aac",".opus",".ogg",".flac",".wav"}
+VIDEO_EXTS    = {".mp4",".mkv",".webm",".mov",".avi",".flv",".m4v",".ts"}   # thumbnails, subtitles etc. aren't downloads
+
+def archive_key(url):
+    """("youtube", id) for YouTube video URLs, else None — other sites are matched by URL."""
+    if host_key(url) != "youtube.com": return None
+    u = urlparse(url)
+    if u.hostname and u.hostname.endswith("youtu.be"): vid = u.path.strip("/").split("/")[0]
+    else:
+        vid = parse_qs(u.query).get("v", [""])[0]
+        parts = u.path.strip("/").split("/")
+        if not vid and len(parts) == 2 and parts[0] in ("shorts", "live", "embed", "v"): vid = parts[1]
+    return ("youtube", vid) if re.fullmatch(r"[0-9A-Za-z_-]{11}", vid or "") else None
+
+class Archive:
+    """Persistent index of finished downloads, kept in `store` next to the job queue."""
+    def __init__(self, store):
+        self.store = store
+        store.x("""CREATE TABLE IF NOT EXISTS archive (
+                       extractor TEXT, video_id TEXT, mode TEXT, url TEXT, path TEXT, format TEXT,
+                       size INTEGER, added REAL, PRIMARY KEY (extractor, video_id, mode))""")
+        store.x("CREATE INDEX IF NOT EXISTS archive_url ON archive (url)")
+
+    def lookup(self, url, mode):
+        """The archive row for this URL+mode whose file still exists (or that has no path), else None.
+        One indexed query and at most one stat — cheap enough to run before every launch."""
+        key = archive_key(url)
+        if key: rows = self.store.q("SELECT * FROM archive WHERE extractor=? AND video_id=? AND mode IN (?,'')", (*key, mode))
+        else:   rows = self.store.q("SELECT * FROM archive WHERE url=? AND mode IN (?,'')", (url, mode))
+        for r in rows:
+            if not r["path"] or os.path.isfile(r["path"]): return r
+        return None
+
+    def record_from(self, print_file, url, mode):
+        """Add the downloads yt-dlp listed via --print-to-file ARCHIVE_PRINT. Returns how many."""
+        try:
+            with open(print_file, encoding="utf-8") as f: lines = [l.rstrip("\n") for l in f if l.strip()]
+        except OSError: return 0
+        for line in lines:
+            ie, vid, fmt, path = (line.split("|", 3) + ["", "", ""])[:4]
+            size = os.path.getsize(path) if path and os.path.isfile(path) else None
+            self.store.x("INSERT OR REPLACE INTO archive VALUES (?,?,?,?,?,?,?,?)",
+                         (ie.lower(), vid, mode, url, path, fmt, size, time.time()))
+        return len(lines)
+
+    def put(self, row):
+        """Add an entry made outside record_from (a cluster worker's, the postprocess pipeline's);
+        its path is kept only if this host sees the file."""
+        path = row.get("path") or ""
+        if path and not os.path.isfile(path): path = ""
+        self.store.x("INSERT OR REPLACE INTO archive VALUES (?,?,?,?,?,?,?,?)",
+                     (row["extractor"], row["video_id"], row["mode"], row["url"], path, row.get("format") or "",
+                      row.get("size"), time.time()))
+
+    def export_lines(self):
+        """yt-dlp --download-archive format: one "<extractor> <id>" per line."""
+        return [f"{r['extractor']} {r['video_id']}" for r in self.store.q(
+            "SELECT DISTINCT extractor, video_id FROM archive ORDER BY added")]
+
+    def import_lines(self, lines):
+        n = 0
+        for line in lines:
+            parts = line.split()
+            if len(parts) != 2: continue
+            self.store.x("INSERT OR IGNORE INTO archive VALUES (?,?,?,?,?,?,?,?)",
+                         (parts[0].lower(), parts[1], "", "", "", "", None, time.time())); n += 1
+        return n
+
+    def reconcile(self, out_dir):
+        """Check the archive against the files in out_dir (recursively).
+
+        · entries whose file is gone are removed; sizes are refreshed
+        · "... [<id>].<ext>" files (yt-dlp's default name) fill in path-less
+          imported entries, or are added when the archive does not know them
+        """
+        out = {"removed": 0, "updated": 0, "filled": 0, "added": 0}
+        root = os.path.abspath(out_dir)
+        for r in self.store.q("SELECT * FROM archive WHERE path != ''"):
+            if not os.path.abspath(r["path"]).startswith(root + os.sep): continue
+            key = (r["extractor"], r["video_id"], r["mode"])
+            if not os.path.isfile(r["path"]):
+                self.store.x("DELETE FROM archive WHERE extractor=? AND video_id=? AND mode=?", key); out["removed"] += 1
+            elif os.path.getsize(r["path"]) != r["size"]:
+                self.store.x("UPDATE archive SET size=? WHERE extractor=? AND video_id=? AND mode=?",
+                             (os.path.getsize(r["path"]), *key)); out["updated"] += 1
+        for dirpath, _, files in os.walk(root):
+            for name in files:
+                m = ARCHIVE_ID_RE.search(name); ext = os.path.splitext(name)[1].lower()
+                if not m or ext not in AUDIO_EXTS | VIDEO_EXTS: continue
+                path = os.path.join(dirpath, name); vid = m.group(1)
+                mode = "audio" if ext in AUDIO_EXTS else "video"
+                known = self.store.q("SELECT * FROM archive WHERE extractor='youtube' AND video_id=?", (vid,))
+                if any(r["path"] == path for r in known): continue
+                blank = [r for r in known if not r["path"]]
+                if blank:
+                    self.store.x("UPDATE archive SET path=?, size=?, url=? WHERE extractor='youtube' AND video_id=? AND mode=''",
+                                 (path, os.path.getsize(path), f"https://www.youtube.com/watch?v={vid}", vid)); out["filled"] += 1
+                elif not any(r["mode"] == mode for r in known):
+                    self.store.x("INSERT INTO archive VALUES (?,?,?,?,?,?,?,?)",
+                                 ("youtube", vid, mode, f"https://www.youtube.com/watch?v={vid}", path, "",
+                                  os.path.getsize(path), time.time())); out["added"] += 1
+        return out
+
+    def stats(self):
+        return {r["mode"] or "imported": r["n"] for r in self.store.q("SELECT mode, COUNT(*) AS n FROM archive GROUP BY mode")}
+
+archive = Archive(store)
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  RESUMABLE PARTIALS  (keep .part files across strategy switches and restarts)
+# ═══════════════════════════════════════════════════════════════════════════
+# yt-dlp resumes a .part file by itself (--continue) when the next run writes the
+# same file name — which for separate video/audio streams embeds the format ID
+# ("Title [id].f137.mp4.part"). So after an unfinished attempt the partials and
+# the format IDs that produced them are recorded, and later attempts for that
+# URL put those IDs first in their -f selector. Partials of cancelled jobs go at
+# once; those of finished jobs after PARTIAL_TTL.
+class Partials:
+    def __init__(self, store):
+        self.store = store
+        store.x("""CREATE TABLE IF NOT EXISTS partials (
+                       path TEXT PRIMARY KEY, job_id TEXT, url TEXT, format TEXT, size INTEGER, updated REAL)""")
+        store.x("CREATE INDEX IF NOT EXISTS partials_url ON partials (url)")
+
+    @staticmethod
+    def files(dest):
+        """The .part / .part-FragN / .ytdl files belonging to one destination."""
+        return [f for f in glob.glob(glob.escape(dest) + ".part*") + [dest + ".ytdl"] if os.path.isfile(f)]
+
+    def _drop(self, rows):
+        freed = 0
+        for r in rows:
+            for f in self.files(r["path"]):
+                try: freed += os.path.getsize(f); os.remove(f)
+                except OSError: pass
+            self.store.x("DELETE FROM partials WHERE path=?", (r["path"],))
+        return freed
+
+    def record(self, job_id, url, out):
+        """Remember what an unfinished attempt left on disk. Returns the bytes kept."""
+        kept = 0
+        for dest in dict.fromkeys(out.dests):
+            size = sum(os.path.getsize(f) for f in self.files(dest))
+            if not size: continue
+            self.store.x("INSERT OR REPLACE INTO partials VALUES (?,?,?,?,?,?)",
+                         (dest, job_id, url, out.formats, size, time.time()))
+            kept += size
+        return kept
+
+    def resume_format(self, url):
+        """(format IDs, bytes on disk) of the largest set of partials for url, or ("", 0)."""
+        by_fmt = {}
+        for r in self.store.q("SELECT * FROM partials WHERE url=?", (url,)):
+            size = sum(os.path.getsize(f) for f in self.files(r["path"]))
+            if not size: self.store.x("DELETE FROM partials WHERE path=?", (r["path"],)); continue
+            if r["format"]: by_fmt[r["format"]] = by_fmt.get(r["format"], 0) + size
+        return max(by_fmt.items(), key=lambda kv: kv[1]) if by_fmt else ("", 0)
+
+    def finished(self, url):
+        """After a success: whatever is still partial for url (other formats) is garbage."""
+        return self._drop(self.store.q("SELECT * FROM partials WHERE url=?", (url,)))
+
+    def settle(self, job_id):
+        """When a job ends: a cancelled job's partials are deleted now, others age out."""
+        row = self.store.get(job_id)
+        if row and row["state"] == "cancelled":
+            self._drop(self.store.q("SELECT * FROM partials WHERE job_id=?", (job_id,)))
+
+    def cleanup(self, max_age=PARTIAL_TTL, out_dir=""):
+        """Delete tracked partials of jobs that are over and older than max_age; with
+        out_dir, also untracked .part/.ytdl files there older than max_age."""
+        cutoff = time.time() - max_age
+        rows = self.store.q("SELECT * FROM partials WHERE updated < ? AND job_id NOT IN "
+                            "(SELECT id FROM jobs WHERE state IN (?,?,?))", (cutoff, *ACTIVE_STATES))
+        out = {"removed": len(rows), "freed": self._drop(rows)}
+        if out_dir:
+            tracked = {r["path"] for r in self.store.q("SELECT path FROM partials")}
+            for f in glob.glob(os.path.join(glob.escape(os.path.abspath(out_dir)), "**", "*"), recursive=True):
+                dest = re.sub(r"(\.part(-Frag\d+)?(\.part)?|\.ytdl)$", "", f)
+                if dest == f or dest in tracked or not os.path.isfile(f) or os.path.getmtime(f) > cutoff: continue
+                try: out["freed"] += os.path.getsize(f); os.remove(f); out["removed"] += 1
+                except OSError: pass
+        return out
+
+    def summary(self):
+        return self.store.q("SELECT path, job_id, url, format, size, updated FROM partials ORDER BY updated DESC")
+
+partials = Partials(store)
+
+def prefer_format(args, fmt):
+    """Put `fmt` in front of the -f selector so yt-dlp picks it when still offered.
+    Raw-stream selectors ("V,A") get one ID per part, merging ones the joined IDs."""
+    if "-f" not in args: return args
+    i = args.index("-f") + 1; out = list(args)
+    parts = out[i].split(","); ids = fmt.replace("+", ",").split(",")
+    if len(parts) == 1: ids = ["+".join(ids)]
+    if len(ids) == len(parts):
+        out[i] = ",".join(p if p.startswith(x + "/") else f"{x}/{p}" for x, p in zip(ids, parts))
+    return out
+
+def download_mode(base_args): return "audio" if "--extract-audio" in base_args else "video"
+
+def _archived(url, mode, client_id, tag):
+    hit = archive.lookup(url, mode)
+    if hit: push(client_id, f"{tag}[{ts()}] ⏭ Already downloaded{': ' + hit['path'] if hit['path'] else ' (archive)'}")
+    return bool(hit)
+
+def smart_download(base_args, cookie_args, extra_args, out_dir, client_id, job, tag="", index=None, then=None,
+                   skip_done=True):
     """
     base_args : list — e.g. ["yt-dlp","--no-playlist","-f","bv*[height<=1080]+ba/best[height<=1080]","--merge-output-format","mp4","--newline",url]
     cookie_args: list — from build_cookie_args()
     extra_args : list — from build_extra_args()
+    job        : Job  — stop flag + process tracking for this download
+    index      : playlist index this download reports progress for (None for single downloads)
+    then       : with the pipeline on, return the postprocess Future as soon as the raw
+                 streams are down and call then(ok) when it is finished
     Uses shell=False so < > % never touch cmd.exe — works on Windows and Linux.
+    With skip_done, URLs already in the download archive return True without starting yt-dlp.
     """
-    stop_flag.clear()
+    url = base_args[-1]; mode = download_mode(base_args)
+    if skip_done and _archived(url, mode, client_id, tag): return True
+    base_args, plan = pipeline_args(base_args)
+    host = host_key(url)
+    strategies = strategy_stats.order(host, build_strategies(base_args, cookie_args, extra_args, out_dir))
+    fd, printed = tempfile.mkstemp(prefix="ytdl-", suffix=".txt", dir=STATE_DIR); os.close(fd)
+    try:
+        if not _run_strategies(strategies, host, url, printed, PIPE_PRINT if plan else ARCHIVE_PRINT,
+                               client_id, job, tag, index): return False
+        if not plan: archive.record_from(printed, url, mode); return True
+        fut = postproc.submit(job, plan, _read_streams(printed), url, mode, client_id, tag, then)
+        return fut if then else fut.result()
+    finally:
+        try: os.remove(printed)
+        except OSError: pass
 
+def build_strategies(base_args, cookie_args, extra_args, out_dir):
+    """The (label, args) retry chain for one download, in default order."""
     def make(label, xtr="", extra_opts=None, use_cookie=True, fallback=False):
         args = fmt_fallback_list(base_args) if fallback else list(base_args)
         if use_cookie: args += cookie_args
@@ -207,27 +1947,563 @@ def smart_download(base_args, cookie_args, extra_args, out_dir, client_id):
             a = fmt_fallback_list(base_args) + ["--cookies-from-browser", b] + extra_args
             a += ["--extractor-args","youtube:player_client=android","-P",out_dir]
             strategies.append((f"Fallback+{b}", a))
+    return strategies
+
+def _attempt_metrics(label, ok, out, prog, t0, stopped):
+    """Outcome counters and stage timings for one attempt. Stages come from progress:
+    extraction until the first byte, download until the last stream finished,
+    postprocess (merge / audio extraction / embedding) until yt-dlp exited."""
+    end = time.time()
+    outcome = "stopped" if stopped else "success" if ok else "429" if out.e429 else "sabr" if out.sabr \
+              else "403" if out.e403 else out.stalled or "error"
+    metrics.inc("ytdl_strategy_attempts_total", strategy=label, outcome=outcome)
+    metrics.observe("ytdl_attempt_seconds", end - t0, outcome=outcome)
+    for kind, hit in (("403", out.e403), ("429", out.e429), ("sabr", out.sabr)):
+        if hit: metrics.inc("ytdl_attempt_errors_total", kind=kind)
+    first = prog.first_at or prog.done_at
+    metrics.observe("ytdl_stage_seconds", (first or end) - t0, stage="extraction")
+    if first:
+        metrics.observe("ytdl_stage_seconds", (prog.done_at or end) - first, stage="download")
+        if ok and prog.done_at: metrics.observe("ytdl_stage_seconds", end - prog.done_at, stage="postprocess")
 
-    sabr = False; tried = 0
+def _run_strategies(strategies, host, url, printed, print_tmpl, client_id, job, tag, index):
+    """smart_download's attempt loop; `printed` is the --print-to-file target (with
+    `print_tmpl`) that tells the archive or the pipeline what the successful attempt produced."""
+    sabr = False; tried = 0; hits_429 = 0
     WEB = {"Direct","mweb client"}
+    pending = deque(strategies)
 
-    for label, args in strategies:
-        if stop_flag.is_set(): push(client_id, f"[{ts()}] ⛔ Stopped."); return False
-        if sabr and label in WEB: push(client_id, f"[{ts()}] ⏭ Skipping {label} (SABR)"); continue
+    def say(msg): push(client_id, tag + msg)
+
+    while pending:
+        label, base = pending.popleft()
+        if job.stop.is_set(): say(f"[{ts()}] ⛔ Stopped."); return False
+        if sabr and label in WEB: say(f"[{ts()}] ⏭ Skipping {label} (SABR)"); continue
+        if not governor.acquire(host, job.stop, say): say(f"[{ts()}] ⛔ Stopped."); return False
 
         tried += 1
-        push(client_id, f"\n[{ts()}] ▶ Strategy {tried}: {label}\n{chr(9472)*50}")
-        ok, full_out = run_and_stream(args, client_id)
-        if stop_flag.is_set(): push(client_id, f"[{ts()}] ⛔ Stopped."); return False
-        if ok: push(client_id, f"\n[{ts()}] ✅ SUCCESS — {label}"); return True
+        say(f"\n[{ts()}] ▶ Strategy {tried}: {label}\n{chr(9472)*50}")
+        # per-attempt flags are rebuilt from the strategy's own args every time (a 429 re-queues `base`)
+        args = base; resume, have = partials.resume_format(url)
+        if resume:
+            args = prefer_format(args, resume)
+            say(f"[{ts()}] ♻ Resuming format {resume} — {have/1048576:.1f} MiB already downloaded")
+        args, info, loaded = info_cache_args(args + governor.extra_args(host) + ["--print-to-file", print_tmpl, printed], url)
+        if loaded: say(f"[{ts()}] ♻ Reusing cached video info")
+        t0 = time.time(); prog = Progress(client_id, job, index, tag)
+        ok, out = run_ytdlp(args, client_id, job, tag, prog)
+        with spawn_lock: spawn_counts["spawns"] += 1; spawn_counts["successes"] += ok
+        _attempt_metrics(label, ok, out, prog, t0, job.stop.is_set())
+        if not loaded: cache.added(info)
+        if not ok and partials.record(job.id, url, out):
+            say(f"[{ts()}] 💾 Partial download kept for the next attempt")
+        if job.stop.is_set(): say(f"[{ts()}] ⛔ Stopped."); return False
+        if ok:
+            strategy_stats.record(host, label, True, time.time() - t0)
+            governor.succeeded(host); partials.finished(url)
+            if prog.bytes and prog.first_at and prog.done_at:
+                note_stream_speed(prog.bytes / max(prog.done_at - prog.first_at, 0.5))
+            say(f"\n[{ts()}] ✅ SUCCESS — {label}"); return True
+        if out.e403 or out.sabr or out.stalled:
+            cache.drop(info)        # its stream URLs are what just got refused (or went dead)
+            if not out.e429: strategy_stats.record(host, label, False, time.time() - t0)
 
-        if is_sabr(full_out): sabr=True; push(client_id, f"[{ts()}] ⚠ SABR detected")
-        if is_429(full_out): push(client_id, f"[{ts()}] ⏳ Rate limited — waiting 20s…"); time.sleep(20); continue
-        if not is_403(full_out) and not is_sabr(full_out): push(client_id, f"[{ts()}] ❌ Failed — stopping retry"); return False
+        if out.sabr: sabr=True; say(f"[{ts()}] ⚠ SABR detected")
+        if out.e429:
+            # not the strategy's fault: the whole host backs off and this strategy goes again
+            hits_429 += 1; delay = governor.penalize(host)
+            if hits_429 >= RATE_MAX_429: say(f"[{ts()}] ❌ Rate limited {hits_429}× — giving up"); return False
+            say(f"[{ts()}] ⏳ Rate limited — all jobs on {host} pause {delay:.0f}s")
+            pending.appendleft((label, base)); continue
+        if not out.e403 and not out.sabr and not out.stalled: say(f"[{ts()}] ❌ Failed — stopping retry"); return False
 
-    push(client_id, f"\n[{ts()}] ❌ ALL {tried} STRATEGIES EXHAUSTED\n💡 Try: update yt-dlp · set cookie browser · export cookies.txt · VPN")
+    say(f"\n[{ts()}] ❌ ALL {tried} STRATEGIES EXHAUSTED\n💡 Try: update yt-dlp · set cookie browser · export cookies.txt · VPN")
     return False
 
+# ═══════════════════════════════════════════════════════════════════════════
+#  POSTPROCESS PIPELINE  (merge / extract / normalise / tag off the network slot)
+# ═══════════════════════════════════════════════════════════════════════════
+# With PIPELINE on, yt-dlp gets the raw streams only: "V+A" selectors become
+# "V,A" (each stream saved on its own as "Title [id].f<format>.<ext>"), the
+# merge/extract-audio options are dropped and the thumbnail is written next to
+# them. The finished item then waits for one of POSTPROCESS_WORKERS threads, each
+# running a single ffmpeg pass (merge or audio extraction, loudnorm, metadata,
+# cover) — the download slot is already free for the next item by then.
+PIPE_PRINT    = ("after_move:%(.{extractor_key,id,format_id,vcodec,acodec,filepath,"
+                 "title,uploader,upload_date,webpage_url})j")
+RAW_OUTTMPL   = "%(title)s [%(id)s].f%(format_id)s.%(ext)s"
+THUMB_OUTTMPL = "thumbnail:%(title)s [%(id)s].%(ext)s"
+COVER_EXTS    = (".jpg", ".jpeg", ".png", ".webp")
+COVER_FORMATS = {"mp4", "mp3", "m4a", "flac"}
+
+def split_selector(sel):
+    """"V1+A1/V2+A2/S" → "V1/V2/S,A1/A2": video and audio picked (and saved) separately."""
+    alts = sel.split("/")
+    video = [a.split("+", 1)[0] for a in alts]
+    audio = list(dict.fromkeys(a.split("+", 1)[1] for a in alts if "+" in a))
+    return "/".join(video) + ("," + "/".join(audio) if audio else "")
+
+def pipeline_args(base_args):
+    """(args, plan) with the postprocessing taken off yt-dlp, or (base_args, None) with PIPELINE off."""
+    if not PIPELINE: return base_args, None
+    args = list(base_args); url = args.pop()
+    plan = {"mode": download_mode(base_args), "afmt": ""}
+    def drop(flag, has_value=True):
+        if flag not in args: return None
+        i = args.index(flag); val = args[i + 1] if has_value else flag
+        del args[i:i + 1 + has_value]; return val
+    if plan["mode"] == "audio":
+        drop("--extract-audio", False); plan["afmt"] = drop("--audio-format") or "mp3"; drop("--audio-quality")
+    else:
+        drop("--merge-output-format"); drop("--postprocessor-args")
+        if "-f" in args: i = args.index("-f") + 1; args[i] = split_selector(args[i])
+    args += ["-o", RAW_OUTTMPL]
+    if EMBED and (plan["afmt"] or "mp4") in COVER_FORMATS:    # else nothing would use (or delete) it
+        args += ["--write-thumbnail", "-o", THUMB_OUTTMPL]
+    return args + [url], plan
+
+def _read_streams(print_file):
+    """The PIPE_PRINT records of one download, one per raw file."""
+    recs = {}
+    try:
+        with open(print_file, encoding="utf-8") as f:
+            for line in f:
+                try: r = json.loads(line)
+                except ValueError: continue
+                if r.get("filepath"): recs[r["filepath"]] = r
+    except OSError: pass
+    return list(recs.values())
+
+def postprocess_args(plan, inputs, cover, meta, dst):
+    """One ffmpeg pass over the raw streams → dst. Video: copy the video stream and
+    take the audio of the last input; audio: encode to plan["afmt"]."""
+    args = ["ffmpeg","-hide_banner","-nostdin","-loglevel","error"]
+    for p in inputs + ([cover] if cover else []): args += ["-i", p]
+    last = len(inputs) - 1
+    a_ext = os.path.splitext(inputs[last])[1].lower()
+    loud = ["-af", f"loudnorm=I={LOUDNORM}:TP=-1.5:LRA=11"] if LOUDNORM else []
+    if plan["mode"] == "video":
+        copy_a = not LOUDNORM and a_ext in (".m4a", ".mp4", ".aac")
+        args += ["-map","0:v:0","-map",f"{last}:a:0?","-c:v:0","copy","-c:a","copy" if copy_a else "aac"] + loud
+        if cover: args += ["-map",f"{last + 1}:v:0","-c:v:1","mjpeg","-disposition:v:1","attached_pic"]
+        args += ["-movflags","+faststart"]
+    else:
+        afmt = plan["afmt"]
+        codec = "copy" if not LOUDNORM and a_ext == "." + afmt else AUDIO_CODECS.get(afmt, "libmp3lame")
+        args += ["-map","0:a:0","-c:a",codec] + (["-q:a","0"] if codec == "libmp3lame" else []) + loud
+        if cover: args += ["-map","1:v:0","-c:v","mjpeg","-disposition:v","attached_pic"]
+        if afmt == "mp3": args += ["-id3v2_version","3"]
+    for k, v in meta.items():
+        if v: args += ["-metadata", f"{k}={v}"]
+    return args + [dst, "-y"]
+
+class Postprocessor:
+    """CPU stage of the pipeline: one ffmpeg per downloaded item, `workers` at a time."""
+    def __init__(self, workers):
+        self.workers = max(1, workers); self.queued = self.running = 0; self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="postproc")
+
+    def submit(self, job, plan, streams, url, mode, client_id, tag="", then=None):
+        """Queue one item's raw streams; the Future resolves to True when the final file is written."""
+        with self.lock: self.queued += 1
+        if then: push(client_id, f"{tag}[{ts()}] 🎞 Queued for muxing — next download can start")
+        return self.pool.submit(self._run, job, plan, streams, url, mode, client_id, tag, then, time.time())
+
+    def _run(self, job, plan, streams, url, mode, client_id, tag, then, queued_at):
+        with self.lock: self.queued -= 1; self.running += 1
+        metrics.observe("ytdl_stage_seconds", time.time() - queued_at, stage="mux_wait")
+        ok = False
+        try: ok = self.process(job, plan, streams, url, mode, client_id, tag)
+        except Exception as e: push(client_id, f"{tag}[{ts()}] Exception: {e}")
+        finally:
+            with self.lock: self.running -= 1
+        if then: then(ok)
+        return ok
+
+    def process(self, job, plan, streams, url, mode, client_id, tag):
+        def say(msg): push(client_id, tag + msg)
+        if job.stop.is_set(): say(f"[{ts()}] ⛔ Stopped."); return False
+        files = [r for r in streams if os.path.isfile(r["filepath"])]
+        if not files: say(f"[{ts()}] ❌ Downloaded streams not found"); return False
+        video = next((r for r in files if r.get("vcodec") not in (None, "none")), files[0])
+        audio = next((r for r in files if r is not video and r.get("acodec") != "none"), None)
+        inputs = [r["filepath"] for r in ([video, audio] if audio else [video])]
+        if plan["mode"] == "audio": inputs = inputs[-1:]
+        raw = video["filepath"]; suffix = f".f{video['format_id']}{os.path.splitext(raw)[1]}"
+        base = raw[:-len(suffix)] if raw.endswith(suffix) else os.path.splitext(raw)[0]
+        dst = base + ("." + plan["afmt"] if plan["mode"] == "audio" else ".mp4")
+        cover = next((base + e for e in COVER_EXTS if os.path.isfile(base + e)), None) \
+                if EMBED and (plan["afmt"] or "mp4") in COVER_FORMATS else None
+        meta = {"title": video.get("title"), "artist": video.get("uploader"), "date": video.get("upload_date"),
+                "comment": video.get("webpage_url")} if EMBED else {}
+        say(f"[{ts()}] 🎞 {'Merging' if plan['mode'] == 'video' else 'Extracting audio'} → {os.path.basename(dst)}")
+        t0 = time.time()
+        ok, out = run_and_stream(postprocess_args(plan, inputs, cover, meta, dst), client_id, job, tag)
+        metrics.observe("ytdl_stage_seconds", time.time() - t0, stage="mux")
+        if not ok:
+            if not job.stop.is_set(): say(f"[{ts()}] ❌ Postprocessing failed — raw streams kept")
+            return False
+        for f in [r["filepath"] for r in files] + ([cover] if cover else []):
+            if f != dst:
+                try: os.remove(f)
+                except OSError: pass
+        archive.put({"extractor": (video.get("extractor_key") or "").lower(), "video_id": video.get("id") or "",
+                     "mode": mode, "url": url, "path": dst, "format": "+".join(r["format_id"] for r in files),
+                     "size": os.path.getsize(dst) if os.path.isfile(dst) else None})
+        say(f"[{ts()}] ✅ Muxed in {time.time() - t0:.1f}s — {dst}")
+        return True
+
+    def info(self):
+        with self.lock: return {"workers": self.workers, "queued": self.queued, "running": self.running}
+
+postproc = Postprocessor(POSTPROCESS_WORKERS)
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  FORMAT PROBE  (pre-flight for playlist batches: concrete formats and sizes)
+# ═══════════════════════════════════════════════════════════════════════════
+# Before a batch downloads, its items are extracted PROBE_BATCH at a time by one
+# `yt-dlp --skip-download` run each, with the flags of the strategy the host
+# ranks first. That resolves the -f selector to concrete format IDs and a size
+# per video, and leaves each info JSON where that strategy's first attempt will
+# --load-info-json it, so the probe replaces extraction rather than adding to it.
+# Videos the selector finds nothing for are probed again with the single-file
+# fallback; unavailable ones fail without a download attempt. Results are cached
+# for PROBE_TTL and handed to the download as its preferred format.
+PROBE_PRINT  = "%(.{id,webpage_url,format_id,filesize,filesize_approx,duration})j"
+PROBE_BATCH  = 25
+PROBE_ERR_RE = re.compile(r"^ERROR: \[[^\]]+\] ([\w-]+): (.*)$")
+UNAVAILABLE  = ("Video unavailable", "Private video", "This video has been removed", "This video is not available",
+                "members-only", "account associated with this video has been terminated")
+
+def note_stream_speed(bps):
+    """Running average of one download's throughput, kept across restarts for batch ETAs."""
+    old = store.get_kv("stream_bps")
+    store.put_kv("stream_bps", bps if not old else old + 0.2 * (bps - old))
+
+class _ProbeSink:
+    """run_and_stream sink for a probe: collects the JSON lines and errors, keeps
+    yt-dlp's per-video chatter out of the log."""
+    def __init__(self): self.found = []; self.errors = {}
+    def parse(self, line):
+        if line.startswith("{"):
+            try: self.found.append(json.loads(line)); return {}
+            except ValueError: pass
+        m = PROBE_ERR_RE.match(line)
+        if m: self.errors[m.group(1)] = m.group(2)
+        return None if line.startswith(("ERROR", "WARNING")) else {}
+    def update(self, p): pass
+
+def _selector(args): return args[args.index("-f") + 1] if "-f" in args else ""
+
+def probe_formats(items, fmt, is_audio, cookie_args, extra_args, job, client_id):
+    """{url: {"format", "size", "duration"} or {"error"}} for playlist items ({id, url});
+    cached results are reused, the rest is probed PROBE_BATCH per yt-dlp run."""
+    out = {}; todo = []
+    for v in items:
+        hit = cache.get_json("probe", v["url"] + "\0" + _selector(_make_base_args(v["url"], fmt, is_audio)), PROBE_TTL)
+        if hit: out[v["url"]] = hit
+        else: todo.append(v)
+    if todo: push(client_id, f"[{ts()}] 🔎 Probing formats of {len(todo)} video(s)…")
+    for k in range(0, len(todo), PROBE_BATCH):
+        found, stop = _probe_batch(todo[k:k + PROBE_BATCH], fmt, is_audio, cookie_args, extra_args, job, client_id)
+        out.update(found)
+        if stop: break
+    return out
+
+def _probe_batch(batch, fmt, is_audio, cookie_args, extra_args, job, client_id):
+    """Probe one batch; returns (results, stop) — stop after a 429 or a user stop."""
+    def say(msg): push(client_id, msg)
+    base = _make_base_args(batch[0]["url"], fmt, is_audio); sel = _selector(base)
+    host = host_key(base[-1]); tmp = tempfile.mkdtemp(prefix="probe-", dir=STATE_DIR)
+    _, args = strategy_stats.order(host, build_strategies(base, cookie_args, extra_args, tmp))[0]
+    args = [a for a in args if a != base[-1]]
+    by_id = {v["id"]: v["url"] for v in batch}; res = {}; todo = batch
+    try:
+        for fallback in (False, True):
+            if not todo or job.stop.is_set(): break
+            if not governor.acquire(host, job.stop, say): break
+            sink = _ProbeSink()
+            run_args = (fmt_fallback_list(args) if fallback else args) + governor.extra_args(host) + \
+                       ["--no-simulate","--skip-download","--ignore-errors","--print",PROBE_PRINT,
+                        "--write-info-json","-o",f"infojson:{os.path.join(tmp, '%(id)s')}"] + [v["url"] for v in todo]
+            t0 = time.time()
+            ok, out = run_and_stream(run_args, client_id, job, progress=sink)
+            metrics.observe("ytdl_stage_seconds", time.time() - t0, stage="probe")
+            for r in sink.found:
+                url = by_id.get(r.get("id")) or r.get("webpage_url")
+                if url not in by_id.values(): continue
+                res[url] = {"format": r.get("format_id"), "size": r.get("filesize") or r.get("filesize_approx"),
+                            "duration": r.get("duration")}
+                src = os.path.join(tmp, f"{r['id']}.info.json")
+                if os.path.isfile(src):
+                    _, info, _ = info_cache_args(args, url)
+                    os.replace(src, info); cache.added(info)
+            for vid, msg in sink.errors.items():
+                url = by_id.get(vid)
+                if url and url not in res and any(u in msg for u in UNAVAILABLE): res[url] = {"error": msg}
+            if out.e429:
+                delay = governor.penalize(host)
+                say(f"[{ts()}] ⏳ Rate limited while probing — {host} pauses {delay:.0f}s, the rest is not probed")
+                return res, True
+            governor.succeeded(host)
+            todo = [v for v in todo if v["url"] not in res and "Requested format is not available" in sink.errors.get(v["id"], "")]
+        for url, r in res.items(): cache.put_json("probe", url + "\0" + sel, r)
+        return res, job.stop.is_set()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def batch_estimate(probe, items, parallel):
+    """Total size and ETA of a batch from its probe results. Videos without a size count
+    as the average of the others; the rate is the average single-download speed
+    times `parallel`, capped by the bandwidth budget."""
+    sizes = [(probe.get(v["url"]) or {}).get("size") for v in items]
+    known = [s for s in sizes if s]
+    total = sum(known) * len(sizes) / len(known) if known else 0
+    rate = (store.get_kv("stream_bps") or 0) * parallel
+    budget = bandwidth.budget_now()
+    if budget: rate = min(rate, budget) if rate else budget
+    return {"items": len(items), "sized": len(known), "bytes": int(total), "rate_bps": int(rate) or None,
+            "eta_secs": round(total / rate) if rate and total else None,
+            "unavailable": sum(1 for v in items if (probe.get(v["url"]) or {}).get("error"))}
+
+def fmt_estimate(est):
+    eta = time.strftime("%H:%M:%S", time.gmtime(est["eta_secs"])) if est["eta_secs"] else "unknown"
+    size = f"{est['bytes'] / 1073741824:.2f} GiB" if est["bytes"] else "unknown size"
+    return (f"🔎 Pre-flight: {est['items']} videos · ~{size} ({est['sized']} sized) · ETA {eta}"
+            + (f" · {est['unavailable']} unavailable" if est["unavailable"] else ""))
+
+def _worker_estimate(job, items, fmt, is_audio, cookie_args, extra_args, parallel, client_id):
+    """Background half of /api/playlist/estimate: the totals go out as a "batch_estimate" event."""
+    try:
+        probe = probe_formats(items, fmt, is_audio, cookie_args, extra_args, job, client_id)
+        if job.stop.is_set(): return
+        est = batch_estimate(probe, items, parallel)
+        push(client_id, fmt_estimate(est))
+        push(client_id, json.dumps(dict(est, estimate=job.id, formats={v["idx"]: probe.get(v["url"]) for v in items})),
+             event="batch_estimate")
+    except Exception as e:
+        push(client_id, f"[{ts()}] Exception: {e}")
+    finally:
+        with fetches_lock:
+            if estimates.get(client_id) is job: estimates.pop(client_id)
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  CLUSTER  (coordinator hands downloads to worker processes on other hosts)
+# ═══════════════════════════════════════════════════════════════════════════
+# Workers pull: POST /api/cluster/lease for as many tasks as they have free
+# slots, renew the leases with /heartbeat, stream each task's SSE events back
+# with /events and report the result with /complete. A task is one
+# smart_download call (args, folder, playlist index). The job thread that made
+# it waits for the result, so the queue, pause/cancel and item statuses stay on
+# the coordinator, while rate limits, bandwidth and partials are per worker.
+# Task states:  queued → leased → done | failed  ·  cancelled (job stopped)
+class Cluster:
+    """Coordinator side: tasks in `store`; workers are known from their last call."""
+    def __init__(self, store):
+        self.store = store; self.workers = {}
+        self.cond = threading.Condition(); self.reap_lock = threading.Lock()
+        store.x("""CREATE TABLE IF NOT EXISTS tasks (
+                       id TEXT PRIMARY KEY, job_id TEXT, client_id TEXT, spec TEXT, state TEXT,
+                       worker TEXT DEFAULT '', lease TEXT DEFAULT '', lease_until REAL DEFAULT 0,
+                       leases INTEGER DEFAULT 0, created REAL, updated REAL)""")
+        store.x("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, created)")
+        store.x("CREATE INDEX IF NOT EXISTS tasks_lease ON tasks (lease)")
+        if STATE_OWNER and not HEADLESS:
+            # whoever waited on these died with the previous process; their jobs re-run from the queue
+            store.x("UPDATE tasks SET state='cancelled' WHERE state IN ('queued','leased')")
+            store.x("DELETE FROM tasks WHERE state IN ('done','failed','cancelled') AND updated < ?", (time.time() - 86400,))
+
+    def _seen(self, wid, slots=None, addr=""):
+        with self.cond:
+            w = self.workers.setdefault(wid, {"id": wid, "slots": 1, "addr": addr, "first_seen": time.time(),
+                                              "done": 0, "failed": 0})
+            w["seen"] = time.time()
+            if slots: w["slots"] = slots
+            if addr: w["addr"] = addr
+
+    def live(self):
+        now = time.time()
+        with self.cond: return [dict(w) for w in self.workers.values() if now - w["seen"] < CLUSTER_LEASE]
+
+    def active(self):   return bool(self.live())
+    def capacity(self): return sum(w["slots"] for w in self.live())
+
+    def _task(self, token, wid):
+        rows = self.store.q("SELECT * FROM tasks WHERE lease=? AND worker=? AND state='leased'", (token, wid)) if token else []
+        return rows[0] if rows else None
+
+    def reap(self):
+        """Leases not renewed in time go back to the queue (failed after CLUSTER_MAX_LEASES)."""
+        with self.reap_lock:
+            now = time.time()
+            for r in self.store.q("SELECT * FROM tasks WHERE state='leased' AND lease_until < ?", (now,)):
+                state = "failed" if r["leases"] >= CLUSTER_MAX_LEASES else "queued"
+                self.store.x("UPDATE tasks SET state=?, worker='', lease='', updated=? WHERE id=?", (state, now, r["id"]))
+                push(r["client_id"], f"{json.loads(r['spec'])['tag']}[{ts()}] ⚠ Worker {r['worker']} stopped responding — "
+                                     + ("giving up" if state == "failed" else "reassigning"))
+        with self.cond: self.cond.notify_all()
+
+    def lease(self, wid, slots, free, addr=""):
+        """Hand the oldest queued tasks (at most `free`) to worker `wid`."""
+        self._seen(wid, slots, addr); self.reap()
+        now = time.time(); out = []
+        with self.store.transaction("IMMEDIATE") as db:
+            rows = db.execute("SELECT * FROM tasks WHERE state='queued' ORDER BY created LIMIT ?", (max(0, free),)).fetchall()
+            for r in rows:
+                token = uuid.uuid4().hex
+                db.execute("UPDATE tasks SET state='leased', worker=?, lease=?, lease_until=?, "
+                           "leases=leases+1, updated=? WHERE id=?", (wid, token, now + CLUSTER_LEASE, now, r["id"]))
+                out.append((r["client_id"], {"lease": token, "task": r["id"], "job_id": r["job_id"], "spec": json.loads(r["spec"])}))
+        for client_id, t in out: push(client_id, f"{t['spec']['tag']}[{ts()}] 🖧 Running on worker {wid}")
+        return [t for _, t in out]
+
+    def heartbeat(self, wid, leases, slots=None, addr=""):
+        """Renew `wid`'s leases. Returns the ones it must stop (cancelled or given to another worker)."""
+        self._seen(wid, slots, addr); stop = []
+        for token in leases:
+            if self._task(token, wid):
+                self.store.x("UPDATE tasks SET lease_until=? WHERE lease=?", (time.time() + CLUSTER_LEASE, token))
+            else: stop.append(token)
+        return stop
+
+    def relay(self, wid, token, events):
+        """Republish a task's events (log, progress…) on the client channel it was created for."""
+        t = self._task(token, wid)
+        if not t: return False
+        for event, data in events: hub.publish(t["client_id"], event, data)
+        return True
+
+    def complete(self, wid, token, ok, archived=None):
+        if not self._task(token, wid): return False        # lease expired and went elsewhere
+        self.store.x("UPDATE tasks SET state=?, updated=? WHERE lease=?", ("done" if ok else "failed", time.time(), token))
+        if ok and archived: archive.put(archived)
+        with self.cond:
+            if wid in self.workers: self.workers[wid]["done" if ok else "failed"] += 1
+            self.cond.notify_all()
+        return True
+
+    def download(self, base_args, cookie_args, extra_args, out_dir, client_id, job, tag="", index=None, skip_done=True):
+        """smart_download's contract, run by whichever worker leases the task. If the
+        last worker disappears while it is still queued, it runs here instead."""
+        url = base_args[-1]
+        if skip_done and _archived(url, download_mode(base_args), client_id, tag): return True
+        task_id = uuid.uuid4().hex[:12]; now = time.time()
+        spec = {"base_args": base_args, "cookie_args": cookie_args, "extra_args": extra_args,
+                "out_dir": out_dir, "tag": tag, "index": index, "kind": job.kind, "skip_done": skip_done}
+        self.store.x("INSERT INTO tasks (id, job_id, client_id, spec, state, created, updated) VALUES (?,?,?,?,?,?,?)",
+                     (task_id, job.id, client_id, json.dumps(spec), "queued", now, now))
+        push(client_id, f"{tag}[{ts()}] 🖧 Queued for a cluster worker")
+        while True:
+            with self.cond: self.cond.wait(1.0)
+            row = self.store.q("SELECT state FROM tasks WHERE id=?", (task_id,))
+            state = row[0]["state"] if row else "gone"
+            if state in ("done", "failed"): return state == "done"
+            if state in ("cancelled", "gone"):     # by startup recovery or another process, not this job
+                push(client_id, f"{tag}[{ts()}] ❌ Cluster task {'cancelled' if row else 'removed'} elsewhere"); return False
+            if job.stop.is_set():
+                self.store.x("UPDATE tasks SET state='cancelled', updated=? WHERE id=?", (time.time(), task_id))
+                push(client_id, f"{tag}[{ts()}] ⛔ Stopped."); return False
+            self.reap()
+            if state == "queued" and not self.active():
+                self.store.x("DELETE FROM tasks WHERE id=? AND state='queued'", (task_id,))
+                if self.store.q("SELECT 1 FROM tasks WHERE id=?", (task_id,)): continue   # leased meanwhile
+                push(client_id, f"{tag}[{ts()}] ⚠ No cluster workers left — downloading here")
+                return smart_download(base_args, cookie_args, extra_args, out_dir, client_id, job, tag, index,
+                                      skip_done=skip_done)
+
+    def summary(self):
+        counts = {r["state"]: r["n"] for r in self.store.q("SELECT state, COUNT(*) AS n FROM tasks GROUP BY state")}
+        running = {r["worker"]: r["n"] for r in self.store.q(
+            "SELECT worker, COUNT(*) AS n FROM tasks WHERE state='leased' GROUP BY worker")}
+        now = time.time()
+        with self.cond:
+            workers = [dict(w, alive=now - w["seen"] < CLUSTER_LEASE, running=running.get(w["id"], 0))
+                       for w in self.workers.values()]
+        return {"workers": workers, "tasks": counts, "lease_secs": CLUSTER_LEASE}
+
+cluster = Cluster(store)
+
+def download(base_args, cookie_args, extra_args, out_dir, client_id, job, tag="", index=None, then=None, skip_done=True):
+    """Run one download on a cluster worker when any are connected, else here. `then` as in
+    smart_download; cluster workers mux before they report, so their result is always a bool."""
+    if cluster.active(): return cluster.download(base_args, cookie_args, extra_args, out_dir, client_id, job, tag, index, skip_done)
+    return smart_download(base_args, cookie_args, extra_args, out_dir, client_id, job, tag, index, then, skip_done)
+
+# ── Worker side ──────────────────────────────────────────────────────────────
+def _cluster_call(action, **payload):
+    req = Request(f"{COORDINATOR}/api/cluster/{action}", method="POST",
+                  data=json.dumps(dict(payload, worker=WORKER_ID, slots=WORKER_SLOTS)).encode(),
+                  headers={"Content-Type": "application/json", "X-Cluster-Token": CLUSTER_TOKEN})
+    with urlopen(req, timeout=30) as r: return json.loads(r.read() or b"{}")
+
+class ClusterWorker:
+    """Leases tasks from COORDINATOR and runs smart_download on them, `slots` at a time.
+
+    Each task gets a Job with the coordinator's job id (so progress events match
+    the UI) and its lease token as the SSE channel, which is relayed back as is.
+    """
+    POLL = 2.0
+    def __init__(self, slots):
+        self.slots = slots; self.running = {}; self.lock = threading.Lock(); self.wake = threading.Event()
+
+    def run(self):
+        print(f"[worker] {WORKER_ID}: {self.slots} slots, coordinator {COORDINATOR}, state in {STATE_DIR}")
+        threading.Thread(target=self._heartbeat, daemon=True, name="heartbeat").start()
+        while True:
+            with self.lock: free = self.slots - len(self.running)
+            if free == self.slots: updater.swap_if_idle()
+            if free > 0:
+                try: tasks = _cluster_call("lease", free=free).get("tasks", [])
+                except Exception as e: print(f"[worker] coordinator unreachable: {e}"); tasks = []
+                for t in tasks:
+                    job = Job(t["lease"], t["spec"]["kind"], t["job_id"]); watchdog.limit(job)
+                    with self.lock: self.running[t["lease"]] = job
+                    threading.Thread(target=self._run, args=(t, job), daemon=True, name=f"task-{t['task']}").start()
+                if tasks: continue
+            self.wake.wait(self.POLL); self.wake.clear()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(CLUSTER_HEARTBEAT)
+            with self.lock: leases = list(self.running)
+            try: stop = _cluster_call("heartbeat", leases=leases).get("stop", [])
+            except Exception as e: print(f"[worker] heartbeat failed: {e}"); continue
+            for token in stop:
+                with self.lock: job = self.running.get(token)
+                if job: job.cancel()
+
+    def _run(self, t, job):
+        token, spec = t["lease"], t["spec"]
+        done = threading.Event(); wake = threading.Event()
+        sub = hub.subscribe(token, wake.set)
+
+        def relay():
+            while True:
+                last = done.is_set()
+                wake.wait(0.5); wake.clear()
+                events = [[e, d] for _, e, d in sub.drain()]
+                if events:
+                    try: _cluster_call("events", lease=token, events=events)
+                    except Exception as e: print(f"[worker] event relay failed: {e}")
+                if last: return
+        relayer = threading.Thread(target=relay, daemon=True); relayer.start()
+        ok = False
+        try:
+            ok = smart_download(spec["base_args"], spec["cookie_args"], spec["extra_args"],
+                                sanitize(WORKER_DIR or spec["out_dir"]), token, job, spec["tag"], spec["index"],
+                                skip_done=spec.get("skip_done", True))
+        except Exception as e:
+            push(token, f"{spec['tag']}[{ts()}] Exception: {e}")
+        finally:
+            done.set(); wake.set(); relayer.join(10)
+            hub.unsubscribe(token, sub); hub.close(token)
+            hit = archive.lookup(spec["base_args"][-1], download_mode(spec["base_args"])) if ok else None
+            for _ in range(3):
+                try: _cluster_call("complete", lease=token, ok=ok, archived=hit); break
+                except Exception as e: print(f"[worker] complete failed: {e}"); time.sleep(CLUSTER_HEARTBEAT)
+            with self.lock: self.running.pop(token, None)
+            self.wake.set()
+
 # ═══════════════════════════════════════════════════════════════════════════
 #  DOWNLOAD WORKERS  (run in threads)
 # ═══════════════════════════════════════════════════════════════════════════
@@ -249,105 +2525,430 @@ def _make_base_args(url, fmt, is_audio):
                 "--postprocessor-args","ffmpeg:-c:v copy -c:a copy",
                 "--newline",url]
 
-def _worker_video(url, out_dir, quality, cookie_flag, extra_flags, client_id):
-    stop_flag.clear()
+# Workers are started by the Scheduler as target(job, **params) and return True
+# on success. Playlist workers read their items from the job's rows in `store`,
+# so a restarted job only re-runs the items that never finished.
+
+def _worker_video(job, url, out_dir, quality, cookie_flag, extra_flags, client_id, skip_done=False):
     cookie_args = build_cookie_args(*_parse_cookie_flag(cookie_flag))
     extra_args  = _parse_extra_flags(extra_flags)
     fmt = FMT_MAP.get(quality, "bv*+ba/best")
     base_args = ["yt-dlp","--no-playlist","-f",fmt,"--merge-output-format","mp4",
                  "--postprocessor-args","ffmpeg:-c:v copy -c:a aac","--newline",url]
     push(client_id, f"[{ts()}] 🎬 Starting video download…\nSave to: {out_dir}\n{'='*56}")
-    ok = smart_download(base_args, cookie_args, extra_args, out_dir, client_id)
+    ok = download(base_args, cookie_args, extra_args, out_dir, client_id, job, skip_done=skip_done)
     push_done(client_id, ok, out_dir)
+    return ok
 
-def _worker_audio(url, out_dir, afmt, cookie_flag, extra_flags, client_id):
-    stop_flag.clear()
+def _worker_audio(job, url, out_dir, afmt, cookie_flag, extra_flags, client_id, skip_done=False):
     cookie_args = build_cookie_args(*_parse_cookie_flag(cookie_flag))
     extra_args  = _parse_extra_flags(extra_flags)
     base_args = ["yt-dlp","--no-playlist","-f","bestaudio","--extract-audio",
                  "--audio-format",afmt,"--audio-quality","0","--newline",url]
     push(client_id, f"[{ts()}] 🎵 Starting audio download…\nSave to: {out_dir}\n{'='*56}")
-    ok = smart_download(base_args, cookie_args, extra_args, out_dir, client_id)
+    ok = download(base_args, cookie_args, extra_args, out_dir, client_id, job, skip_done=skip_done)
     push_done(client_id, ok, out_dir)
+    return ok
 
-def _worker_playlist_all(out_dir, quality, mode, skip_done, cookie_flag, extra_flags, client_id):
-    global playlist_videos
-    stop_flag.clear()
+def _download_item(v, fmt, is_audio, probe, cookie_args, extra_args, out_dir, client_id, job, tag, finish, skip_done=True):
+    """One batch item ({idx, url}) with its probe result; finish(v, ok) is called when it is
+    over. Returns the postprocess Future while the item is still being muxed, else None."""
+    p = probe.get(v["url"]) or {}
+    if p.get("error"): push(client_id, f"{tag}[{ts()}] ❌ {p['error']}"); finish(v, False); return None
+    base_args = _make_base_args(v["url"], fmt, is_audio)
+    if p.get("format"): base_args = prefer_format(base_args, p["format"])
+    res = download(base_args, cookie_args, extra_args, out_dir, client_id, job,
+                   tag=tag, index=v["idx"], then=lambda ok: finish(v, ok), skip_done=skip_done)
+    if isinstance(res, Future): return res
+    finish(v, res)
+    return None
+
+def _worker_playlist_batch(job, out_dir, quality, mode, concurrency, cookie_flag, extra_flags, client_id, skip_done=True):
+    """Download the job's pending items, up to `concurrency` at a time.
+
+    Each item runs its own smart_download chain; status changes are written by index
+    (to the store and the UI playlist) so items finishing out of order never clobber
+    each other. With concurrency > 1, log lines are prefixed with the item number.
+    With cluster workers connected, as many items as they have slots are handed out.
+    Items whose streams are down are muxed by `postproc` while their slot moves on.
+    A format probe first pins each item's formats and reports the batch's size and ETA.
+    Items interrupted by pause/stop go back to "queued" rather than "failed".
+    Returns (done, failed) counted over the whole job, including earlier runs.
+    """
     cookie_args = build_cookie_args(*_parse_cookie_flag(cookie_flag))
     extra_args  = _parse_extra_flags(extra_flags)
     is_audio = mode == "audio"
     fmt = "mp3" if is_audio else FMT_MAP.get(quality, "bv*+ba/best")
-    total = len(playlist_videos); done = 0; failed = 0
-    push(client_id, f"[{ts()}] 📋 Batch — {total} videos\nSave to: {out_dir}\n{'='*56}")
-    for i, v in enumerate(playlist_videos):
-        if stop_flag.is_set(): push(client_id, f"[{ts()}] ⛔ Stopped."); break
-        if skip_done and v["status"] == "done":
-            playlist_videos[i]["status"] = "skipped"; push_playlist(client_id, playlist_videos); continue
-        playlist_videos[i]["status"] = "downloading"; push_playlist(client_id, playlist_videos)
-        push(client_id, f"\n[{ts()}] [{i+1}/{total}] {v['title'][:60]}\n{'─'*48}")
-        base_args = _make_base_args(v["url"], fmt, is_audio)
-        ok = smart_download(base_args, cookie_args, extra_args, out_dir, client_id)
-        playlist_videos[i]["status"] = "done" if ok else "failed"
-        if ok: done+=1
-        else: failed+=1
-        push_playlist(client_id, playlist_videos)
+    items = store.items(job.id)
+    pending = [v for v in items if v["status"] in ("queued", "downloading", "failed")]
+    total = len(items)
+    parallel = max(concurrency, cluster.capacity()) if cluster.active() else concurrency
+    probe = probe_formats(pending, fmt, is_audio, cookie_args, extra_args, job, client_id) if PROBE and pending else {}
+    if probe:
+        est = batch_estimate(probe, pending, parallel)
+        push(client_id, f"[{ts()}] {fmt_estimate(est)}")
+        push(client_id, json.dumps(dict(est, job=job.id)), event="batch_estimate")
+
+    def mark(v, status):
+        store.set_item(job.id, v["idx"], status)
+        set_item_status(client_id, v["idx"], status, v["id"])
+
+    def finish(v, ok): mark(v, "done" if ok else "queued" if job.stop.is_set() else "failed")
+    muxing = []      # postprocess Futures of items whose download slot is already free
+
+    for v in items:
+        if v["status"] == "skipped": set_item_status(client_id, v["idx"], "skipped", v["id"])
+
+    pos = {v["idx"]: n for n, v in enumerate(items, 1)}    # position in the job, for the log
+
+    def _one(v, n):
+        if job.stop.is_set(): return
+        i = v["idx"]
+        mark(v, "downloading")
+        tag = f"[#{i+1}] " if parallel > 1 else ""
+        push(client_id, f"\n[{ts()}] [{n}/{total}] #{i+1} {v['title'][:55]}\n{'─'*48}")
+        fut = _download_item(v, fmt, is_audio, probe, cookie_args, extra_args, out_dir, client_id, job, tag, finish, skip_done)
+        if fut: muxing.append(fut)
+
+    if parallel <= 1:
+        for v in pending: _one(v, pos[v["idx"]])
+    else:
+        with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix=f"job-{job.id}") as pool:
+            for f in [pool.submit(_one, v, pos[v["idx"]]) for v in pending]: f.result()
+    for f in muxing: f.result()
+    if job.stop.is_set(): push(client_id, f"[{ts()}] ⛔ Stopped.")
+    counts = store.item_counts(job.id)
+    return counts.get("done", 0), counts.get("failed", 0) + counts.get("queued", 0)
+
+def _worker_playlist_all(job, out_dir, quality, mode, concurrency, cookie_flag, extra_flags, client_id, skip_done=True):
+    push(client_id, f"[{ts()}] 📋 Batch — {len(store.items(job.id))} videos · {concurrency} parallel\nSave to: {out_dir}\n{'='*56}")
+    done, failed = _worker_playlist_batch(job, out_dir, quality, mode, concurrency, cookie_flag, extra_flags, client_id, skip_done)
     push(client_id, f"\n{'='*56}\n[{ts()}] Done — ✅ {done}  ❌ {failed}\nSaved to: {out_dir}")
     push_done(client_id, failed==0, out_dir)
+    return failed == 0
 
-def _worker_playlist_range(start, end, out_dir, quality, mode, skip_done, cookie_flag, extra_flags, client_id):
-    global playlist_videos
-    stop_flag.clear()
-    cookie_args = build_cookie_args(*_parse_cookie_flag(cookie_flag))
-    extra_args  = _parse_extra_flags(extra_flags)
-    total = len(playlist_videos)
-    s = max(0, start-1); e = min(end, total)-1
-    is_audio = mode == "audio"
-    fmt = "mp3" if is_audio else FMT_MAP.get(quality, "bv*+ba/best")
-    rng = e-s+1; done_c = 0; fail_c = 0
-    push(client_id, f"[{ts()}] 📋 Range #{start}–#{end} ({rng} videos)\nSave to: {out_dir}\n{'='*56}")
-    for i in range(s, e+1):
-        v = playlist_videos[i]
-        if stop_flag.is_set(): push(client_id, f"[{ts()}] ⛔ Stopped."); break
-        if skip_done and v["status"] == "done":
-            playlist_videos[i]["status"] = "skipped"; push_playlist(client_id, playlist_videos); continue
-        playlist_videos[i]["status"] = "downloading"; push_playlist(client_id, playlist_videos)
-        push(client_id, f"\n[{ts()}] [{i-s+1}/{rng}] #{i+1} {v['title'][:55]}\n{'─'*48}")
-        base_args = _make_base_args(v["url"], fmt, is_audio)
-        ok = smart_download(base_args, cookie_args, extra_args, out_dir, client_id)
-        playlist_videos[i]["status"] = "done" if ok else "failed"
-        if ok: done_c+=1
-        else: fail_c+=1
-        push_playlist(client_id, playlist_videos)
+def _worker_playlist_range(job, start, end, out_dir, quality, mode, concurrency, cookie_flag, extra_flags, client_id,
+                           skip_done=True):
+    rng = len(store.items(job.id))
+    push(client_id, f"[{ts()}] 📋 Range #{start}–#{end} ({rng} videos · {concurrency} parallel)\nSave to: {out_dir}\n{'='*56}")
+    done_c, fail_c = _worker_playlist_batch(job, out_dir, quality, mode, concurrency, cookie_flag, extra_flags, client_id,
+                                            skip_done)
     push(client_id, f"\n[{ts()}] Range done — ✅ {done_c}  ❌ {fail_c}")
     push_done(client_id, fail_c==0, out_dir)
+    return fail_c == 0
 
-def _worker_playlist_one(idx, out_dir, quality, mode, cookie_flag, extra_flags, client_id):
-    global playlist_videos
-    stop_flag.clear()
+def _worker_playlist_one(job, idx, out_dir, quality, mode, cookie_flag, extra_flags, client_id, skip_done=False):
     cookie_args = build_cookie_args(*_parse_cookie_flag(cookie_flag))
     extra_args  = _parse_extra_flags(extra_flags)
-    i = idx-1
     is_audio = mode == "audio"
     fmt = "mp3" if is_audio else FMT_MAP.get(quality, "bv*+ba/best")
-    v = playlist_videos[i]; playlist_videos[i]["status"] = "downloading"
-    push_playlist(client_id, playlist_videos)
+    v = store.items(job.id)[0]; i = v["idx"]
+    store.set_item(job.id, i, "downloading"); set_item_status(client_id, i, "downloading", v["id"])
     push(client_id, f"[{ts()}] #{idx}: {v['title']}\n{'='*56}")
     base_args = _make_base_args(v["url"], fmt, is_audio)
-    ok = smart_download(base_args, cookie_args, extra_args, out_dir, client_id)
-    playlist_videos[i]["status"] = "done" if ok else "failed"
-    push_playlist(client_id, playlist_videos)
+    ok = download(base_args, cookie_args, extra_args, out_dir, client_id, job, index=i, skip_done=skip_done)
+    status = "done" if ok else "queued" if job.stop.is_set() else "failed"
+    store.set_item(job.id, i, status); set_item_status(client_id, i, status, v["id"])
     push_done(client_id, ok, out_dir)
+    return ok
 
-def _worker_convert(src, afmt, bitrate, client_id):
-    stop_flag.clear()
-    dst   = os.path.splitext(src)[0]+f"_converted.{afmt}"
-    codec = {"mp3":"libmp3lame","aac":"aac","flac":"flac","wav":"pcm_s16le","opus":"libopus"}.get(afmt,"libmp3lame")
+AUDIO_CODECS = {"mp3":"libmp3lame","aac":"aac","m4a":"aac","flac":"flac","wav":"pcm_s16le","opus":"libopus"}
+MEDIA_EXTS   = {".mp4",".mkv",".webm",".mov",".avi",".flv",".m4v",".ts",".mp3",".m4a",".aac",".opus",
+                ".ogg",".oga",".flac",".wav",".wma",".aiff",".alac"}
+
+def _convert_args(src, dst, afmt, bitrate, threads=0):
     # ffmpeg also uses shell=False — args list keeps paths with spaces safe
-    args = ["ffmpeg","-i",src,"-vn","-acodec",codec,"-ab",bitrate,dst,"-y"]
+    args = ["ffmpeg","-hide_banner","-nostats","-progress","pipe:1","-i",src,"-vn",
+            "-acodec",AUDIO_CODECS.get(afmt,"libmp3lame"),"-ab",bitrate]
+    if threads: args += ["-threads", str(threads)]
+    return args + [dst, "-y"]
+
+def _worker_convert(job, src, afmt, bitrate, client_id):
+    dst   = os.path.splitext(src)[0]+f"_converted.{afmt}"
+    args  = _convert_args(src, dst, afmt, bitrate)
     push(client_id, f"[{ts()}] 🔄 Converting…\n{' '.join(args)}\n{'─'*56}")
-    ok, _ = run_and_stream(args, client_id)
+    t0 = time.time()
+    ok, _ = run_and_stream(args, client_id, job, progress=FfmpegProgress(client_id, job, index=0))
+    if ok: metrics.observe("ytdl_stage_seconds", time.time() - t0, stage="convert")
     push(client_id, f"\n[{ts()}] {'✅ Saved: '+dst if ok else '❌ Conversion failed.'}")
     push_done(client_id, ok, dst)
+    return ok
+
+# ── Batch conversion ─────────────────────────────────────────────────────────
+def convert_sources(src, out_dir="", afmt="mp3", recursive=True):
+    """Expand a directory or glob into [(source, output)] pairs.
+
+    Outputs mirror the source layout under out_dir (default: a `<format>` folder
+    next to the sources) and keep the original file name with the new extension.
+    """
+    src = os.path.expanduser(src.strip())
+    if os.path.isdir(src):
+        base = src
+        pattern = os.path.join(glob.escape(src), "**", "*") if recursive else os.path.join(glob.escape(src), "*")
+        files = [f for f in glob.glob(pattern, recursive=recursive) if os.path.splitext(f)[1].lower() in MEDIA_EXTS]
+    elif glob.has_magic(src):
+        base = src.split("*")[0].split("?")[0].split("[")[0]
+        base = base if base.endswith(os.sep) else os.path.dirname(base)
+        files = glob.glob(src, recursive=True)
+    else:
+        return []
+    out_dir = os.path.abspath(out_dir or os.path.join(base or ".", afmt))
+    pairs = []
+    for f in sorted(os.path.abspath(f) for f in files if os.path.isfile(f)):
+        if f.startswith(out_dir + os.sep): continue         # earlier outputs of this batch
+        rel = os.path.relpath(f, os.path.abspath(base or "."))
+        pairs.append((f, os.path.join(out_dir, os.path.splitext(rel)[0] + f".{afmt}")))
+    return pairs
+
+def _file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""): h.update(chunk)
+    return h.hexdigest()
+
+def conversion_up_to_date(src, dst, settings, check="mtime"):
+    """True if dst was already produced from this exact src with these settings.
+
+    check="mtime" compares the source's size and mtime with what was recorded at
+    conversion time (outputs made outside the app count if newer than the source);
+    check="hash" compares the source's SHA-1 instead; check="none" never skips.
+    """
+    if check == "none" or not os.path.isfile(dst) or os.path.getsize(dst) == 0: return False
+    st = os.stat(src)
+    rows = store.q("SELECT * FROM conversions WHERE dst=?", (dst,))
+    if not rows: return check == "mtime" and os.path.getmtime(dst) >= st.st_mtime
+    r = rows[0]
+    if r["src"] != src or r["settings"] != settings: return False
+    if check == "hash": return r["sha1"] == _file_sha1(src)
+    return r["size"] == st.st_size and abs(r["mtime"] - st.st_mtime) < 1
+
+def _record_conversion(src, dst, settings, check):
+    st = os.stat(src)
+    store.x("INSERT OR REPLACE INTO conversions VALUES (?,?,?,?,?,?,?)",
+            (dst, src, st.st_size, st.st_mtime, _file_sha1(src) if check == "hash" else "", settings, time.time()))
+
+def _worker_convert_batch(job, afmt, bitrate, check, concurrency, client_id):
+    """Convert every item of the job with up to `concurrency` ffmpeg processes.
+
+    Items store the source in `id` and the output in `url`. Each ffmpeg gets an
+    equal share of the cores via -threads so the pool does not oversubscribe.
+    """
+    items = store.items(job.id); total = len(items)
+    pending = [v for v in items if v["status"] in ("queued", "downloading", "failed")]
+    settings = f"{afmt}|{bitrate}"; threads = max(1, (os.cpu_count() or 1) // concurrency)
+    stats = {"bytes": 0, "media": 0.0, "done": 0}; stats_lock = threading.Lock(); t0 = time.time()
+    push(client_id, f"[{ts()}] 🔄 Batch convert — {total} files → {afmt} {bitrate} · {concurrency} parallel\n{'='*56}")
+
+    def _one(v):
+        if job.stop.is_set(): return
+        i, src, dst = v["idx"], v["id"], v["url"]; tag = f"[#{i+1}] "
+        if not os.path.isfile(src):
+            store.set_item(job.id, i, "failed"); push(client_id, f"{tag}❌ Missing: {src}"); return
+        if conversion_up_to_date(src, dst, settings, check):
+            store.set_item(job.id, i, "skipped"); push(client_id, f"{tag}⏭ Up to date: {v['title']}"); return
+        store.set_item(job.id, i, "downloading")
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        prog = FfmpegProgress(client_id, job, index=i, tag=tag); start = time.time()
+        ok, out = run_and_stream(_convert_args(src, dst, afmt, bitrate, threads), client_id, job, tag=tag, progress=prog)
+        if ok:
+            _record_conversion(src, dst, settings, check)
+            took = time.time() - start; metrics.observe("ytdl_stage_seconds", took, stage="convert")
+            with stats_lock:
+                stats["bytes"] += os.path.getsize(src); stats["media"] += prog.duration or 0; stats["done"] += 1
+            rt = f", {prog.duration / took:.0f}x" if prog.duration and took else ""
+            push(client_id, f"{tag}✅ {os.path.basename(dst)} ({took:.1f}s{rt})")
+        store.set_item(job.id, i, "done" if ok else "queued" if job.stop.is_set() else "failed")
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"job-{job.id}") as pool:
+        for f in [pool.submit(_one, v) for v in pending]: f.result()
+    if job.stop.is_set(): push(client_id, f"[{ts()}] ⛔ Stopped.")
+    counts = store.item_counts(job.id); took = max(time.time() - t0, 1e-6)
+    failed = counts.get("failed", 0) + counts.get("queued", 0)
+    push(client_id, f"\n{'='*56}\n[{ts()}] Done — ✅ {counts.get('done', 0)}  ⏭ {counts.get('skipped', 0)}  ❌ {failed}\n"
+                    f"Throughput: {stats['done']} files · {stats['bytes']/1048576:.1f} MiB in {took:.1f}s "
+                    f"({stats['bytes']/1048576/took:.2f} MiB/s, {stats['done']*60/took:.1f} files/min, "
+                    f"{stats['media']/took:.1f}x realtime)")
+    out_dir = os.path.commonpath([os.path.dirname(v["url"]) for v in items]) if items else ""
+    push_done(client_id, failed == 0, out_dir)
+    return failed == 0
+
+# ── Playlist listing (streamed) ─────────────────────────────────────────────
+PLAYLIST_PRINT = "%(id)s|||%(title)s|||%(url)s"
+PLAYLIST_BATCH = 50          # entries per "playlist_items" event
+PLAYLIST_FLUSH = 0.5         # …or whatever arrived within this many seconds
+
+# Running listing fetches {client_id: Job} — a new fetch from the same client replaces the old one
+fetches: dict[str, Job] = {}
+# …and running /api/playlist/estimate probes, likewise one per client (same lock)
+estimates: dict[str, Job] = {}
+fetches_lock = threading.Lock()
+
+def _parse_playlist_line(line):
+    parts = line.split("|||")
+    if len(parts) < 2: return None
+    vid_id  = parts[0].strip(); title = parts[1].strip()
+    vid_url = parts[2].strip() if len(parts)>2 and parts[2].strip() not in ("", "NA") else f"https://www.youtube.com/watch?v={vid_id}"
+    return {"id":vid_id,"title":title,"url":vid_url,"status":"queued"}
+
+def _worker_fetch_playlist(job, args, cache_key, cached, start, limit, client_id):
+    """Append entries to playlist_videos as yt-dlp prints them, pushing them in small batches.
+
+    Items are usable by the download routes as soon as they have been appended.
+    """
+    batch = []; mine = []; got = 0; last = time.time(); errors = []; ok = False
+    host = host_key(args[-1]); limited = False
+
+    def flush():
+        nonlocal batch, last
+        global playlist_version
+        with playlist_lock:
+            if job.stop.is_set() or not batch: batch = []; return
+            offset = len(playlist_videos); playlist_videos.extend(batch)
+            playlist_version += 1; epoch, v = playlist_epoch, playlist_version
+        mine.extend(batch)
+        push(client_id, json.dumps({"epoch": epoch, "v": v, "offset": offset, "videos": batch}), event="playlist_items")
+        batch = []; last = time.time()
+
+    try:
+        if cached is not None:
+            for v in cached:
+                batch.append(dict(v, status="queued")); got += 1
+                if len(batch) >= PLAYLIST_BATCH * 10: flush()
+            ok = True
+        elif governor.acquire(host, job.stop, lambda m: push(client_id, m)):
+            t0 = time.time()
+            proc = spawn(tool_args(args), PROC_NICE, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, text=True, bufsize=1)
+            metrics.inc("ytdl_process_spawns_total", tool="yt-dlp")
+            job.attach(proc); w = watchdog.watch(proc, STALL_SECS)
+            try:
+                for raw in proc.stdout:
+                    w.touch()
+                    if job.stop.is_set(): proc.terminate(); break
+                    v = _parse_playlist_line(raw.rstrip())
+                    if v: batch.append(v); got += 1
+                    elif raw.strip():
+                        errors = (errors + [raw.strip()])[-3:]; limited = limited or is_429(raw)
+                    if len(batch) >= PLAYLIST_BATCH or (batch and time.time() - last >= PLAYLIST_FLUSH): flush()
+                proc.wait()
+            finally: watchdog.unwatch(w); job.detach(proc)
+            if w.reason: errors.append(w.why())
+            ok = proc.returncode == 0 and not job.stop.is_set()
+            metrics.observe("ytdl_stage_seconds", time.time() - t0, stage="listing")
+            if limited: governor.penalize(host)
+            elif ok: governor.succeeded(host)
+        flush()
+    except Exception as e:
+        errors.append(str(e))
+    finally:
+        with fetches_lock:
+            if fetches.get(client_id) is job: fetches.pop(client_id)
+    if job.stop.is_set(): return
+    with playlist_lock: snapshot = list(playlist_videos)
+    store.put_kv("playlist", snapshot)
+    if ok and got and cached is None:
+        cache.put_json("playlist", cache_key, [dict(v, status="queued") for v in mine])
+    push(client_id, json.dumps({
+        "ok": ok or got > 0, "total": len(snapshot), "got": got, "cached": cached is not None,
+        "next": start + got if limit and got >= limit else None,
+        "error": "" if ok else (errors[-1] if errors else "yt-dlp failed")}), event="playlist_end")
+
+JOB_KINDS = {
+    "video":          _worker_video,
+    "audio":          _worker_audio,
+    "playlist_one":   _worker_playlist_one,
+    "playlist_range": _worker_playlist_range,
+    "playlist_all":   _worker_playlist_all,
+    "convert":        _worker_convert,
+    "convert_batch":  _worker_convert_batch,
+}
+
+def _restore_playlist():
+    """Reload the last fetched playlist and overlay the newest item statuses from jobs."""
+    videos = store.get_kv("playlist", [])
+    latest = {r["video_id"]: r["status"] for r in store.q("SELECT video_id, status FROM items ORDER BY rowid")}
+    for v in videos:
+        st = latest.get(v["id"], v["status"])
+        v["status"] = "queued" if st == "downloading" else st
+    replace_playlist(videos)
+
+if STATE_OWNER and not HEADLESS:
+    _restore_playlist(); partials.cleanup()
+elif not HEADLESS:
+    print(f"[startup] {STATE_DIR} is in use by another process — skipping queue/partial recovery")
+watchdog.start()
+bandwidth.configure(**store.get_kv("bandwidth", {}))
+bandwidth.start()
+if not HEADLESS: updater.start()
+if not COORDINATOR and not HEADLESS: scheduler.start()
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  ASYNC SSE SERVER  (one asyncio loop serves every /stream connection)
+# ═══════════════════════════════════════════════════════════════════════════
+sse_server_port = 0
+ui_port         = 0          # the Flask port, set at startup — the only origin allowed cross-port
+
+def _last_event_id(*vals):
+    for v in vals:
+        try: return int(v)
+        except (TypeError, ValueError): pass
+    return None
+
+def _ui_origin(origin, host):
+    """True for the page this app served: same hostname as the SSE request, UI port.
+    Other sites must not read a client's stream even if they learn its id."""
+    try: o = urlparse(origin); return o.hostname == urlparse("//" + host).hostname and o.port == ui_port
+    except ValueError: return False
+
+async def _sse_conn(reader, writer):
+    loop = asyncio.get_running_loop(); sub = cid = None
+    try:
+        head = (await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)).decode("latin-1")
+        method, target = (head.split("\r\n", 1)[0].split(" ") + ["", ""])[:2]
+        headers = {k.strip().lower(): v.strip() for k, _, v in (l.partition(":") for l in head.split("\r\n")[1:] if l)}
+        path, _, qs = target.partition("?")
+        origin = headers.get("origin")
+        if origin and not _ui_origin(origin, headers.get("host", "")):
+            writer.write(b"HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\n\r\n"); return
+        cors = (f"Access-Control-Allow-Origin: {origin}\r\nVary: Origin\r\n"
+                "Access-Control-Allow-Headers: Last-Event-ID, Cache-Control\r\n") if origin else ""
+        if method == "OPTIONS":
+            writer.write(f"HTTP/1.1 204 No Content\r\n{cors}Content-Length: 0\r\n\r\n".encode()); return
+        if method != "GET" or not path.startswith("/stream/") or len(path) <= 8:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n"); return
+        cid = path[len("/stream/"):]
+        wake = asyncio.Event()
+        sub = hub.subscribe(cid, lambda: loop.call_soon_threadsafe(wake.set),
+                            _last_event_id(headers.get("last-event-id"), parse_qs(qs).get("last", [None])[0]))
+        writer.write(("HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                      f"{cors}Connection: keep-alive\r\n\r\nretry: 2000\n\n").encode())
+        await writer.drain()
+        while not sub.overflow:
+            items = sub.drain()
+            if items:
+                writer.write("".join(sse_frame(it) for it in items).encode()); await writer.drain(); continue
+            try: await asyncio.wait_for(wake.wait(), 30)
+            except asyncio.TimeoutError:
+                writer.write(b": ping\n\n"); await writer.drain()
+            wake.clear()
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, asyncio.LimitOverrunError):
+        pass
+    finally:
+        if sub: hub.unsubscribe(cid, sub)
+        try: writer.close()
+        except Exception: pass
+
+def start_sse_server(port):
+    """Serve /stream/<client_id> from an asyncio loop on its own thread; returns the bound port or 0."""
+    global sse_server_port
+    loop = asyncio.new_event_loop()
+    try: server = loop.run_until_complete(asyncio.start_server(_sse_conn, HOST, port))
+    except OSError as e:
+        print(f"[startup] Async SSE server could not bind port {port}: {e} — using /stream on the UI port")
+        loop.close(); return 0
+    sse_server_port = server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True, name="sse-server").start()
+    return sse_server_port
 
 # ═══════════════════════════════════════════════════════════════════════════
 #  ROUTES
@@ -357,29 +2958,39 @@ def _worker_convert(src, afmt, bitrate, client_id):
 def index():
     return render_template("index.html",
         default_dir=DEFAULT_DIR,
-        platform=platform.system())
+        platform=platform.system(),
+        sse_port=sse_server_port)
 
 # ── SSE stream ───────────────────────────────────────────────────────────────
 @app.route("/stream/<client_id>")
 def stream(client_id):
-    q = queue.Queue()
-    sse_queues[client_id] = q
+    """Thread-per-connection SSE fallback; the async server (SSE_PORT) serves the same hub."""
+    wake = threading.Event()
+    sub = hub.subscribe(client_id, wake.set, _last_event_id(request.headers.get("Last-Event-ID"), request.args.get("last")))
     def generate():
         try:
-            while True:
-                try:
-                    msg = q.get(timeout=30)
-                    data = json.loads(msg)
-                    yield f"event: {data['event']}\ndata: {data['data']}\n\n"
-                except queue.Empty:
-                    yield ": ping\n\n"
-        except GeneratorExit:
-            sse_queues.pop(client_id, None)
+            yield "retry: 2000\n\n"
+            while not sub.overflow:
+                items = sub.drain()
+                if items: yield "".join(sse_frame(it) for it in items); continue
+                if not wake.wait(timeout=30): yield ": ping\n\n"
+                wake.clear()
+        finally:
+            hub.unsubscribe(client_id, sub)
     return Response(stream_with_context(generate()),
                     mimetype="text/event-stream",
                     headers={"Cache-Control":"no-cache","X-Accel-Buffering":"no"})
 
-# ── Download video ────────────────────────────────────────────────────────────
+@app.route("/api/sse/stats")
+def api_sse_stats():
+    return jsonify(channels=hub.stats(), async_port=sse_server_port)
+
+def _enqueue(d, kind, params, items=None):
+    """Queue a job for the scheduler; `priority` in the request body orders the queue (higher first)."""
+    try: priority = int(d.get("priority", 0))
+    except (TypeError, ValueError): priority = 0
+    return scheduler.submit(params["client_id"], kind, params, priority, items)
+
 @app.route("/api/download/video", methods=["POST"])
 def api_download_video():
     d = request.json
@@ -390,8 +3001,9 @@ def api_download_video():
     cookie_flag = build_cookie_flag(d.get("browser","None"), d.get("cookie_file",""))
     extra_flags = build_extra_flags(d.get("rate_limit","No limit"), d.get("retries","5"))
     if not url: return jsonify(error="No URL"), 400
-    threading.Thread(target=_worker_video, args=(url,out_dir,quality,cookie_flag,extra_flags,client_id), daemon=True).start()
-    return jsonify(ok=True)
+    job_id = _enqueue(d, "video", dict(url=url, out_dir=out_dir, quality=quality, skip_done=bool(d.get("skip_done", False)),
+                      cookie_flag=cookie_flag, extra_flags=extra_flags, client_id=client_id))
+    return jsonify(ok=True, job_id=job_id)
 
 @app.route("/api/download/audio", methods=["POST"])
 def api_download_audio():
@@ -403,21 +3015,33 @@ def api_download_audio():
     cookie_flag = build_cookie_flag(d.get("browser","None"), d.get("cookie_file",""))
     extra_flags = build_extra_flags(d.get("rate_limit","No limit"), d.get("retries","5"))
     if not url: return jsonify(error="No URL"), 400
-    threading.Thread(target=_worker_audio, args=(url,out_dir,afmt,cookie_flag,extra_flags,client_id), daemon=True).start()
-    return jsonify(ok=True)
+    job_id = _enqueue(d, "audio", dict(url=url, out_dir=out_dir, afmt=afmt, skip_done=bool(d.get("skip_done", False)),
+                      cookie_flag=cookie_flag, extra_flags=extra_flags, client_id=client_id))
+    return jsonify(ok=True, job_id=job_id)
 
 # ── Playlist ──────────────────────────────────────────────────────────────────
 @app.route("/api/playlist/fetch", methods=["POST"])
 def api_fetch_playlist():
-    global playlist_videos
+    """Load a playlist listing.
+
+    With "stream": true the call returns at once and entries arrive over SSE as
+    "playlist_items" batches while yt-dlp pages through the playlist, followed by
+    "playlist_end". "start"/"limit" fetch one page (1-based); "playlist_end"
+    carries "next" when more entries may follow. Without "stream" the full
+    listing is returned in the response as before.
+    """
     d = request.json
     url = d.get("url","").strip()
     if not url: return jsonify(error="No URL"), 400
+    client_id = d.get("client_id","")
+    streaming = bool(d.get("stream"))
+    try: start = max(1, int(d.get("start", 1))); limit = max(0, int(d.get("limit", 0) or 0))
+    except (TypeError, ValueError): return jsonify(error="Bad start/limit"), 400
 
     # Build args list — shell=False bypasses cmd.exe on Windows entirely,
     # so % characters in the --print format are never expanded as env vars.
     args = ["yt-dlp", "--flat-playlist",
-            "--print", "%(id)s|||%(title)s|||%(url)s",
+            "--print", PLAYLIST_PRINT,
             "--no-warnings"]
 
     # Add cookie args if set
@@ -427,26 +3051,59 @@ def api_fetch_playlist():
         args += ["--cookies", cookie_file.strip()]
     elif browser != "None":
         args += ["--cookies-from-browser", browser.lower()]
+    if start > 1 or limit:
+        args += ["--playlist-items", f"{start}:{start+limit-1 if limit else ''}"]
 
     args.append(url)
+    cache_key = "\0".join(args)
+    cached = None if d.get("refresh") else cache.get_json("playlist", cache_key, PLAYLIST_TTL)
+
+    if streaming:
+        with fetches_lock: old = fetches.get(client_id)
+        if old: old.cancel()
+        job = Job(client_id, "fetch")
+        with fetches_lock: fetches[client_id] = job
+        if start == 1: replace_playlist([])
+        threading.Thread(target=_worker_fetch_playlist, daemon=True, name=f"fetch-{job.id}",
+                         args=(job, args[:-1] + ["--lazy-playlist", url], cache_key, cached, start, limit, client_id)).start()
+        return jsonify(ok=True, streaming=True, fetch_id=job.id)
+
+    if cached is not None:
+        videos = [dict(v, status="queued") for v in cached]
+        epoch, v = replace_playlist(videos)
+        store.put_kv("playlist", videos)
+        return jsonify(videos=videos, cached=True, epoch=epoch, v=v)
 
     try:
-        result = subprocess.run(args, shell=False, capture_output=True, text=True, timeout=90)
-        lines  = [l for l in result.stdout.strip().split("\n") if "|||" in l]
-        videos = []
-        for line in lines:
-            parts = line.split("|||")
-            if len(parts) >= 2:
-                vid_id  = parts[0].strip(); title = parts[1].strip()
-                vid_url = parts[2].strip() if len(parts)>2 else f"https://www.youtube.com/watch?v={vid_id}"
-                videos.append({"id":vid_id,"title":title,"url":vid_url,"status":"queued"})
-        playlist_videos = videos
-        return jsonify(videos=videos)
+        result = subprocess.run(tool_args(args), shell=False, capture_output=True, text=True, timeout=90, env=tool_env())
+        videos = [v for v in map(_parse_playlist_line, result.stdout.strip().split("\n")) if v]
+        if start == 1: epoch, v = replace_playlist(videos)
+        else:
+            with playlist_lock: merged = playlist_videos + videos
+            epoch, v = replace_playlist(merged)
+        store.put_kv("playlist", playlist_snapshot()["videos"])
+        if result.returncode == 0 and videos: cache.put_json("playlist", cache_key, videos)
+        return jsonify(videos=videos, epoch=epoch, v=v)
     except subprocess.TimeoutExpired:
-        return jsonify(error="Timeout — playlist took too long"), 408
+        return jsonify(error="Timeout — playlist took too long (use stream mode)"), 408
     except Exception as e:
         return jsonify(error=str(e)), 500
 
+def _snapshot_items(indices, skip_done=False, mode="video"):
+    """Copy playlist rows into job items; rows already done — in this playlist or in
+    the download archive — become "skipped" when skip_done."""
+    with playlist_lock:
+        rows = [(i, dict(playlist_videos[i])) for i in indices if 0 <= i < len(playlist_videos)]
+    return [{"idx": i, "id": v["id"], "title": v["title"], "url": v["url"],
+             "status": "skipped" if skip_done and (v["status"] == "done" or archive.lookup(v["url"], mode)) else "queued"}
+            for i, v in rows]
+
+def _concurrency(d):
+    """Parallel item count for a playlist batch, clamped to 1..MAX_CONCURRENCY."""
+    try: n = int(d.get("concurrency", 1))
+    except (TypeError, ValueError): n = 1
+    return max(1, min(n, MAX_CONCURRENCY))
+
 @app.route("/api/playlist/download/one", methods=["POST"])
 def api_dl_one():
     d = request.json
@@ -454,9 +3111,12 @@ def api_dl_one():
     out_dir = sanitize(d.get("save_dir", DEFAULT_DIR))
     cookie_flag = build_cookie_flag(d.get("browser","None"), d.get("cookie_file",""))
     extra_flags = build_extra_flags(d.get("rate_limit","No limit"), d.get("retries","5"))
-    threading.Thread(target=_worker_playlist_one,
-        args=(idx, out_dir, d.get("quality","1080p"), d.get("mode","video"), cookie_flag, extra_flags, client_id), daemon=True).start()
-    return jsonify(ok=True)
+    items = _snapshot_items([idx-1])
+    if not items: return jsonify(error=f"No video #{idx}"), 400
+    job_id = _enqueue(d, "playlist_one", dict(idx=idx, out_dir=out_dir, quality=d.get("quality","1080p"),
+                      mode=d.get("mode","video"), cookie_flag=cookie_flag, extra_flags=extra_flags,
+                      client_id=client_id, skip_done=bool(d.get("skip_done", False))), items)
+    return jsonify(ok=True, job_id=job_id)
 
 @app.route("/api/playlist/download/range", methods=["POST"])
 def api_dl_range():
@@ -464,10 +3124,14 @@ def api_dl_range():
     out_dir = sanitize(d.get("save_dir", DEFAULT_DIR))
     cookie_flag = build_cookie_flag(d.get("browser","None"), d.get("cookie_file",""))
     extra_flags = build_extra_flags(d.get("rate_limit","No limit"), d.get("retries","5"))
-    threading.Thread(target=_worker_playlist_range,
-        args=(int(d.get("start",1)), int(d.get("end",1)), out_dir, d.get("quality","1080p"),
-              d.get("mode","video"), d.get("skip_done",True), cookie_flag, extra_flags, client_id), daemon=True).start()
-    return jsonify(ok=True)
+    start, end = int(d.get("start",1)), int(d.get("end",1))
+    items = _snapshot_items(range(start-1, end), d.get("skip_done",True), d.get("mode","video"))
+    if not items: return jsonify(error="Empty range"), 400
+    job_id = _enqueue(d, "playlist_range", dict(start=start, end=end, out_dir=out_dir,
+                      quality=d.get("quality","1080p"), mode=d.get("mode","video"), concurrency=_concurrency(d),
+                      cookie_flag=cookie_flag, extra_flags=extra_flags, client_id=client_id,
+                      skip_done=bool(d.get("skip_done",True))), items)
+    return jsonify(ok=True, job_id=job_id)
 
 @app.route("/api/playlist/download/all", methods=["POST"])
 def api_dl_all():
@@ -475,64 +3139,424 @@ def api_dl_all():
     out_dir = sanitize(d.get("save_dir", DEFAULT_DIR))
     cookie_flag = build_cookie_flag(d.get("browser","None"), d.get("cookie_file",""))
     extra_flags = build_extra_flags(d.get("rate_limit","No limit"), d.get("retries","5"))
-    threading.Thread(target=_worker_playlist_all,
-        args=(out_dir, d.get("quality","1080p"), d.get("mode","video"), d.get("skip_done",True),
-              cookie_flag, extra_flags, client_id), daemon=True).start()
-    return jsonify(ok=True)
+    with playlist_lock: total = len(playlist_videos)
+    items = _snapshot_items(range(total), d.get("skip_done",True), d.get("mode","video"))
+    if not items: return jsonify(error="No playlist loaded"), 400
+    job_id = _enqueue(d, "playlist_all", dict(out_dir=out_dir, quality=d.get("quality","1080p"),
+                      mode=d.get("mode","video"), concurrency=_concurrency(d),
+                      cookie_flag=cookie_flag, extra_flags=extra_flags, client_id=client_id,
+                      skip_done=bool(d.get("skip_done",True))), items)
+    return jsonify(ok=True, job_id=job_id)
+
+@app.route("/api/playlist/estimate", methods=["POST"])
+def api_estimate():
+    """Probe the loaded playlist (same body as /download/all) for its total size and ETA
+    before anything is queued. Returns at once; the result arrives as a "batch_estimate"
+    event carrying "estimate": <estimate_id>. /api/stop cancels it, and a following
+    /download/all reuses the cached probe."""
+    d = request.json; client_id = d.get("client_id","")
+    mode = d.get("mode","video"); is_audio = mode == "audio"
+    fmt = "mp3" if is_audio else FMT_MAP.get(d.get("quality","1080p"), "bv*+ba/best")
+    with playlist_lock: total = len(playlist_videos)
+    if not total: return jsonify(error="No playlist loaded"), 400
+    items = [v for v in _snapshot_items(range(total), d.get("skip_done",True), mode) if v["status"] == "queued"]
+    cookie_args = build_cookie_args(*_parse_cookie_flag(build_cookie_flag(d.get("browser","None"), d.get("cookie_file",""))))
+    extra_args  = _parse_extra_flags(build_extra_flags(d.get("rate_limit","No limit"), d.get("retries","5")))
+    with fetches_lock: old = estimates.get(client_id)
+    if old: old.cancel()
+    job = Job(client_id, "estimate")
+    with fetches_lock: estimates[client_id] = job
+    threading.Thread(target=_worker_estimate, daemon=True, name=f"estimate-{job.id}",
+                     args=(job, items, fmt, is_audio, cookie_args, extra_args, _concurrency(d), client_id)).start()
+    return jsonify(ok=True, streaming=True, estimate_id=job.id, items=len(items))
 
 @app.route("/api/playlist/reset", methods=["POST"])
 def api_reset():
-    global playlist_videos
-    for v in playlist_videos: v["status"] = "queued"
-    return jsonify(videos=playlist_videos)
+    with playlist_lock: videos = [dict(v, status="queued") for v in playlist_videos]
+    replace_playlist(videos)
+    store.put_kv("playlist", videos)
+    return jsonify(playlist_snapshot())
+
+@app.route("/api/playlist/snapshot")
+def api_playlist_snapshot():
+    """Full playlist with its epoch/version — what a (re)connecting client renders before applying deltas."""
+    return jsonify(playlist_snapshot())
 
 # ── Convert ───────────────────────────────────────────────────────────────────
 @app.route("/api/convert", methods=["POST"])
+@app.route("/api/convert/batch", methods=["POST"])
 def api_convert():
+    """Convert one file, or — for a folder or glob path (or /batch) — every media file in it.
+
+    Batch options: out_dir, recursive (true), check ("mtime" | "hash" | "none"),
+    concurrency (default YTDL_CONVERT_WORKERS).
+    """
     d = request.json; client_id = d.get("client_id","")
-    src = d.get("path","").strip()
-    if not src or not os.path.isfile(src): return jsonify(error="File not found"), 404
-    threading.Thread(target=_worker_convert,
-        args=(src, d.get("format","mp3"), d.get("bitrate","320k"), client_id), daemon=True).start()
-    return jsonify(ok=True)
+    src = d.get("path","").strip(); afmt = d.get("format","mp3")
+    if src and os.path.isfile(src) and not request.path.endswith("/batch"):
+        job_id = _enqueue(d, "convert", dict(src=src, afmt=afmt,
+                          bitrate=d.get("bitrate","320k"), client_id=client_id))
+        return jsonify(ok=True, job_id=job_id)
+    pairs = convert_sources(src, d.get("out_dir",""), afmt, d.get("recursive", True)) if src else []
+    if not pairs: return jsonify(error="No media files found"), 404
+    check = d.get("check","mtime") if d.get("check") in ("mtime", "hash", "none") else "mtime"
+    try: concurrency = int(d.get("concurrency") or CONVERT_WORKERS)
+    except (TypeError, ValueError): concurrency = CONVERT_WORKERS
+    concurrency = max(1, min(concurrency, len(pairs), max(CONVERT_WORKERS, os.cpu_count() or 1)))
+    items = [{"idx": i, "id": a, "title": os.path.basename(a), "url": b, "status": "queued"}
+             for i, (a, b) in enumerate(pairs)]
+    job_id = _enqueue(d, "convert_batch", dict(afmt=afmt, bitrate=d.get("bitrate","320k"), check=check,
+                      concurrency=concurrency, client_id=client_id), items)
+    return jsonify(ok=True, job_id=job_id, files=len(pairs), concurrency=concurrency,
+                   out_dir=os.path.commonpath([os.path.dirname(b) for _, b in pairs]))
 
 # ── Stop ──────────────────────────────────────────────────────────────────────
 @app.route("/api/stop", methods=["POST"])
 def api_stop():
-    global stop_flag
-    stop_flag.set()
-    if active_process:
-        try: active_process.terminate()
-        except: pass
+    """Cancel one job (job_id — also a fetch_id / estimate_id), every active job of a client
+    (client_id), or everything."""
+    d = request.get_json(silent=True) or {}
+    job_id = d.get("job_id",""); client_id = d.get("client_id","")
+    if job_id: ids = [job_id]
+    elif client_id:
+        ids = [r["id"] for r in store.q("SELECT id FROM jobs WHERE client_id=? AND state IN (?,?,?)",
+                                        (client_id, *ACTIVE_STATES))]
+    else:
+        ids = [r["id"] for r in store.q("SELECT id FROM jobs WHERE state IN (?,?,?)", ACTIVE_STATES)]
+    with fetches_lock: side = [*fetches.values(), *estimates.values()]    # listings and estimates
+    for j in side:
+        if (j.id == job_id) if job_id else (not client_id or j.client_id == client_id): j.cancel()
+    return jsonify(ok=True, stopped=[i for i in ids if scheduler.cancel(i)])
+
+# ── Job queue ─────────────────────────────────────────────────────────────────
+def _job_view(row):
+    params = json.loads(row.pop("params"))
+    with jobs_lock: live = jobs.get(row["id"])
+    row["items"] = store.item_counts(row["id"])
+    row["processes"] = live.info()["processes"] if live else 0
+    row["label"] = params.get("url") or params.get("src") or ""
+    return row
+
+@app.route("/api/jobs")
+def api_jobs():
+    rows = store.q("SELECT * FROM jobs ORDER BY CASE WHEN state IN ('running','queued','paused') THEN 0 ELSE 1 END,"
+                   " priority DESC, created DESC LIMIT ?", (int(request.args.get("limit", 100)),))
+    return jsonify(jobs=[_job_view(r) for r in rows], max_jobs=scheduler.max_jobs)
+
+@app.route("/api/jobs/<job_id>")
+def api_job(job_id):
+    row = store.get(job_id)
+    if not row: return jsonify(error="No such job"), 404
+    return jsonify(job=_job_view(row), items=store.items(job_id))
+
+@app.route("/api/jobs/<job_id>/<action>", methods=["POST"])
+def api_job_action(job_id, action):
+    """pause · resume · cancel · priority ({"priority": n})"""
+    if not store.get(job_id): return jsonify(error="No such job"), 404
+    if action == "priority":
+        d = request.get_json(silent=True) or {}
+        store.x("UPDATE jobs SET priority=? WHERE id=?", (int(d.get("priority",0)), job_id))
+        scheduler.wake.set()
+        return jsonify(ok=True, state=store.get(job_id)["state"])
+    fn = {"pause": scheduler.pause, "resume": scheduler.resume, "cancel": scheduler.cancel}.get(action)
+    if not fn: return jsonify(error=f"Unknown action {action}"), 400
+    ok = fn(job_id)
+    return jsonify(ok=ok, state=store.get(job_id)["state"])
+
+@app.route("/api/jobs/config", methods=["POST"])
+def api_jobs_config():
+    d = request.json
+    if "max_jobs" in d: scheduler.set_max_jobs(int(d["max_jobs"]))
+    return jsonify(ok=True, max_jobs=scheduler.max_jobs)
+
+# ── Strategy stats ────────────────────────────────────────────────────────────
+@app.route("/api/strategies/stats")
+def api_strategy_stats():
+    with spawn_lock: c = dict(spawn_counts)
+    c["spawns_per_success"] = round(c["spawns"] / c["successes"], 2) if c["successes"] else None
+    return jsonify(hosts=strategy_stats.summary(), half_life_secs=STRATEGY_HALF_LIFE, process=c)
+
+@app.route("/api/strategies/reset", methods=["POST"])
+def api_strategy_reset():
+    host = (request.get_json(silent=True) or {}).get("host","")
+    if host: store.x("DELETE FROM strategy_stats WHERE host=?", (host,))
+    else:    store.x("DELETE FROM strategy_stats")
     return jsonify(ok=True)
 
+# ── Download archive ──────────────────────────────────────────────────────────
+@app.route("/api/archive")
+def api_archive():
+    return jsonify(entries=archive.stats())
+
+@app.route("/api/archive/export")
+def api_archive_export():
+    """The archive as a yt-dlp --download-archive file."""
+    return Response("".join(l + "\n" for l in archive.export_lines()), mimetype="text/plain",
+                    headers={"Content-Disposition": "attachment; filename=archive.txt"})
+
+@app.route("/api/archive/import", methods=["POST"])
+def api_archive_import():
+    """Import a yt-dlp --download-archive file: {"path": "..."} or {"text": "..."}."""
+    d = request.get_json(silent=True) or {}
+    if d.get("path"):
+        try:
+            with open(d["path"], encoding="utf-8") as f: text = f.read()
+        except OSError as e: return jsonify(error=str(e)), 404
+    else: text = d.get("text","")
+    return jsonify(ok=True, imported=archive.import_lines(text.splitlines()))
+
+@app.route("/api/archive/reconcile", methods=["POST"])
+def api_archive_reconcile():
+    """Check the archive against the files in {"dir"} (default save folder)."""
+    out_dir = (request.get_json(silent=True) or {}).get("dir","").strip() or DEFAULT_DIR
+    if not os.path.isdir(out_dir): return jsonify(error="Folder not found"), 404
+    return jsonify(ok=True, **archive.reconcile(out_dir))
+
+# ── Partial downloads ─────────────────────────────────────────────────────────
+@app.route("/api/partials")
+def api_partials():
+    rows = partials.summary()
+    return jsonify(partials=rows, bytes=sum(r["size"] or 0 for r in rows), ttl_secs=PARTIAL_TTL)
+
+@app.route("/api/partials/cleanup", methods=["POST"])
+def api_partials_cleanup():
+    """Delete partials of finished jobs older than max_age_hours (default YTDL_PARTIAL_TTL);
+    with "dir", also untracked .part/.ytdl files in that folder."""
+    d = request.get_json(silent=True) or {}
+    try: max_age = float(d["max_age_hours"]) * 3600 if "max_age_hours" in d else PARTIAL_TTL
+    except (TypeError, ValueError): return jsonify(error="Bad max_age_hours"), 400
+    return jsonify(ok=True, **partials.cleanup(max_age, d.get("dir","").strip()))
+
+# ── Bandwidth ─────────────────────────────────────────────────────────────────
+@app.route("/api/bandwidth", methods=["GET","POST"])
+def api_bandwidth():
+    """GET the budget, schedule and live throughput; POST {"limit": "4M", "schedule": [...]} to change them."""
+    if request.method == "POST":
+        d = request.get_json(silent=True) or {}
+        conf = {k: d[k] for k in ("limit", "schedule") if k in d}
+        try: bandwidth.configure(**conf)
+        except (ValueError, KeyError, TypeError, AttributeError) as e: return jsonify(error=f"Bad bandwidth setting: {e}"), 400
+        store.put_kv("bandwidth", dict(store.get_kv("bandwidth", {}), **conf))
+    return jsonify(bandwidth.state())
+
+# ── Rate governor ─────────────────────────────────────────────────────────────
+@app.route("/api/ratelimit")
+def api_ratelimit():
+    """Per-host request budget and 429 backoff state."""
+    return jsonify(hosts=governor.state(), per_min=EXTRACT_PER_MIN, burst=EXTRACT_BURST,
+                   backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX, retry_sleep=RETRY_SLEEP)
+
+@app.route("/api/ratelimit/reset", methods=["POST"])
+def api_ratelimit_reset():
+    """Forget backoff state ({"host"} or all) — e.g. after switching VPN/IP."""
+    governor.reset((request.get_json(silent=True) or {}).get("host",""))
+    return jsonify(ok=True)
+
+# ── Engine ────────────────────────────────────────────────────────────────────
+@app.route("/api/engine", methods=["GET","POST"])
+def api_engine():
+    """GET the current yt-dlp engine, or POST {"engine": "subprocess"|"inprocess"}."""
+    global ENGINE
+    if request.method == "POST":
+        eng = (request.get_json(silent=True) or {}).get("engine","")
+        if eng not in ("subprocess","inprocess"): return jsonify(error=f"Unknown engine {eng!r}"), 400
+        ENGINE = eng
+    return jsonify(engine=ENGINE, pool=inproc_pool.info())
+
+# ── Cache ─────────────────────────────────────────────────────────────────────
+@app.route("/api/cache")
+def api_cache():
+    return jsonify(**cache.stats(), info_ttl=INFO_TTL, playlist_ttl=PLAYLIST_TTL)
+
+@app.route("/api/cache/clear", methods=["POST"])
+def api_cache_clear():
+    cache.clear((request.get_json(silent=True) or {}).get("namespace",""))
+    return jsonify(ok=True)
+
+# ── Cluster ───────────────────────────────────────────────────────────────────
+@app.route("/api/cluster")
+def api_cluster():
+    return jsonify(**cluster.summary(), role="worker" if COORDINATOR else "coordinator")
+
+@app.route("/api/cluster/<action>", methods=["POST"])
+def api_cluster_call(action):
+    """Worker → coordinator calls (see CLUSTER); with YTDL_CLUSTER_TOKEN set, workers must send it."""
+    if CLUSTER_TOKEN and request.headers.get("X-Cluster-Token") != CLUSTER_TOKEN:
+        return jsonify(error="Bad cluster token"), 403
+    d = request.get_json(silent=True) or {}
+    wid = str(d.get("worker", "")); slots = int(d.get("slots") or 1); addr = request.remote_addr or ""
+    if not wid: return jsonify(error="worker is required"), 400
+    if action == "lease":     return jsonify(tasks=cluster.lease(wid, slots, int(d.get("free") or 0), addr))
+    if action == "heartbeat": return jsonify(stop=cluster.heartbeat(wid, d.get("leases", []), slots, addr))
+    if action == "events":    return jsonify(ok=cluster.relay(wid, d.get("lease", ""), d.get("events", [])))
+    if action == "complete":  return jsonify(ok=cluster.complete(wid, d.get("lease", ""), bool(d.get("ok")), d.get("archived")))
+    return jsonify(error=f"Unknown action {action!r}"), 400
+
+# ── Metrics ───────────────────────────────────────────────────────────────────
+@app.route("/metrics")
+def api_metrics():
+    """Prometheus scrape target: the counters/histograms above plus gauges sampled now."""
+    states = store.q("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state")
+    with jobs_lock: running = list(jobs.values())
+    with fetches_lock: running += list(fetches.values()) + list(estimates.values())
+    procs = sum(j.info()["processes"] for j in running)
+    sse = hub.stats(); queued = [n for ch in sse.values() for n in ch["queued"]]
+    bw = bandwidth.state(); rl = governor.state(); pool = inproc_pool.info(); cl = cluster.summary(); pp = postproc.info()
+    gauges = [
+        ("ytdl_jobs", "jobs in the queue by state", [({"state": r["state"]}, r["n"]) for r in states]),
+        ("ytdl_active_processes", "yt-dlp/ffmpeg processes and in-process tasks running now", [({}, procs)]),
+        ("ytdl_inproc_workers", "ytdl_worker.py processes alive", [({}, pool["workers"])]),
+        ("ytdl_throughput_bytes_per_second", "current aggregate download speed",
+         [({"window": "now"}, bw["aggregate_bps"]), ({"window": "30s"}, bw["aggregate_bps_30s"])]),
+        ("ytdl_bandwidth_streams", "downloads sharing the bandwidth budget", [({}, len(bw["streams"]))]),
+        ("ytdl_sse_subscribers", "open SSE connections", [({}, sum(ch["subscribers"] for ch in sse.values()))]),
+        ("ytdl_sse_queue_depth", "events waiting in SSE subscriber queues",
+         [({"agg": "sum"}, sum(queued)), ({"agg": "max"}, max(queued, default=0))]),
+        ("ytdl_ratelimit_backoff_level", "429 backoff level per host", [({"host": h}, b["backoff_level"]) for h, b in rl.items()]),
+        ("ytdl_cluster_workers", "cluster workers seen within the lease time", [({}, sum(w["alive"] for w in cl["workers"]))]),
+        ("ytdl_cluster_tasks", "cluster tasks by state", [({"state": k}, n) for k, n in cl["tasks"].items()]),
+        ("ytdl_postprocess_items", "items in the postprocess pool",
+         [({"state": "queued"}, pp["queued"]), ({"state": "running"}, pp["running"])]),
+        ("ytdl_ratelimit_cooldown_seconds", "remaining 429 cool-down per host", [({"host": h}, b["cooldown_secs"]) for h, b in rl.items()]),
+    ]
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
 # ── Settings ──────────────────────────────────────────────────────────────────
-@app.route("/api/update_ytdlp", methods=["POST"])
+@app.route("/api/update_ytdlp", methods=["GET","POST"])
 def api_update():
-    client_id = request.json.get("client_id","")
+    """GET the update state; POST checks PyPI now and stages a newer yt-dlp for the next job."""
+    if request.method == "GET": return jsonify(updater.info())
+    client_id = (request.get_json(silent=True) or {}).get("client_id","")
     def _run():
-        push(client_id, f"[{ts()}] Updating yt-dlp…")
-        result = subprocess.run([sys.executable,"-m","pip","install","--upgrade","yt-dlp"],
-                                capture_output=True, text=True, timeout=120)
-        for line in (result.stdout+result.stderr).splitlines():
-            if line.strip(): push(client_id, line)
-        push(client_id, f"[{ts()}] Done.")
+        say = lambda m: push(client_id, m)
+        if not updater.enabled():
+            say(f"[{ts()}] A custom yt-dlp is configured (YTDL_YTDLP) — update it yourself."); push_done(client_id, False); return
+        say(f"[{ts()}] Checking for a newer yt-dlp…")
+        updater.check(say, force=True)
+        if updater.swap_if_idle(): say(f"[{ts()}] Now using yt-dlp {updater.version()}")
+        elif updater.staged: say(f"[{ts()}] Jobs are running — switching when they are done.")
         push_done(client_id, True)
     threading.Thread(target=_run, daemon=True).start()
     return jsonify(ok=True)
 
 @app.route("/api/check_tools")
 def api_check_tools():
-    results = []
-    for tool, flag in [("yt-dlp","--version"),("ffmpeg","-version"),("python","--version")]:
-        try:
-            r = subprocess.run(f"{tool} {flag}", shell=True, capture_output=True, text=True)
-            ver = (r.stdout or r.stderr).split("\n")[0][:60]
-            results.append({"tool":tool,"status":"ok","version":ver})
-        except:
-            results.append({"tool":tool,"status":"error","version":"NOT FOUND"})
-    results.append({"tool":"platform","status":"ok","version":f"{platform.system()} {platform.release()}"})
-    return jsonify(results=results)
+    """Tool versions, from the probe cache unless an executable changed since."""
+    results = [tools.probe("yt-dlp", tool_args(["yt-dlp"]), "--version", tool_env()),
+               tools.probe("ffmpeg", tool_args(["ffmpeg"]), "-version"),
+               {"tool":"python","status":"ok","version":f"Python {platform.python_version()}"},
+               {"tool":"platform","status":"ok","version":f"{platform.system()} {platform.release()}"}]
+    return jsonify(results=results, update=updater.info())
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  HEADLESS CLI  (python app.py download … — batch runs from cron / schedulers)
+# ═══════════════════════════════════════════════════════════════════════════
+# The UI's engine (format probe, strategies, postprocess pipeline, archive,
+# partials) without Flask, the job queue or a browser. stdout is JSON lines,
+# one object per event: start, estimate, item (status changes), progress,
+# log (with -v), summary. Exit codes below.
+CLI_OK, CLI_PARTIAL, CLI_USAGE, CLI_FAILED, CLI_NO_TOOL, CLI_STATE_BUSY, CLI_INTERRUPTED = 0, 1, 2, 3, 4, 5, 130
+
+def _cli_parser():
+    import argparse
+    ap = argparse.ArgumentParser(prog="app.py download", description="Download without the UI; progress as JSON lines on stdout.",
+        epilog="exit codes: 0 all done or already archived · 1 some failed · 2 bad usage · "
+               "3 none succeeded · 4 yt-dlp not runnable · 5 state folder in use · 130 interrupted")
+    ap.add_argument("urls", nargs="*", help="video URLs")
+    ap.add_argument("-a", "--batch-file", help='file with one URL per line ("-" = stdin, # comments)')
+    ap.add_argument("-m", "--mode", choices=("video", "audio"), default="video")
+    ap.add_argument("-q", "--quality", choices=list(FMT_MAP), default="1080p")
+    ap.add_argument("--audio-format", choices=list(AUDIO_CODECS), default="mp3")
+    ap.add_argument("-j", "--concurrency", type=int, default=2, help=f"parallel downloads (1–{MAX_CONCURRENCY})")
+    ap.add_argument("-o", "--output", default=DEFAULT_DIR, help="folder to save to")
+    ap.add_argument("--cookies", default="", help="cookies.txt file")
+    ap.add_argument("--cookies-from-browser", default="None", choices=["None"] + BROWSERS)
+    ap.add_argument("--limit-rate", default="No limit", help="cap for the whole run, shared by its parallel downloads, e.g. 2M")
+    ap.add_argument("--retries", default="5")
+    ap.add_argument("--no-probe", action="store_true", help="skip the format pre-flight")
+    ap.add_argument("--timeout", type=float, default=JOB_TIMEOUT, help="cancel the run after this many seconds (0 = never)")
+    ap.add_argument("-v", "--verbose", action="store_true", help="also emit yt-dlp's log lines")
+    return ap
+
+def cli_download(argv):
+    """Entry point of `python app.py download`. Returns the exit code."""
+    ap = _cli_parser(); a = ap.parse_args(argv)          # exits with CLI_USAGE on bad arguments
+    urls = list(a.urls)
+    if a.batch_file:
+        try: f = sys.stdin if a.batch_file == "-" else open(a.batch_file, encoding="utf-8")
+        except OSError as e: ap.error(str(e))
+        with f: urls += [l.strip() for l in f if l.strip() and not l.lstrip().startswith(("#", ";"))]
+    urls = list(dict.fromkeys(urls))
+    if not urls: ap.error("no URLs given")
+
+    out_lock = threading.Lock()
+    def emit(event, **kw):
+        with out_lock:
+            sys.stdout.write(json.dumps(dict(event=event, ts=round(time.time(), 3), **kw)) + "\n"); sys.stdout.flush()
+    if not STATE_OWNER:
+        emit("error", msg=f"{STATE_DIR} is in use by another app.py (the UI?) — set YTDL_STATE_DIR to a folder of its own")
+        return CLI_STATE_BUSY
+    yt = tools.probe("yt-dlp", tool_args(["yt-dlp"]), "--version", tool_env())
+    if yt["status"] != "ok": emit("error", msg=f"yt-dlp not runnable: {yt['version']}"); return CLI_NO_TOOL
+
+    client_id = f"cli-{os.getpid()}"; job = Job(client_id, "cli"); watchdog.limit(job, a.timeout)
+    is_audio = a.mode == "audio"; fmt = a.audio_format if is_audio else FMT_MAP[a.quality]
+    parallel = max(1, min(a.concurrency, MAX_CONCURRENCY)); out_dir = sanitize(a.output)
+    cookie_args = build_cookie_args(a.cookies_from_browser, a.cookies)
+    extra_args  = build_extra_args(a.limit_rate, a.retries)
+    items = [{"idx": i, "id": (archive_key(u) or ("", u))[1], "url": u} for i, u in enumerate(urls)]
+    results = {}; t0 = time.time()
+
+    # the engine reports through the SSE hub; this channel is relayed to stdout
+    wake = threading.Event(); over = threading.Event(); sub = hub.subscribe(client_id, wake.set)
+    def relay():
+        while True:
+            last = over.is_set(); wake.wait(0.5); wake.clear()
+            for _, event, data in sub.drain():
+                if event == "progress":
+                    for p in json.loads(data)["items"]:
+                        i = p.pop("index", None)
+                        emit("progress", index=i, url=urls[i] if i is not None else None, **p)
+                elif event == "log" and a.verbose: emit("log", msg=data)
+            if last: return
+    relayer = threading.Thread(target=relay, daemon=True, name="cli-relay"); relayer.start()
+    interrupted = threading.Event()
+    def on_signal(*_): interrupted.set(); job.cancel()
+    for sig in (signal.SIGINT, signal.SIGTERM): signal.signal(sig, on_signal)
+
+    def finish(v, ok):
+        hit = archive.lookup(v["url"], a.mode) if ok else None
+        results[v["idx"]] = "done" if ok else "stopped" if job.stop.is_set() else "failed"
+        emit("item", index=v["idx"], url=v["url"], status=results[v["idx"]], path=hit["path"] if hit else None)
+
+    emit("start", urls=len(urls), mode=a.mode, quality=a.quality, concurrency=parallel, output=out_dir)
+    pending = []
+    for v in items:
+        hit = archive.lookup(v["url"], a.mode)
+        if hit: results[v["idx"]] = "skipped"; emit("item", index=v["idx"], url=v["url"], status="skipped", path=hit["path"])
+        else: pending.append(v)
+    probe = probe_formats(pending, fmt, is_audio, cookie_args, extra_args, job, client_id) \
+            if PROBE and not a.no_probe and pending else {}
+    if probe: emit("estimate", **batch_estimate(probe, pending, parallel))
+
+    muxing = []
+    def one(v):
+        if job.stop.is_set(): return
+        emit("item", index=v["idx"], url=v["url"], status="downloading")
+        fut = _download_item(v, fmt, is_audio, probe, cookie_args, extra_args, out_dir, client_id, job,
+                             f"[#{v['idx'] + 1}] " if parallel > 1 else "", finish)
+        if fut: muxing.append(fut)
+    with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="cli") as pool:
+        for f in [pool.submit(one, v) for v in pending]: f.result()
+    for f in muxing: f.result()
+    over.set(); wake.set(); relayer.join(5); hub.unsubscribe(client_id, sub); hub.close(client_id)
+
+    counts = {s: sum(1 for r in results.values() if r == s) for s in ("done", "skipped", "failed", "stopped")}
+    counts["stopped"] += len(items) - len(results)
+    emit("summary", **counts, secs=round(time.time() - t0, 2), timed_out=job.timed_out)
+    if interrupted.is_set(): return CLI_INTERRUPTED
+    if not counts["failed"] and not counts["stopped"]: return CLI_OK
+    return CLI_PARTIAL if counts["done"] + counts["skipped"] else CLI_FAILED
 
 def _find_open_port(preferred=5050, max_tries=20):
     """Return the first available port, starting from preferred."""
@@ -540,7 +3564,7 @@ def _find_open_port(preferred=5050, max_tries=20):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             try:
-                sock.bind(("0.0.0.0", port))
+                sock.bind((HOST, port))
                 return port
             except OSError:
                 continue
@@ -549,12 +3573,20 @@ def _find_open_port(preferred=5050, max_tries=20):
 
 if __name__ == "__main__":
     import webbrowser
+    if HEADLESS: sys.exit(cli_download(sys.argv[2:]))
+    if COORDINATOR:
+        ClusterWorker(WORKER_SLOTS).run(); sys.exit(0)
 
     preferred_port = int(os.environ.get("PORT", 5050))
     run_port = _find_open_port(preferred_port)
     if run_port != preferred_port:
         print(f"[startup] Port {preferred_port} is busy, using {run_port} instead.")
     print(f"[startup] Opening UI at http://localhost:{run_port}")
+    ui_port = run_port
+
+    sse_port = int(SSE_PORT) if SSE_PORT else _find_open_port(run_port + 1)
+    if sse_port and start_sse_server(sse_port):
+        print(f"[startup] Live log stream on port {sse_server_port}")
 
     threading.Timer(1.2, lambda: webbrowser.open(f"http://localhost:{run_port}")).start()
-    app.run(host="0.0.0.0", port=run_port, debug=False, threaded=True)
+    app.run(host=HOST, port=run_port, debug=False, threaded=True)
@@ -0,0 +1,174 @@
+"""Benchmarks / load tests for the download pipeline, driven by bench/fake_tool.py.
+
+    python bench/bench.py                                  # every scenario
+    python bench/bench.py single playlist -n 40 --concurrency 4
+    python bench/bench.py playlist --fake '{"p403": 0.3, "good_clients": ["android"]}'
+    python bench/bench.py --json results.json
+
+Each scenario runs in its own Python process: app.py is imported with a fresh
+state folder, the subprocess engine and YTDL_YTDLP / YTDL_FFMPEG pointing at the
+fake tools, then driven through Flask's test client like the UI would. Reported:
+
+  jobs_per_min       finished downloads (or converted files) per minute
+  spawns_per_success yt-dlp/ffmpeg processes started per success
+  sse_events_per_sec events published to the client's SSE channel
+  py_kb_per_job      peak Python heap (tracemalloc) per job; rss_mb = peak RSS
+  latency_*          submit → done per job (single), start → done per item (playlist),
+                     whole batch (conversion)
+"""
+import sys, os, json, time, argparse, tempfile, threading, subprocess, tracemalloc
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+ROOT = HERE.parent
+FAKE = HERE / "fake_tool.py"
+SCENARIOS = ("single", "playlist", "convert")
+CLIENT = "bench"
+
+def pct(values, p):
+    if not values: return None
+    v = sorted(values); return round(v[min(len(v) - 1, int(p / 100 * len(v)))], 3)
+
+def rss_mb():
+    try:
+        import resource
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(kb / (1048576 if sys.platform == "darwin" else 1024), 1)
+    except ImportError:                 # Windows
+        return None
+
+# ── Child side: one scenario against an in-process app ───────────────────────
+def _count_spawns(log_path):
+    counts = {}
+    if os.path.exists(log_path):
+        with open(log_path, encoding="utf-8") as f:
+            for line in f:
+                tool = line.split("\t", 1)[0]; counts[tool] = counts.get(tool, 0) + 1
+    return counts
+
+def run_scenario(name, n, concurrency):
+    import app
+    app.ENGINE = "subprocess"
+    c = app.app.test_client()
+    events = {"n": 0}; item_times = {}; lock = threading.Lock()
+
+    def drain(sub, wake):
+        # stands in for a browser tab: reads every event the way /stream does
+        while True:
+            wake.wait(1.0); wake.clear()
+            for _, event, data in sub.drain():
+                with lock:
+                    events["n"] += 1
+                    if event == "playlist_delta":
+                        for it in json.loads(data)["items"]:
+                            item_times.setdefault(it["index"], {})[it["status"]] = time.time()
+    wake = threading.Event()
+    sub = app.hub.subscribe(CLIENT, wake.set)
+    threading.Thread(target=drain, args=(sub, wake), daemon=True).start()
+
+    def wait_jobs(ids):
+        done_at = {}
+        while len(done_at) < len(ids):
+            for j in ids:
+                if j not in done_at and app.store.get(j)["state"] not in ("queued", "running"): done_at[j] = time.time()
+            time.sleep(0.02)
+        return done_at
+
+    out_dir = tempfile.mkdtemp(prefix="bench-out-")
+    tracemalloc.start(); t0 = time.time(); result = {"scenario": name, "n": n, "concurrency": concurrency}
+    if name == "single":
+        app.scheduler.set_max_jobs(concurrency)
+        sent = {}
+        for i in range(n):
+            r = c.post("/api/download/video", json={"client_id": CLIENT, "save_dir": out_dir, "quality": "1080p",
+                                                    "url": f"https://www.youtube.com/watch?v=s{i:010d}"}).get_json()
+            sent[r["job_id"]] = time.time()
+        done_at = wait_jobs(list(sent))
+        ok = sum(1 for j in sent if app.store.get(j)["state"] == "done")
+        lat = [done_at[j] - sent[j] for j in sent]
+        result.update(jobs=len(sent), successes=ok, latency_p50=pct(lat, 50), latency_p95=pct(lat, 95))
+    elif name == "playlist":
+        t_fetch = time.time()
+        r = c.post("/api/playlist/fetch", json={"client_id": CLIENT, "url": "https://www.youtube.com/playlist?list=PLbench"}).get_json()
+        fetch_secs = time.time() - t_fetch
+        r = c.post("/api/playlist/download/all", json={"client_id": CLIENT, "save_dir": out_dir, "quality": "1080p",
+                                                       "concurrency": concurrency}).get_json()
+        wait_jobs([r["job_id"]])
+        counts = app.store.item_counts(r["job_id"]); ok = counts.get("done", 0)
+        time.sleep(0.2)
+        with lock: lat = [t["done"] - t["downloading"] for t in item_times.values() if "done" in t and "downloading" in t]
+        result.update(jobs=sum(counts.values()), successes=ok, fetch_secs=round(fetch_secs, 3),
+                      latency_p50=pct(lat, 50), latency_p95=pct(lat, 95))
+    elif name == "convert":
+        src = tempfile.mkdtemp(prefix="bench-src-")
+        for i in range(n): Path(src, f"clip{i:04d}.webm").write_bytes(b"\0" * 65536)
+        r = c.post("/api/convert/batch", json={"client_id": CLIENT, "path": src, "format": "mp3",
+                                               "out_dir": out_dir, "concurrency": concurrency}).get_json()
+        done_at = wait_jobs([r["job_id"]])
+        counts = app.store.item_counts(r["job_id"]); ok = counts.get("done", 0)
+        result.update(jobs=sum(counts.values()), successes=ok, latency_p50=round(done_at[r["job_id"]] - t0, 3))
+    elapsed = time.time() - t0
+    _, peak = tracemalloc.get_traced_memory(); tracemalloc.stop()
+    time.sleep(0.3)
+    spawns = _count_spawns(os.environ["FAKE_TOOL_LOG"])
+    procs = spawns.get("ffmpeg" if name == "convert" else "yt-dlp", 0)
+    with lock: n_events = events["n"]
+    result.update(
+        secs=round(elapsed, 2),
+        jobs_per_min=round(result["successes"] * 60 / elapsed, 1) if elapsed else None,
+        spawns=procs, spawns_per_success=round(procs / result["successes"], 2) if result["successes"] else None,
+        sse_events=n_events, sse_events_per_sec=round(n_events / elapsed, 1) if elapsed else None,
+        py_kb_per_job=round(peak / 1024 / max(result["jobs"], 1), 1), rss_mb=rss_mb())
+    return result
+
+# ── Parent side: one child process per scenario ──────────────────────────────
+def launch(name, args):
+    state = tempfile.mkdtemp(prefix="bench-state-")
+    fake = dict(json.loads(args.fake or "{}"))
+    if name == "playlist": fake.setdefault("playlist_n", args.n)
+    env = dict(os.environ,
+               YTDL_STATE_DIR=state, YTDL_ENGINE="subprocess",
+               YTDL_YTDLP=f'"{sys.executable}" "{FAKE}" yt-dlp', YTDL_FFMPEG=f'"{sys.executable}" "{FAKE}" ffmpeg',
+               YTDL_EXTRACT_PER_MIN=str(args.extract_per_min), YTDL_EXTRACT_BURST=str(args.concurrency * 2),
+               YTDL_BACKOFF_BASE="1", YTDL_MAX_CONCURRENCY=str(max(8, args.concurrency)),
+               YTDL_CONVERT_WORKERS=str(args.concurrency), YTDL_SSE_PORT="0",
+               FAKE_TOOL_CONFIG=json.dumps(fake), FAKE_TOOL_LOG=os.path.join(state, "spawns.log"))
+    cmd = [sys.executable, str(Path(__file__).resolve()), "--child", name, "-n", str(args.n), "--concurrency", str(args.concurrency)]
+    r = subprocess.run(cmd, cwd=str(ROOT), env=env, capture_output=True, text=True, timeout=args.timeout)
+    lines = [l for l in r.stdout.splitlines() if l.startswith("{")]
+    if r.returncode != 0 or not lines:
+        return {"scenario": name, "error": (r.stderr or r.stdout).strip().splitlines()[-1:] or ["no output"]}
+    return json.loads(lines[-1])
+
+COLUMNS = ("scenario", "jobs", "successes", "secs", "jobs_per_min", "spawns_per_success",
+           "sse_events_per_sec", "py_kb_per_job", "rss_mb", "latency_p50", "latency_p95")
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the downloader against fake yt-dlp/ffmpeg.")
+    ap.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    ap.add_argument("-n", type=int, default=20, help="videos / files per scenario (default 20)")
+    ap.add_argument("--concurrency", type=int, default=4, help="running jobs, playlist parallelism or ffmpeg workers")
+    ap.add_argument("--fake", default="", help='JSON overrides for fake_tool.py, e.g. \'{"p403": 0.2}\'')
+    ap.add_argument("--extract-per-min", type=float, default=100000, help="rate governor budget (default: effectively off)")
+    ap.add_argument("--timeout", type=float, default=600)
+    ap.add_argument("--json", help="also write the results to this file")
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    bad = [s for s in args.scenarios if s not in SCENARIOS]
+    if bad: ap.error(f"unknown scenario(s): {', '.join(bad)}")
+
+    if args.child:
+        sys.path.insert(0, str(ROOT))
+        print(json.dumps(run_scenario(args.child, args.n, args.concurrency)), flush=True)
+        os._exit(0)                     # skip waiting on the app's daemon threads
+
+    results = [launch(name, args) for name in (args.scenarios or SCENARIOS)]
+    print("  ".join(f"{c:>18}" for c in COLUMNS))
+    for r in results:
+        if "error" in r: print(f"{r['scenario']:>18}  ERROR: {r['error']}"); continue
+        print("  ".join(f"{'' if r.get(c) is None else r.get(c):>18}" for c in COLUMNS))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
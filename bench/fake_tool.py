@@ -0,0 +1,242 @@
+"""Stand-in for yt-dlp and ffmpeg, for benchmarks and load tests.
+
+Run as `python bench/fake_tool.py yt-dlp ARGS…` or `… ffmpeg ARGS…` — bench.py
+points YTDL_YTDLP / YTDL_FFMPEG here. It understands the flags app.py passes and
+prints what the real tool prints for them (listing lines, "Downloading N
+format(s)", "Destination:", progress, 403/429/SABR errors) while writing real
+bytes at a configurable speed, so parsing, resuming, the archive and the SSE
+path all run for real. No network access.
+
+Behaviour comes from FAKE_TOOL_CONFIG (a JSON object, keys as in DEFAULTS).
+If FAKE_TOOL_LOG is set, every invocation appends one line to it so the
+benchmark can count spawns.
+"""
+import sys, os, re, json, time, random, hashlib
+from urllib.parse import urlparse, parse_qs
+
+DEFAULTS = {
+    "extract_ms":    300,             # extraction latency (skipped with --load-info-json)
+    "bytes":         4 * 1048576,     # size of each downloaded stream
+    "speed":         20 * 1048576,    # bytes/s unless --limit-rate is lower
+    "progress_hz":   10,              # progress lines per second
+    "split":         True,            # separate video+audio streams (137+140) that get merged
+    "p403":          0.0,             # chance an attempt gets HTTP 403 ...
+    "fail_at":       0.0,             # ... after this fraction of the bytes (0 = before the first)
+    "pstall":        0.0,             # chance an attempt hangs silently after its first Destination line
+    "p429":          0.0,             # chance an attempt is rate limited
+    "psabr":         0.0,             # chance an attempt hits SABR (then 403)
+    "good_clients":  [],              # if set, attempts whose --extractor-args name none of these get 403
+    "unavailable":   [],              # video IDs that are "Video unavailable"
+    "missing_formats": [],            # video IDs where only the single-file fallback ("best") exists
+    "playlist_n":    50,              # --flat-playlist entries
+    "playlist_ms":   5,               # latency per listed entry
+    "convert_secs":  60.0,            # ffmpeg: input duration
+    "convert_speed": 50.0,            # ffmpeg: x realtime
+    "seed":          None,            # makes failures reproducible per URL and attempt
+}
+CONF = dict(DEFAULTS, **json.loads(os.environ.get("FAKE_TOOL_CONFIG") or "{}"))
+ERR_403  = "ERROR: [youtube] {id}: unable to download video data: HTTP Error 403: Forbidden"
+ERR_429  = "ERROR: [youtube] {id}: HTTP Error 429: Too Many Requests"
+WARN_SABR = ("WARNING: [youtube] {id}: Some web client https formats have been skipped as they are missing a url. "
+             "YouTube is forcing SABR streaming for this client.")
+
+def say(*a, err=False):
+    print(*a, file=sys.stderr if err else sys.stdout, flush=True)
+
+def opt(args, name, default=None):
+    return args[args.index(name) + 1] if name in args and args.index(name) + 1 < len(args) else default
+
+def opts(args, name):
+    return [args[i + 1] for i, a in enumerate(args[:-1]) if a == name]
+
+def parse_rate(v):
+    if not v: return None
+    mult = {"K": 1024, "M": 1048576, "G": 1073741824}.get(v[-1].upper(), 1)
+    return float(v[:-1] if mult > 1 else v) * mult
+
+def fill(template, info):
+    out = re.sub(r"%\(\.\{([\w,]+)\}\)j", lambda m: json.dumps({k: info.get(k) for k in m.group(1).split(",")}), template)
+    for k, v in info.items(): out = out.replace(f"%({k})s", str(v))
+    return out
+
+def outtmpl(args, kind=""):
+    """The -o template for `kind` ("" = the media files), or None."""
+    for o in opts(args, "-o"):
+        m = re.match(r"^([a-z]{2,}):", o)      # "infojson:…", "thumbnail:…" (not a drive letter)
+        if (m.group(1) if m else "") == kind: return o[len(m.group(0)):] if m else o
+    return None
+
+def log_spawn(tool, key):
+    path = os.environ.get("FAKE_TOOL_LOG")
+    if not path: return 0
+    with open(path, "a+", encoding="utf-8") as f:
+        f.seek(0); before = sum(1 for l in f if l.split("\t")[1:2] == [key])
+        f.write(f"{tool}\t{key}\t{time.time():.3f}\n")
+    return before
+
+def video_id(url):
+    u = urlparse(url)
+    vid = parse_qs(u.query).get("v", [""])[0] or u.path.strip("/").split("/")[-1]
+    return vid or hashlib.sha1(url.encode()).hexdigest()[:11]
+
+# ── yt-dlp ──────────────────────────────────────────────────────────────────
+def flat_playlist(args, url):
+    tmpl = opt(args, "--print", "%(id)s")
+    a, b = 1, CONF["playlist_n"]
+    if "--playlist-items" in args:
+        lo, _, hi = opt(args, "--playlist-items").partition(":")
+        a = int(lo or 1); b = min(b, int(hi)) if hi else b
+    base = video_id(url)[:4]
+    for i in range(a - 1, b):
+        vid = f"{base}{i:07d}"[-11:]
+        say(fill(tmpl, {"id": vid, "title": f"Fake video {i + 1}", "url": f"https://www.youtube.com/watch?v={vid}"}))
+        time.sleep(CONF["playlist_ms"] / 1000)
+    return 0
+
+def probe(args, urls):
+    """A --skip-download run (the format probe): extraction only, one --print line per video."""
+    log_spawn("yt-dlp-probe", urls[0] if urls else "")
+    tmpl = opt(args, "--print", "%(id)s"); ij = outtmpl(args, "infojson"); sel = opt(args, "-f", "") or ""
+    rc = 0
+    for url in urls:
+        vid = video_id(url); time.sleep(CONF["extract_ms"] / 1000)
+        if vid in CONF["unavailable"]: say(f"ERROR: [youtube] {vid}: Video unavailable"); rc = 1; continue
+        if vid in CONF["missing_formats"] and sel != "best":
+            say(f"ERROR: [youtube] {vid}: Requested format is not available. Use --list-formats for a list of available formats")
+            rc = 1; continue
+        first = sel.split("/")[0]
+        fid = first if first.replace("+", "").isdigit() else "140" if sel.startswith("bestaudio") else \
+              "137+140" if CONF["split"] and "+" in sel else "18"
+        info = {"id": vid, "title": f"Fake video {vid}", "webpage_url": url, "extractor_key": "Youtube"}
+        if ij and "--write-info-json" in args:
+            with open(fill(ij, info) + ".info.json", "w", encoding="utf-8") as f: json.dump(info, f)
+        say(fill(tmpl, dict(info, format_id=fid, filesize=None, duration=60,
+                            filesize_approx=CONF["bytes"] * len(fid.split("+")))))
+    return rc
+
+def download_stream(path, total, rate, template, fail_after=None):
+    """Append to path.part until it holds `total` bytes; False if the fake 403 struck first."""
+    part = path + ".part"
+    have = os.path.getsize(part) if os.path.exists(part) else 0
+    if have: say(f"[download] Resuming download at byte {have}")
+    tick = 1.0 / CONF["progress_hz"]; chunk = max(1, int(rate * tick)); t0 = time.time(); start = have
+    with open(part, "ab") as f:
+        while have < total:
+            if fail_after is not None and have >= fail_after: return False
+            n = min(chunk, total - have); f.write(b"\0" * n); f.flush(); have += n
+            elapsed = time.time() - t0; target = (have - start) / rate
+            if target > elapsed: time.sleep(target - elapsed)
+            speed = (have - start) / max(time.time() - t0, 1e-6); eta = int((total - have) / speed) if speed else 0
+            if template: say(f"[progress]downloading|{have}|{total}|NA|{speed:.0f}|{eta}")
+            else: say(f"[download] {100.0 * have / total:5.1f}% of {total / 1048576:.2f}MiB at {speed / 1048576:.2f}MiB/s ETA 00:{eta:02d}")
+    if template: say(f"[progress]finished|{total}|{total}|NA|NA|0")
+    os.replace(part, path)
+    return True
+
+def ytdlp(args):
+    if "--version" in args: say("2099.01.01 (fake)"); return 0
+    urls = [a for a in args if a.startswith(("http://", "https://"))]
+    info_path = opt(args, "--load-info-json")
+    if info_path:
+        with open(info_path, encoding="utf-8") as f: info = json.load(f)
+        url = info["webpage_url"]
+    else:
+        url = urls[-1] if urls else ""
+    if "--flat-playlist" in args: log_spawn("yt-dlp-list", url); return flat_playlist(args, url)
+    if "--skip-download" in args: return probe(args, urls)
+    attempt = log_spawn("yt-dlp", url)
+    rnd = random.Random(f"{CONF['seed']}|{url}|{attempt}") if CONF["seed"] is not None else random.Random()
+    vid = video_id(url); title = f"Fake video {vid}"
+    out_dir = opt(args, "-P", "."); os.makedirs(out_dir, exist_ok=True)
+
+    if not info_path:
+        say(f"[youtube] Extracting URL: {url}")
+        time.sleep(CONF["extract_ms"] / 1000)
+        say(f"[youtube] {vid}: Downloading webpage")
+        if outtmpl(args, "infojson") and "--write-info-json" in args:
+            with open(outtmpl(args, "infojson") + ".info.json", "w", encoding="utf-8") as f:
+                json.dump({"id": vid, "title": title, "webpage_url": url, "extractor_key": "Youtube"}, f)
+
+    xargs = " ".join(opts(args, "--extractor-args"))
+    if CONF["good_clients"] and not any(c in xargs for c in CONF["good_clients"]):
+        say(ERR_403.format(id=vid)); return 1
+    if rnd.random() < CONF["p429"]: say(ERR_429.format(id=vid)); return 1
+    if rnd.random() < CONF["psabr"]: say(WARN_SABR.format(id=vid)); say(ERR_403.format(id=vid)); return 1
+    fail = rnd.random() < CONF["p403"]
+    stall = rnd.random() < CONF["pstall"]
+    if fail and not CONF["fail_at"]: say(ERR_403.format(id=vid)); return 1
+
+    sel = opt(args, "-f", "") or ""
+    audio = "--extract-audio" in args or sel.startswith("bestaudio")
+    raw = "," in sel                    # "V,A": streams saved separately, nothing merged
+    def pinned(part):
+        first = part.split("/")[0]
+        return first.split("+") if first.replace("+", "").isdigit() else None
+    if vid in CONF["unavailable"]: say(f"ERROR: [youtube] {vid}: Video unavailable"); return 1
+    if vid in CONF["missing_formats"] and not pinned(sel.split(",")[0]) and sel != "best":
+        say(f"ERROR: [youtube] {vid}: Requested format is not available. Use --list-formats for a list of available formats")
+        return 1
+    if raw:
+        v, a = sel.split(",", 1)
+        fids = [(pinned(v) or ["137" if CONF["split"] else "18"])[0], (pinned(a) or ["140"])[0]]
+    else:
+        fids = pinned(sel) or (["140"] if audio else ["137", "140"] if CONF["split"] else ["18"])
+    say(f"[info] {vid}: Downloading {len(fids)} format(s): {(', ' if raw else '+').join(fids)}")
+    limit = parse_rate(opt(args, "--limit-rate")); rate = min(CONF["speed"], limit) if limit else CONF["speed"]
+    template = "--progress-template" in args
+    files = []; tmpl = outtmpl(args)
+    for fid in fids:
+        ext = "m4a" if fid == "140" else "mp4"
+        name = fill(tmpl, {"title": title, "id": vid, "format_id": fid, "ext": ext}) if tmpl else \
+               f"{title} [{vid}]" + (f".f{fid}" if len(fids) > 1 else "") + f".{ext}"
+        path = os.path.join(out_dir, name)
+        say(f"[download] Destination: {path}")
+        if stall: time.sleep(86400)
+        if not download_stream(path, CONF["bytes"], rate, template, CONF["fail_at"] * CONF["bytes"] if fail else None):
+            say(ERR_403.format(id=vid)); return 1
+        files.append(path)
+    if "--write-thumbnail" in args:
+        thumb = fill(outtmpl(args, "thumbnail") or f"{title} [{vid}].%(ext)s", {"title": title, "id": vid, "ext": "webp"})
+        with open(os.path.join(out_dir, thumb), "wb") as f: f.write(b"RIFF\0\0\0\0WEBP")
+    final = files[0]
+    if len(files) > 1 and not raw:
+        final = os.path.join(out_dir, f"{title} [{vid}].mp4")
+        say(f'[Merger] Merging formats into "{final}"')
+        os.replace(files[0], final)
+        for f in files[1:]: os.remove(f)
+    if "--extract-audio" in args:
+        mp3 = os.path.splitext(final)[0] + "." + (opt(args, "--audio-format") or "mp3")
+        say(f"[ExtractAudio] Destination: {mp3}"); os.replace(final, mp3); final = mp3
+    common = {"extractor_key": "Youtube", "id": vid, "title": title, "uploader": "Fake channel",
+              "upload_date": "20990101", "webpage_url": url}
+    done = [(fid, path) for fid, path in zip(fids, files)] if raw else [("+".join(fids), final)]
+    for i, a in enumerate(args[:-2]):
+        if a == "--print-to-file" and args[i + 1].startswith("after_move:"):
+            with open(args[i + 2], "a", encoding="utf-8") as f:
+                for fid, path in done:
+                    fields = dict(common, format_id=fid, filepath=path, vcodec="none" if fid == "140" else "avc1",
+                                  acodec="none" if fid == "137" else "mp4a")
+                    f.write(fill(args[i + 1][len("after_move:"):], fields) + "\n")
+    return 0
+
+# ── ffmpeg ──────────────────────────────────────────────────────────────────
+def ffmpeg(args):
+    if "-version" in args: say("ffmpeg version fake"); return 0
+    src = opt(args, "-i"); dst = args[-2] if args[-1] == "-y" else args[-1]
+    log_spawn("ffmpeg", src or "")
+    dur = CONF["convert_secs"]; wall = dur / CONF["convert_speed"]
+    say(f"Input #0, mov,mp4,m4a, from '{src}':", err=True)
+    say(f"  Duration: {time.strftime('%H:%M:%S', time.gmtime(dur))}.00, start: 0.000000, bitrate: 128 kb/s", err=True)
+    steps = max(1, int(wall * CONF["progress_hz"]))
+    for k in range(1, steps + 1):
+        time.sleep(wall / steps)
+        if "-progress" in args:
+            say(f"out_time_us={int(dur * 1e6 * k / steps)}\ntotal_size={k * 4096}\nspeed={CONF['convert_speed']:.1f}x\n"
+                f"progress={'end' if k == steps else 'continue'}")
+    with open(dst, "wb") as f: f.write(b"\0" * 4096 * steps)
+    return 0
+
+if __name__ == "__main__":
+    tool, rest = (sys.argv[1], sys.argv[2:]) if len(sys.argv) > 1 else ("", [])
+    if tool not in ("yt-dlp", "ffmpeg"): say("usage: fake_tool.py yt-dlp|ffmpeg ARGS…", err=True); sys.exit(2)
+    sys.exit(ytdlp(rest) if tool == "yt-dlp" else ffmpeg(rest))
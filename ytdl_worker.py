@@ -0,0 +1,114 @@
+"""Long-lived yt-dlp worker — runs downloads in-process with yt_dlp.YoutubeDL.
+
+Started by app.py (InprocPool) as `python ytdl_worker.py`; speaks JSON lines:
+
+  parent → worker   {"id": n, "argv": [...]}     run one download (argv without "yt-dlp")
+                    {"cancel": n}                 abort task n at the next progress hook
+                    {"ratelimit": bps, "id": n}   change task n's rate limit (null = none)
+  worker → parent   {"ready": true, "version": "…"}
+                    {"id": n, "line": "…"}        a log line, same text the CLI would print
+                    {"id": n, "progress": {...}}  structured progress from progress_hooks
+                    {"id": n, "done": retcode}
+
+The yt_dlp import and extractor setup are paid once per worker instead of once
+per attempt. argv is turned into options with yt_dlp.parse_options, so every
+flag built in app.py means exactly what it means on the command line.
+"""
+import os, sys, json, threading, time
+
+import yt_dlp
+from yt_dlp.utils import DownloadCancelled
+
+PROTO      = sys.stdout
+proto_lock = threading.Lock()
+cancelled  = set()
+current    = {"id": None, "ydl": None}
+
+def send(**msg):
+    with proto_lock:
+        PROTO.write(json.dumps(msg) + "\n"); PROTO.flush()
+
+class _StdoutToLines:
+    """Anything yt-dlp or a postprocessor writes to stdout becomes a line message."""
+    def __init__(self): self.buf = ""
+    def write(self, s):
+        self.buf += s
+        while "\n" in self.buf:
+            line, self.buf = self.buf.split("\n", 1)
+            if line.strip(): send(id=current["id"], line=line.rstrip())
+        return len(s)
+    def flush(self): pass
+
+class _Logger:
+    def debug(self, msg):
+        # yt-dlp sends info-level output through debug() without the "[debug] " prefix
+        if not msg.startswith("[debug] "): send(id=current["id"], line=msg)
+    def info(self, msg):    send(id=current["id"], line=msg)
+    def warning(self, msg): send(id=current["id"], line=f"WARNING: {msg}")
+    def error(self, msg):   send(id=current["id"], line=msg)
+
+def _progress_hook(task_id):
+    last = [0.0]
+    def hook(d):
+        if task_id in cancelled: raise DownloadCancelled("Stopped by user")
+        now = time.time()
+        # finished/error always go through; "downloading" at most 4×/s
+        if d.get("status") == "downloading" and now - last[0] < 0.25: return
+        last[0] = now
+        total = d.get("total_bytes") or d.get("total_bytes_estimate")
+        send(id=task_id, progress={
+            "status": d.get("status"), "downloaded": d.get("downloaded_bytes"), "total": total,
+            "speed": d.get("speed"), "eta": d.get("eta"),
+            "pct": round(100.0 * d["downloaded_bytes"] / total, 1) if total and d.get("downloaded_bytes") else None,
+            "filename": d.get("filename")})
+    return hook
+
+def run(task_id, argv):
+    current["id"] = task_id
+    try:
+        opts = yt_dlp.parse_options(argv)
+        ydl_opts = dict(opts.ydl_opts, logger=_Logger(), noprogress=True,
+                        progress_hooks=[_progress_hook(task_id)])
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            current["ydl"] = ydl
+            # as yt-dlp's own main: --load-info-json replaces the URLs (app.py's info cache drops them)
+            if opts.options.load_info_filename is not None:
+                return ydl.download_with_info_file(os.path.expanduser(opts.options.load_info_filename))
+            return ydl.download(opts.urls)
+    except DownloadCancelled as e:
+        send(id=task_id, line=f"ERROR: {e}"); return 1
+    except SystemExit as e:      # parse_options reports bad flags via sys.exit
+        return e.code if isinstance(e.code, int) else 2
+    except Exception as e:
+        send(id=task_id, line=f"ERROR: {e}"); return 1
+    finally:
+        cancelled.discard(task_id); current["id"] = current["ydl"] = None
+
+def main():
+    sys.stdout = _StdoutToLines()
+    tasks = []; ready = threading.Condition()
+    def reader():
+        # cancels must be seen while a download is running, so stdin is read on its own thread
+        for raw in sys.stdin:
+            try: msg = json.loads(raw)
+            except ValueError: continue
+            if "cancel" in msg: cancelled.add(msg["cancel"])
+            elif "ratelimit" in msg:
+                # HTTP downloads read params["ratelimit"] on every block; fragment
+                # downloads copy params when they start and keep their old limit
+                ydl = current["ydl"]
+                if ydl and current["id"] == msg.get("id"): ydl.params["ratelimit"] = msg["ratelimit"]
+            else:
+                with ready: tasks.append(msg); ready.notify()
+        with ready: tasks.append(None); ready.notify()
+    threading.Thread(target=reader, daemon=True).start()
+    send(ready=True, version=yt_dlp.version.__version__)
+    while True:
+        with ready:
+            while not tasks: ready.wait()
+            msg = tasks.pop(0)
+        if msg is None: break
+        send(id=msg["id"], done=run(msg["id"], msg["argv"]))
+
+if __name__ == "__main__":
+    main()